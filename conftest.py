@@ -0,0 +1,51 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+
+def get_test_volume(
+    size=(30, 20, 10),
+    offset=0,
+    pixeltype=sitk.sitkInt16,
+    spacing=(0.8, 1.2, 2.5),
+    origin=(-12.0, 40.0, 3.5),
+    direction=(-1, 0, 0, 0, -1, 0, 0, 0, 1),
+):
+    """volume of `size` [x,y,z] whose voxels count up from -offset in [z,y,x] order"""
+    img_arr = np.arange(np.prod(size), dtype=np.int16).reshape(size[::-1]) - offset
+    img = sitk.GetImageFromArray(img_arr)
+    if pixeltype != sitk.sitkInt16:
+        img = sitk.Cast(img, pixeltype)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    img.SetDirection(direction)
+    return img
+
+
+def assert_same_image(img, other, atol=1e-5):
+    """same pixels and geometry, the nifti header stores the geometry as float32"""
+    assert img.GetSize() == other.GetSize()
+    assert img.GetPixelID() == other.GetPixelID()
+    np.testing.assert_allclose(img.GetOrigin(), other.GetOrigin(), atol=atol)
+    np.testing.assert_allclose(img.GetSpacing(), other.GetSpacing(), atol=atol)
+    np.testing.assert_allclose(img.GetDirection(), other.GetDirection(), atol=atol)
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(img), sitk.GetArrayViewFromImage(other)
+    )
+
+
+def write_test_volume(img_path, **kwargs):
+    """write `get_test_volume(**kwargs)` to img_path, creating its directory"""
+    img = get_test_volume(**kwargs)
+    Path(img_path).parent.mkdir(exist_ok=True, parents=True)
+    sitk.WriteImage(img, str(img_path))
+    return img
+
+
+def rewrite(img_path, img):
+    """overwrite img_path with a plain itk write, making it newer than any cache or sidecar of it"""
+    sitk.WriteImage(img, str(img_path))
+    stat = os.stat(img_path)
+    os.utime(img_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
@@ -1,7 +1,7 @@
 from multiprocessing import Pool
 from pathlib import Path
 import numpy as np
-from xrayto3d_preprocess import read_config_and_load_components, get_stem, get_logger, generate_xray, generate_perturbed_xray, ProjectionType, load_centroids
+from xrayto3d_preprocess import read_config_and_load_components, get_stem, get_logger, generate_xray_sweep, ProjectionType, load_centroids
 
 
 def generate_angle_perturbation(subject_id:str):
@@ -37,17 +37,22 @@ def process_subject(subject_id, centroid_path, config, out_path_template, out_xr
 
         logger.debug(out_ct_path)
         
+        views = []
         for ptb_angle in perturbation_angles:
             out_xray_ap_path = generate_perturbation_path('xray_from_ct_angle_perturbation','vert_xray_ap',subject_id, vert_id,ptb_angle,out_xray_path_template, config)
 
             logger.debug(f'xray_ap {out_xray_ap_path}')
             # AP view is generated as is
-            generate_xray(out_ct_path,ProjectionType.AP,None,config['xray_pose'],out_xray_ap_path )
+            views.append((ProjectionType.AP, (0, 0, 0), out_xray_ap_path))
 
             out_xray_lat_path = generate_perturbation_path("xray_from_ct_angle_perturbation","vert_xray_lat",subject_id, vert_id, ptb_angle,out_xray_path_template,config)
             logger.debug(f'xray_lat {out_xray_lat_path}')
             # LAT view is perturbed by various angles
-            generate_perturbed_xray(out_ct_path,ProjectionType.LAT,config['xray_pose'],out_xray_lat_path,ptb_angle)
+            views.append((ProjectionType.LAT, (0, 0, ptb_angle), out_xray_lat_path))
+
+        # each distinct pose is rendered once, the repeated unperturbed AP view is copied
+        # (one CT load for all poses with drr_engine: numpy, one DRRSiddonJacobs call per pose otherwise)
+        generate_xray_sweep(out_ct_path, views, config['xray_pose'])
 
 def generate_path(sub_dir: str, name: str, subject_id, vert_id, output_path_template, config):
     """xray_ap:"{id}_hip-ap.png -> img0001_hip-ap.png"""
@@ -6,7 +6,7 @@ import numpy as np
 import SimpleITK as sitk
 from monai.data import PatchIter, PILWriter
 from monai.transforms import Compose, LoadImage, EnsureType, Resize
-from xrayto3d_preprocess import read_config_and_load_components, get_stem, get_logger, read_image, resample_isotropic
+from xrayto3d_preprocess import read_config_and_load_components, get_stem, get_logger, read_image, sample_region
 
 
 
@@ -41,10 +41,9 @@ def process_total_segmentator_subject_helper(subject_id, config, patch_sz, patch
 
 
     # make patches
-    ## bring to PATCH_RES resolution
-    seg_img = resample_isotropic(seg_img,patch_res,interpolator='linear')
-
-    logger.debug(f'{subject_id} After resampling: size {seg_img.GetSize()} spacing {np.around(seg_img.GetSpacing(),3)}')
+    ## patches are sampled at PATCH_RES resolution directly from the original volume
+    resampled_size = [round(sz * sp / patch_res) for sz, sp in zip(seg_img.GetSize(), seg_img.GetSpacing())]
+    logger.debug(f'{subject_id} After resampling: size {tuple(resampled_size)} spacing {(patch_res,)*seg_img.GetDimension()}')
 
     logger.debug(f'Generating {NUM_PATCH**3} patches with size {patch_sz} and resolution {patch_res}')
 
@@ -53,7 +52,7 @@ def process_total_segmentator_subject_helper(subject_id, config, patch_sz, patch
     
     logger.debug(start_pos_list)
 
-    seg_patches = [extract_roi(seg_img,patch_sz,roi_index,type='seg') for roi_index in start_pos_list]
+    seg_patches = [sample_patch(seg_img,patch_sz,patch_res,roi_index,type='seg') for roi_index in start_pos_list]
     img_transform = Compose([LoadImage(image_only=True, ensure_channel_first=True),EnsureType(),
                     Resize(spatial_size=(int(ORIG_RES_IN_MM/patch_res), int(ORIG_RES_IN_MM/patch_res)),size_mode='all', mode='bilinear', align_corners=True)])
     ap_patches = get_xray_ap_patches(xray_ap_path, img_transform, patch_sz, NUM_PATCH)
@@ -124,11 +123,14 @@ def write_2d_patch(patch, save_to):
     writer.set_data_array(patch)
     writer.write(save_to)
 
-def extract_roi(img, PATCH_SZ, patch_roi_start_index, type='ct') :
+def sample_patch(img, PATCH_SZ, patch_res, patch_roi_start_index, type='ct') :
+    '''patch at patch_roi_start_index of img resampled to patch_res, without resampling the whole img'''
     if type not in ['ct','seg']:
         raise ValueError(f'type should be one of [ct,seg]. got {type}')
 
-    patch_roi = sitk.RegionOfInterest(img, (PATCH_SZ,) * img.GetDimension(), patch_roi_start_index)
+    direction = np.asarray(img.GetDirection()).reshape(img.GetDimension(), img.GetDimension())
+    patch_origin = np.asarray(img.GetOrigin()) + direction @ (np.asarray(patch_roi_start_index) * patch_res)
+    patch_roi = sample_region(img, patch_origin, (PATCH_SZ,) * img.GetDimension(), patch_res, img.GetDirection(), interpolator='linear')
 
     if type == 'ct':
         patch_roi = sitk.Cast(patch_roi,sitk.sitkInt16)
@@ -1,126 +1,138 @@
 """generate x-ray segmentation pair for ctpelvic1k-hip dataset"""
+import sys
 from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
 from xrayto3d_preprocess import (
-    ProjectionType,
-    change_label,
-    extract_bbox,
-    generate_xray,
+    LazySubject,
+    crop_to_labels,
+    extract_masked_rois,
+    generate_biplanar_xray,
+    get_bbox_roi_start,
     get_logger,
     get_orientation_code_itk,
-    get_segmentation_labels,
+    get_output_dtype,
+    get_segmentation_stats,
     get_stem,
-    keep_only_label,
-    mask_ct_with_seg,
-    read_config_and_load_components,
-    read_image,
+    load_config_groups,
+    process_subject_config_groups,
+    relabel,
     reorient_to,
+    volume_cache,
     write_image,
 )
 
+# (out_directories key, filename_convention.output key) of the files written per subject
+OUTPUTS = [
+    ("ct_roi", "ct_roi"),
+    ("seg_roi", "seg_roi"),
+    ("ct_mask_roi", "ct_mask_roi"),
+    ("xray_from_ct", "xray_ap"),
+    ("xray_from_ct", "xray_lat"),
+    ("xray_from_ctmask", "xray_mask_ap"),
+    ("xray_from_ctmask", "xray_mask_lat"),
+]
 
-def process_subject(subject_id, ct_path, seg_path, config, output_path_template):
-    """generate xray and segmentation pairs for corresponding full view ct-seg pair"""
-    ct = read_image(ct_path)
-    seg = read_image(seg_path)
 
-    seg = change_label(
-        seg, {1: 1, 2: 1, 3: 1}
-    )  # combine left and right hip and sacrum into same label
-    seg = keep_only_label(seg, label_id=1)  # remove vertebra
+def extract_rois(subject: LazySubject, config):
+    """ROI stage: ct, seg and masked ct ROIs in the orientation given by config["ROI_properties"]
+    returns None if the scan does not have the required anatomy labels, without reading the ct pixels
+    """
+    ct_header = subject.ct_header
+    seg = subject.seg
 
-    ct_mask = mask_ct_with_seg(ct, seg)
+    logger.debug(
+        f"Image Size {ct_header.GetSize()} Spacing {np.around(ct_header.GetSpacing(),3)}"
+    )
 
-    logger.debug(f"Image Size {ct.GetSize()} Spacing {np.around(ct.GetSpacing(),3)}")
+    # crop to the hip and sacrum labels first, the label ops below only need to see this region
+    seg_crop, crop_start = crop_to_labels(
+        seg, get_segmentation_stats(seg), label_ids=[1, 2, 3]
+    )
+    # some scans may not have required anatomy labels
+    if seg_crop is None:
+        return None
+    # combine left and right hip and sacrum into same label and remove vertebra
+    seg_crop = relabel(seg_crop, mapping={1: 1, 2: 1, 3: 1}, keep=[1])
 
     # extract ROI and orient to particular orientation
     roi_properties = config["ROI_properties"]
-    size = (roi_properties["size"],) * ct.GetDimension()
+    size = (roi_properties["size"],) * ct_header.GetDimension()
 
-    labels = get_segmentation_labels(seg)
-    # some scans may not have required anatomy labels
-    if 1 not in labels:
-        return
-    ct_roi = extract_bbox(
-        ct,
+    roi_start, voxel_size = get_bbox_roi_start(
+        ct_header, seg_crop, label_id=1, physical_size=size
+    )
+    rois = extract_masked_rois(
+        subject.ct,
         seg,
-        label_id=1,
-        physical_size=size,
-        padding_value=roi_properties["ct_padding"],
+        seg_crop,
+        crop_start,
+        roi_start,
+        voxel_size,
+        roi_properties["ct_padding"],
+        roi_properties["seg_padding"],
     )
 
-    if get_orientation_code_itk(ct_roi) != roi_properties["axcode"]:
-        ct_roi = reorient_to(ct_roi, axcodes_to=roi_properties["axcode"])
+    oriented_rois = []
+    for roi in rois:
+        if get_orientation_code_itk(roi) != roi_properties["axcode"]:
+            roi = reorient_to(roi, axcodes_to=roi_properties["axcode"])
+        oriented_rois.append(roi)
+    return oriented_rois
+
+
+def write_outputs(subject_id, rois, config, output_path_template):
+    """output stage: write the ROIs and their xrays at the poses and paths of config"""
+    ct_roi, seg_roi, ct_mask_roi = rois
+
     out_ct_path = generate_path(
         "ct_roi", "ct_roi", subject_id, output_path_template, config
     )
-    write_image(ct_roi, out_ct_path)
-
-    seg_roi = extract_bbox(
-        seg,
-        seg,
-        label_id=1,
-        physical_size=size,
-        padding_value=roi_properties["seg_padding"],
-    )
-    if get_orientation_code_itk(seg_roi) != roi_properties["axcode"]:
-        seg_roi = reorient_to(seg_roi, axcodes_to=roi_properties["axcode"])
+    write_image(ct_roi, out_ct_path, output_dtype=get_output_dtype(config, "ct_roi"))
 
     out_seg_path = generate_path(
         "seg_roi", "seg_roi", subject_id, output_path_template, config
     )
-    write_image(seg_roi, out_seg_path)
+    write_image(seg_roi, out_seg_path, output_dtype=get_output_dtype(config, "seg_roi"))
 
-    ct_mask_roi = extract_bbox(
-        ct_mask,
-        seg,
-        label_id=1,
-        physical_size=size,
-        padding_value=roi_properties["ct_padding"],
-    )
-    if get_orientation_code_itk(ct_mask_roi) != roi_properties["axcode"]:
-        ct_mask_roi = reorient_to(ct_mask_roi, axcodes_to=roi_properties["axcode"])
     out_ct_mask_path = generate_path(
         "ct_mask_roi", "ct_mask_roi", subject_id, output_path_template, config
     )
-    write_image(ct_mask_roi, out_ct_mask_path)
+    write_image(
+        ct_mask_roi, out_ct_mask_path, output_dtype=get_output_dtype(config, "ct_mask_roi")
+    )
 
     out_xray_ap_path = generate_path(
         "xray_from_ct", "xray_ap", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.AP, seg_roi, config["xray_pose"], out_xray_ap_path
-    )
 
     out_xray_lat_path = generate_path(
         "xray_from_ct", "xray_lat", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.LAT, seg_roi, config["xray_pose"], out_xray_lat_path
+    generate_biplanar_xray(
+        out_ct_path,
+        seg_roi,
+        config["xray_pose"],
+        out_xray_ap_path,
+        out_xray_lat_path,
+        input_image=ct_roi,
     )
 
     out_xray_ap_path = generate_path(
         "xray_from_ctmask", "xray_mask_ap", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_mask_path,
-        ProjectionType.AP,
-        seg_roi,
-        config["xray_pose"],
-        out_xray_ap_path,
-    )
 
     out_xray_lat_path = generate_path(
         "xray_from_ctmask", "xray_mask_lat", subject_id, output_path_template, config
     )
-    generate_xray(
+    generate_biplanar_xray(
         out_ct_mask_path,
-        ProjectionType.LAT,
         seg_roi,
         config["xray_pose"],
+        out_xray_ap_path,
         out_xray_lat_path,
+        input_image=ct_mask_roi,
     )
 
 
@@ -145,47 +157,42 @@ def generate_path(sub_dir: str, name: str, subject_id, output_path_template, con
 
 
 def process_totalsegmentor_subject_helper(subject_id: str):
-    """create required subdirs and generate xray-seg pairs"""
+    """create required subdirs and generate xray-seg pairs for every config listing the subject
+    the ROIs are extracted once per group of configs sharing the ROI stage
+    """
     logger.debug(f"{subject_id}")
-    # define paths
-    input_fileformat = config["filename_convention"]["input"]
-
-    subject_basepath = config["subjects"]["subject_basepath"]
-
-    ct_path = Path(subject_basepath) / subject_id / input_fileformat["ct"]
-    seg_path = Path(subject_basepath) / subject_id / input_fileformat["seg"]
-
-    OUT_DIR_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}'
-    OUT_PATH_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}/{{output_name}}'
-
-    create_directories(OUT_DIR_TEMPLATE, config)
-    process_subject(subject_id, ct_path, seg_path, config, OUT_PATH_TEMPLATE)
+    # groups with different ROI stages may read the same segmentation
+    with volume_cache():
+        process_subject_config_groups(subject_id, config_groups, sys.modules[__name__])
 
 
 if __name__ == "__main__":
     import argparse
 
-    import pandas as pd
     from tqdm import tqdm
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("config_file")
+    parser.add_argument(
+        "config_files",
+        nargs="+",
+        help="configs sharing ROI_properties are processed in the same pass",
+    )
     parser.add_argument("--num_workers", default=4, type=int)
 
     args = parser.parse_args()
-    config = read_config_and_load_components(args.config_file)
+    config_groups = load_config_groups(args.config_files, OUTPUTS)
 
     # create logger
-    dataset_name = get_stem(args.config_file)
+    dataset_name = "+".join(get_stem(f) for f in args.config_files)
     logger = get_logger(dataset_name)
 
     logger.debug(f"Generating dataset {dataset_name}")
-    logger.debug(f"Configuration {config}")
+    logger.debug(f"{len(config_groups)} ROI stages for {len(args.config_files)} configs")
 
-    subject_list = (
-        pd.read_csv(config["subjects"]["subject_list"], header=None)
-        .to_numpy()
-        .flatten()
+    subject_list = sorted(
+        set().union(
+            *(subjects for group in config_groups for _, subjects in group)
+        )
     )
 
     logger.debug(f"found {len(subject_list)} subjects")
@@ -199,14 +206,14 @@ if __name__ == "__main__":
         passed to multiprocessing threads for all of them to
         be able to access global configuration
         """
-        global config
-        config = read_config_and_load_components(args.config_file)
+        global config_groups
+        config_groups = load_config_groups(args.config_files, OUTPUTS)
 
     with Pool(
         processes=num_workers, initializer=initialize_config_for_all_workers
     ) as p:
         results = tqdm(
-            p.map(process_totalsegmentor_subject_helper, sorted(subject_list)),
+            p.map(process_totalsegmentor_subject_helper, subject_list),
             total=len(subject_list),
         )
         print("done")
@@ -1,53 +1,83 @@
+import sys
 from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
 from xrayto3d_preprocess import (
-    ProjectionType,
-    generate_xray,
+    LazySubject,
+    generate_biplanar_xray,
     get_logger,
     get_orientation_code_itk,
+    get_output_dtype,
     get_stem,
-    read_config_and_load_components,
-    read_image,
+    load_config_groups,
+    process_subject_config_groups,
     reorient_to,
     write_image,
     get_largest_connected_component,
-    extract_bbox_topleft,
-    mirror_image,
-    mask_ct_with_seg,
+    get_bbox_topleft_roi_start,
+    get_segmentation_stats,
+    crop_to_labels,
+    mirror_crop,
+    extract_masked_rois,
+    volume_cache,
 )
 
-
-def process_subject(subject_id, ct_path, seg_path, config, output_path_template):
-    ct = read_image(ct_path)
-    seg = read_image(seg_path)
-    seg = get_largest_connected_component(
-        seg
-    )  # some of the segmentations have islands in irrelevant places
+# (out_directories key, filename_convention.output key) of the files written per subject
+OUTPUTS = [
+    ("ct_roi", "ct_roi"),
+    ("seg_roi", "seg_roi"),
+    ("ct_mask_roi", "ct_mask_roi"),
+    ("xray_from_ct", "xray_ap"),
+    ("xray_from_ct", "xray_lat"),
+    ("xray_from_ctmask", "xray_mask_ap"),
+    ("xray_from_ctmask", "xray_mask_lat"),
+]
+
+
+def extract_rois(subject: LazySubject, config):
+    """ROI stage: ct, seg and masked ct ROIs in the orientation given by config["ROI_properties"]
+    returns None if the scan does not have a femur, without reading the ct pixels
+    """
+    ct_header = subject.ct_header
+    seg = subject.seg
 
     logger.debug(
-        f" {subject_id} Image Size {ct.GetSize()} Spacing {np.around(ct.GetSpacing(),3)}"
+        f" Image Size {ct_header.GetSize()} Spacing {np.around(ct_header.GetSpacing(),3)}"
     )
 
+    # crop the segmentation to its bounding box first, the full-volume ops below only
+    # need to see the labelled region
+    seg_crop, crop_start = crop_to_labels(seg, get_segmentation_stats(seg))
+    if seg_crop is None:
+        return None
+    seg_crop = get_largest_connected_component(
+        seg_crop
+    )  # some of the segmentations have islands in irrelevant places
+
+    flip_axes = None
     if config["ROI_properties"].is_left == False:
         # flip image
-        ct = mirror_image(ct, flip_axes=2)
-        seg = mirror_image(seg, flip_axes=2)
-
-    ct_mask = mask_ct_with_seg(ct, seg)
+        flip_axes = 2
+        seg_crop, crop_start = mirror_crop(seg_crop, crop_start, seg, flip_axes)
 
     # extract ROI and orient to particular orientation
     roi_properties = config["ROI_properties"]
-    size = (roi_properties["size"],) * ct.GetDimension()
+    size = (roi_properties["size"],) * ct_header.GetDimension()
 
-    ct_roi = extract_bbox_topleft(
-        ct,
+    roi_start, voxel_size = get_bbox_topleft_roi_start(
+        ct_header, seg_crop, label_id=1, physical_size=size, verbose=False
+    )
+    ct_roi, seg_roi, ct_mask_roi = extract_masked_rois(
+        subject.ct,
         seg,
-        label_id=1,
-        physical_size=size,
-        padding_value=roi_properties["ct_padding"],
-        verbose=False,
+        seg_crop,
+        crop_start,
+        roi_start,
+        voxel_size,
+        roi_properties["ct_padding"],
+        roi_properties["seg_padding"],
+        flip_axes=flip_axes,
     )
 
     logger.debug(
@@ -57,80 +87,69 @@ def process_subject(subject_id, ct_path, seg_path, config, output_path_template)
     if get_orientation_code_itk(ct_roi) != roi_properties["axcode"]:
         ct_roi = reorient_to(ct_roi, axcodes_to=roi_properties["axcode"])
 
-    seg_roi = extract_bbox_topleft(
-        seg,
-        seg,
-        label_id=1,
-        physical_size=size,
-        padding_value=roi_properties["seg_padding"],
-        verbose=False,
-    )
     if get_orientation_code_itk(seg_roi) != roi_properties["axcode"]:
         seg_roi = reorient_to(seg_roi, axcodes_to=roi_properties["axcode"])
     logger.debug(
         f" Seg ROI {seg_roi.GetSize()} Spacing {np.around(seg_roi.GetSpacing(),3)}"
     )
 
+    if get_orientation_code_itk(ct_mask_roi) != roi_properties["axcode"]:
+        ct_mask_roi = reorient_to(ct_mask_roi, axcodes_to=roi_properties["axcode"])
+    return ct_roi, seg_roi, ct_mask_roi
+
+
+def write_outputs(subject_id, rois, config, output_path_template):
+    """output stage: write the ROIs and their xrays at the poses and paths of config"""
+    ct_roi, seg_roi, ct_mask_roi = rois
+
     out_ct_path = generate_path(
         "ct_roi", "ct_roi", subject_id, output_path_template, config
     )
     logger.debug(f"writing ct roi to {out_ct_path}")
-    write_image(ct_roi, out_ct_path)
+    write_image(ct_roi, out_ct_path, output_dtype=get_output_dtype(config, "ct_roi"))
 
     out_seg_path = generate_path(
         "seg_roi", "seg_roi", subject_id, output_path_template, config
     )
-    write_image(seg_roi, out_seg_path)
+    write_image(seg_roi, out_seg_path, output_dtype=get_output_dtype(config, "seg_roi"))
 
-    ct_mask_roi = extract_bbox_topleft(
-        ct_mask,
-        seg,
-        label_id=1,
-        physical_size=size,
-        padding_value=roi_properties["ct_padding"],
-        verbose=False,
-    )
-    if get_orientation_code_itk(ct_mask_roi) != roi_properties["axcode"]:
-        ct_mask_roi = reorient_to(ct_mask_roi, axcodes_to=roi_properties["axcode"])
     out_ct_mask_path = generate_path(
         "ct_mask_roi", "ct_mask_roi", subject_id, output_path_template, config
     )
-    write_image(ct_mask_roi, out_ct_mask_path)
+    write_image(
+        ct_mask_roi, out_ct_mask_path, output_dtype=get_output_dtype(config, "ct_mask_roi")
+    )
 
     out_xray_ap_path = generate_path(
         "xray_from_ct", "xray_ap", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.AP, seg_roi, config["xray_pose"], out_xray_ap_path
-    )
 
     out_xray_lat_path = generate_path(
         "xray_from_ct", "xray_lat", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.LAT, seg_roi, config["xray_pose"], out_xray_lat_path
+    generate_biplanar_xray(
+        out_ct_path,
+        seg_roi,
+        config["xray_pose"],
+        out_xray_ap_path,
+        out_xray_lat_path,
+        input_image=ct_roi,
     )
 
     out_xray_ap_path = generate_path(
         "xray_from_ctmask", "xray_mask_ap", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_mask_path,
-        ProjectionType.AP,
-        seg_roi,
-        config["xray_pose"],
-        out_xray_ap_path,
-    )
 
     out_xray_lat_path = generate_path(
         "xray_from_ctmask", "xray_mask_lat", subject_id, output_path_template, config
     )
-    generate_xray(
+    generate_biplanar_xray(
         out_ct_mask_path,
-        ProjectionType.LAT,
         seg_roi,
         config["xray_pose"],
+        out_xray_ap_path,
         out_xray_lat_path,
+        input_image=ct_mask_roi,
     )
 
 
@@ -141,23 +160,6 @@ def create_directories(out_path_template, config):
         )
 
 
-def process_total_segmentor_subject_helper(subject_id: str, verbose=False):
-    # define paths
-    input_fileformat = config["filename_convention"]["input"]
-
-    subject_basepath = config["subjects"]["subject_basepath"]
-
-    ct_path = Path(subject_basepath) / subject_id / input_fileformat["ct"]
-    seg_path = Path(subject_basepath) / subject_id / input_fileformat["seg"]
-
-    logger.debug(f"reading ct and seg from {ct_path} {seg_path}")
-    OUT_DIR_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}'
-    OUT_PATH_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}/{{output_name}}'
-
-    create_directories(OUT_DIR_TEMPLATE, config)
-    process_subject(subject_id, ct_path, seg_path, config, OUT_PATH_TEMPLATE)
-
-
 def generate_path(sub_dir: str, name: str, subject_id, output_path_template, config):
     output_fileformat = config["filename_convention"]["output"]
     out_dirs = config["out_directories"]
@@ -168,30 +170,42 @@ def generate_path(sub_dir: str, name: str, subject_id, output_path_template, con
     return out_path
 
 
+def process_total_segmentor_subject_helper(subject_id: str):
+    """create required subdirs and generate xray-seg pairs for every config listing the subject
+    the ROIs are extracted once per group of configs sharing the ROI stage
+    """
+    logger.debug(f"{subject_id}")
+    with volume_cache():
+        process_subject_config_groups(subject_id, config_groups, sys.modules[__name__])
+
+
 if __name__ == "__main__":
     import argparse
 
-    import pandas as pd
     from tqdm import tqdm
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("config_file")
+    parser.add_argument(
+        "config_files",
+        nargs="+",
+        help="configs sharing ROI_properties are processed in the same pass",
+    )
     parser.add_argument("--num_workers", default=4, type=int)
 
     args = parser.parse_args()
-    config = read_config_and_load_components(args.config_file)
+    config_groups = load_config_groups(args.config_files, OUTPUTS)
 
     # create logger
-    dataset_name = get_stem(args.config_file)
+    dataset_name = "+".join(get_stem(f) for f in args.config_files)
     logger = get_logger(dataset_name)
 
     logger.debug(f"Generating dataset {dataset_name}")
-    logger.debug(f"Configuration {config}")
+    logger.debug(f"{len(config_groups)} ROI stages for {len(args.config_files)} configs")
 
-    subject_list = (
-        pd.read_csv(config["subjects"]["subject_list"], header=None)
-        .to_numpy()
-        .flatten()
+    subject_list = sorted(
+        set().union(
+            *(subjects for group in config_groups for _, subjects in group)
+        )
     )
 
     logger.debug(f"found {len(subject_list)} subjects")
@@ -200,13 +214,14 @@ if __name__ == "__main__":
     num_workers = args.num_workers
 
     def initialize_config_for_all_workers():
-        global config
-        config = read_config_and_load_components(args.config_file)
+        global config_groups
+        config_groups = load_config_groups(args.config_files, OUTPUTS)
 
     with Pool(
         processes=num_workers, initializer=initialize_config_for_all_workers
     ) as p:
         results = tqdm(
-            p.map(process_total_segmentor_subject_helper, sorted(subject_list))
+            p.map(process_total_segmentor_subject_helper, subject_list),
+            total=len(subject_list),
         )
         print("done")
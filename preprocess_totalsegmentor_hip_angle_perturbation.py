@@ -4,18 +4,19 @@ from pathlib import Path
 
 import numpy as np
 from xrayto3d_preprocess import (
+    LazySubject,
     ProjectionType,
     extract_bbox,
     generate_xray,
     get_logger,
     get_orientation_code_itk,
+    get_output_dtype,
     get_stem,
     read_config_and_load_components,
-    get_segmentation_labels,
-    read_image,
+    get_segmentation_index,
     reorient_to,
     write_image,
-    generate_perturbed_xray,
+    generate_xray_sweep,
 )
 
 
@@ -27,22 +28,27 @@ def process_subject(
     output_path_template,
     output_perturbation_angle_path_template,
 ):
-    ct = read_image(ct_path)
-    seg = read_image(seg_path)
+    # the ct pixels are read only if the scan has the required anatomy labels
+    subject = LazySubject(ct_path, seg_path)
+    ct_header = subject.ct_header
+    seg = subject.seg
 
-    logger.debug(f"Image Size {ct.GetSize()} Spacing {np.around(ct.GetSpacing(),3)}")
+    logger.debug(
+        f"Image Size {ct_header.GetSize()} Spacing {np.around(ct_header.GetSpacing(),3)}"
+    )
 
     # extract ROI and orient to particular orientation
     roi_properties = config["ROI_properties"]
-    size = (roi_properties["size"],) * ct.GetDimension()
+    size = (roi_properties["size"],) * ct_header.GetDimension()
 
-    labels = get_segmentation_labels(seg)
+    # label statistics are computed once and shared by the ROI helpers below
+    seg_index = get_segmentation_index(seg)
     # some scans may not have required anatomy labels
-    if 1 not in labels:
+    if not seg_index.HasLabel(1):
         return
     ct_roi = extract_bbox(
-        ct,
-        seg,
+        subject.ct,
+        seg_index,
         label_id=1,
         physical_size=size,
         padding_value=roi_properties["ct_padding"],
@@ -53,11 +59,11 @@ def process_subject(
     out_ct_path = generate_path(
         "ct_roi", "ct_roi", subject_id, output_path_template, config
     )
-    write_image(ct_roi, out_ct_path)
+    write_image(ct_roi, out_ct_path, output_dtype=get_output_dtype(config, "ct_roi"))
 
     seg_roi = extract_bbox(
         seg,
-        seg,
+        seg_index,
         label_id=1,
         physical_size=size,
         padding_value=roi_properties["seg_padding"],
@@ -68,21 +74,36 @@ def process_subject(
     out_seg_path = generate_path(
         "seg_roi", "seg_roi", subject_id, output_path_template, config
     )
-    write_image(seg_roi, out_seg_path)
+    write_image(seg_roi, out_seg_path, output_dtype=get_output_dtype(config, "seg_roi"))
 
     out_xray_ap_path = generate_path(
         "xray_from_ct", "xray_ap", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.AP, seg_roi, config["xray_pose"], out_xray_ap_path
-    )
-
     out_xray_lat_path = generate_path(
         "xray_from_ct", "xray_lat", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.LAT, seg_roi, config["xray_pose"], out_xray_lat_path
-    )
+    views = []
+    if config["xray_pose"]["drr_from_mask"]:
+        generate_xray(
+            out_ct_path,
+            ProjectionType.AP,
+            seg_roi,
+            config["xray_pose"],
+            out_xray_ap_path,
+            input_image=ct_roi,
+        )
+        generate_xray(
+            out_ct_path,
+            ProjectionType.LAT,
+            seg_roi,
+            config["xray_pose"],
+            out_xray_lat_path,
+            input_image=ct_roi,
+        )
+    else:
+        views.append((ProjectionType.AP, (0, 0, 0), out_xray_ap_path))
+        views.append((ProjectionType.LAT, (0, 0, 0), out_xray_lat_path))
+
     for angle in config["xray_pose"]["perturbation_angle"]:
         out_xray_lat_path = generate_perturbation_angle_path(
             "xray_from_ct_angle_perturbation",
@@ -92,13 +113,10 @@ def process_subject(
             output_perturbation_angle_path_template,
             config,
         )
-        generate_perturbed_xray(
-            out_ct_path,
-            ProjectionType.LAT,
-            config["xray_pose"],
-            out_xray_lat_path,
-            angle,
-        )
+        views.append((ProjectionType.LAT, (0, 0, angle), out_xray_lat_path))
+
+    # the unperturbed and all perturbed views are rendered in one pass over ct_roi
+    generate_xray_sweep(out_ct_path, views, config["xray_pose"], input_image=ct_roi)
 
 
 def create_directories(out_path_template, config):
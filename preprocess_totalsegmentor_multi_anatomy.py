@@ -0,0 +1,162 @@
+"""generate x-ray segmentation pairs of several TotalSegmentator anatomies in one pass,
+the CT of every subject is read only once and shared by all anatomies
+
+usage:
+    python preprocess_totalsegmentor_multi_anatomy.py \
+        femur:configs/full/TotalSegmentor-femur-left-DRR-30k.yaml \
+        femur:configs/full/TotalSegmentor-femur-right-DRR-30k.yaml \
+        hip:configs/full/TotalSegmentor-hips-DRR-full.yaml \
+        ribs:configs/full/TotalSegmentor-ribs-DRR-full.yaml
+"""
+import importlib
+from multiprocessing import Pool
+
+from xrayto3d_preprocess import (
+    check_distinct_outputs,
+    enable_parallel_gzip,
+    get_logger,
+    get_stem,
+    load_config_groups,
+    process_subject_config_groups,
+    volume_cache,
+)
+
+# anatomy -> script providing the ROI and output stages of that anatomy
+ANATOMY_SCRIPTS = {
+    "femur": "preprocess_totalsegmentor_femur",
+    "hip": "preprocess_totalsegmentor_hip",
+    "ribs": "preprocess_totalsegmentor_ribs",
+}
+
+
+def parse_anatomy_spec(spec: str):
+    """'femur:configs/full/TotalSegmentor-femur-left-DRR-30k.yaml' -> (femur, config path)"""
+    anatomy, config_file = spec.split(":", 1)
+    if anatomy not in ANATOMY_SCRIPTS:
+        raise ValueError(
+            f"unknown anatomy {anatomy}, expected one of {list(ANATOMY_SCRIPTS)}"
+        )
+    return anatomy, config_file
+
+
+def get_anatomy_script(anatomy: str):
+    """script module providing the ROI and output stages of the anatomy"""
+    return importlib.import_module(ANATOMY_SCRIPTS[anatomy])
+
+
+def load_anatomy_specs(specs):
+    """config groups (see `load_config_groups`) and logger of each anatomy. Configs of an anatomy sharing the ROI stage are grouped, their ROIs are extracted once.
+    raises a ValueError if two specs would write the same files
+    """
+    config_files = {}  # anatomy -> config files, in the order of the specs
+    for spec in specs:
+        anatomy, config_file = parse_anatomy_spec(spec)
+        config_files.setdefault(anatomy, []).append(config_file)
+
+    anatomy_specs = []
+    for anatomy, files in config_files.items():
+        anatomy_specs.append(
+            {
+                "anatomy": anatomy,
+                "config_groups": load_config_groups(files, get_anatomy_script(anatomy).OUTPUTS),
+                "logger": get_logger("+".join(get_stem(f) for f in files)),
+            }
+        )
+
+    # configs of one anatomy are checked by load_config_groups, check across anatomies
+    configs, subject_sets, outputs, config_names = [], [], [], []
+    for spec in anatomy_specs:
+        for config_group in spec["config_groups"]:
+            for config, subjects in config_group:
+                configs.append(config)
+                subject_sets.append(subjects)
+                outputs.append(get_anatomy_script(spec["anatomy"]).OUTPUTS)
+                config_names.append(f"{spec['anatomy']} config")
+    check_distinct_outputs(configs, subject_sets, outputs, config_names)
+    return anatomy_specs
+
+
+def get_subjects(anatomy_specs):
+    """subjects listed by any config"""
+    return sorted(
+        set().union(
+            *(
+                subjects
+                for spec in anatomy_specs
+                for config_group in spec["config_groups"]
+                for _, subjects in config_group
+            )
+        )
+    )
+
+
+def process_subject(subject_id, anatomy_specs):
+    """run every anatomy that lists this subject on a single in-memory copy of its CT
+    the CT is read when the first anatomy produces a ROI, not at all if every anatomy skips the subject
+    """
+    lazy_cts = {}  # scans are shared by path, configs may point to different CT files
+    for spec in anatomy_specs:
+        script = get_anatomy_script(spec["anatomy"])
+        script.logger = spec["logger"]
+        script.logger.debug(f"{subject_id} {spec['anatomy']}")
+        process_subject_config_groups(
+            subject_id, spec["config_groups"], script, lazy_cts=lazy_cts
+        )
+
+
+# set in every worker by `initialize_workers`
+worker_anatomy_specs = []
+
+
+def initialize_workers(anatomy_specs, gzip_threads=0):
+    """the workers receive the specs loaded by the parent, reloading them would call `get_logger` again,
+    which truncates the log files and adds a second handler to every logger
+    """
+    global worker_anatomy_specs
+    worker_anatomy_specs = anatomy_specs
+    if gzip_threads > 0:
+        enable_parallel_gzip(num_workers=gzip_threads)
+
+
+def process_subject_helper(subject_id):
+    # anatomies reading the same segmentation read it once
+    with volume_cache():
+        process_subject(subject_id, worker_anatomy_specs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from tqdm import tqdm
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "anatomy_specs",
+        nargs="+",
+        help=f"anatomy:config_file, anatomy is one of {list(ANATOMY_SCRIPTS)}",
+    )
+    parser.add_argument("--num_workers", default=4, type=int)
+    parser.add_argument(
+        "--gzip_threads",
+        default=0,
+        type=int,
+        help="compress .nii.gz outputs in blocks on this many threads per worker (0: itk default)",
+    )
+
+    args = parser.parse_args()
+    anatomy_specs = load_anatomy_specs(args.anatomy_specs)
+
+    subject_list = get_subjects(anatomy_specs)
+    print(f"found {len(subject_list)} subjects")
+
+    with Pool(
+        processes=args.num_workers,
+        initializer=initialize_workers,
+        initargs=(anatomy_specs, args.gzip_threads),
+    ) as p:
+        results = tqdm(
+            p.imap_unordered(process_subject_helper, subject_list),
+            total=len(subject_list),
+        )
+        list(results)
+        print("done")
@@ -1,25 +1,37 @@
 import os
+import sys
 from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
 from xrayto3d_preprocess import (
-    ProjectionType,
+    LazySubject,
     extract_bbox,
-    generate_xray,
+    generate_biplanar_xray,
     get_logger,
     get_orientation_code_itk,
+    get_output_dtype,
     get_stem,
-    read_config_and_load_components,
-    read_image,
+    load_config_groups,
+    process_subject_config_groups,
     reorient_to,
+    volume_cache,
     write_image,
 )
 
+# (out_directories key, filename_convention.output key) of the files written per subject
+OUTPUTS = [
+    ("ct_roi", "ct_roi"),
+    ("seg_roi", "seg_roi"),
+    ("xray_from_ct", "xray_ap"),
+    ("xray_from_ct", "xray_lat"),
+]
 
-def process_subject(subject_id, ct_path, seg_path, config, output_path_template):
-    ct = read_image(ct_path)
-    seg = read_image(seg_path)
+
+def extract_rois(subject: LazySubject, config):
+    """ROI stage: ct and seg ROIs in the orientation given by config["ROI_properties"]"""
+    ct = subject.ct
+    seg = subject.seg
 
     logger.debug(f"Image Size {ct.GetSize()} Spacing {np.around(ct.GetSpacing(),3)}")
 
@@ -36,10 +48,6 @@ def process_subject(subject_id, ct_path, seg_path, config, output_path_template)
 
     if get_orientation_code_itk(ct_roi) != roi_properties["axcode"]:
         ct_roi = reorient_to(ct_roi, axcodes_to=roi_properties["axcode"])
-    out_ct_path = generate_path(
-        "ct", "ct_roi", subject_id, output_path_template, config
-    )
-    write_image(ct_roi, out_ct_path)
 
     seg_roi = extract_bbox(
         seg,
@@ -50,24 +58,37 @@ def process_subject(subject_id, ct_path, seg_path, config, output_path_template)
     )
     if get_orientation_code_itk(seg_roi) != roi_properties["axcode"]:
         seg_roi = reorient_to(seg_roi, axcodes_to=roi_properties["axcode"])
+    return ct_roi, seg_roi
+
+
+def write_outputs(subject_id, rois, config, output_path_template):
+    """output stage: write the ROIs and their xrays at the poses and paths of config"""
+    ct_roi, seg_roi = rois
+
+    out_ct_path = generate_path(
+        "ct_roi", "ct_roi", subject_id, output_path_template, config
+    )
+    write_image(ct_roi, out_ct_path, output_dtype=get_output_dtype(config, "ct_roi"))
 
     out_seg_path = generate_path(
-        "seg", "seg_roi", subject_id, output_path_template, config
+        "seg_roi", "seg_roi", subject_id, output_path_template, config
     )
-    write_image(seg_roi, out_seg_path)
+    write_image(seg_roi, out_seg_path, output_dtype=get_output_dtype(config, "seg_roi"))
 
     out_xray_ap_path = generate_path(
         "xray_from_ct", "xray_ap", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.AP, seg_roi, config["xray_pose"], out_xray_ap_path
-    )
 
     out_xray_lat_path = generate_path(
         "xray_from_ct", "xray_lat", subject_id, output_path_template, config
     )
-    generate_xray(
-        out_ct_path, ProjectionType.LAT, seg_roi, config["xray_pose"], out_xray_lat_path
+    generate_biplanar_xray(
+        out_ct_path,
+        seg_roi,
+        config["xray_pose"],
+        out_xray_ap_path,
+        out_xray_lat_path,
+        input_image=ct_roi,
     )
 
 
@@ -89,44 +110,39 @@ def generate_path(sub_dir: str, name: str, subject_id, output_path_template, con
 
 
 def process_totalsegmentor_subject_helper(subject_id: str):
-    # define paths
-    input_fileformat = config["filename_convention"]["input"]
-
-    subject_basepath = config["subjects"]["subject_basepath"]
-
-    ct_path = Path(subject_basepath) / subject_id / input_fileformat["ct"]
-    seg_path = Path(subject_basepath) / subject_id / input_fileformat["seg"]
-
-    OUT_DIR_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}'
-    OUT_PATH_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}/{{output_name}}'
-
-    create_directories(OUT_DIR_TEMPLATE, config)
-    process_subject(subject_id, ct_path, seg_path, config, OUT_PATH_TEMPLATE)
+    """create required subdirs and generate xray-seg pairs for every config listing the subject
+    the ROIs are extracted once per group of configs sharing the ROI stage
+    """
+    with volume_cache():
+        process_subject_config_groups(subject_id, config_groups, sys.modules[__name__])
 
 
 if __name__ == "__main__":
     import argparse
 
-    import pandas as pd
     from tqdm import tqdm
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("config_file")
+    parser.add_argument(
+        "config_files",
+        nargs="+",
+        help="configs sharing ROI_properties are processed in the same pass",
+    )
 
     args = parser.parse_args()
-    config = read_config_and_load_components(args.config_file)
+    config_groups = load_config_groups(args.config_files, OUTPUTS)
 
     # create logger
-    dataset_name = get_stem(args.config_file)
+    dataset_name = "+".join(get_stem(f) for f in args.config_files)
     logger = get_logger(dataset_name)
 
     logger.debug(f"Generating dataset {dataset_name}")
-    logger.debug(f"Configuration {config}")
+    logger.debug(f"{len(config_groups)} ROI stages for {len(args.config_files)} configs")
 
-    subject_list = (
-        pd.read_csv(config["subjects"]["subject_list"], header=None)
-        .to_numpy()
-        .flatten()
+    subject_list = sorted(
+        set().union(
+            *(subjects for group in config_groups for _, subjects in group)
+        )
     )
 
     logger.debug(f"found {len(subject_list)} subjects")
@@ -135,14 +151,14 @@ if __name__ == "__main__":
     num_workers = os.cpu_count()
 
     def initialize_config_for_all_workers():
-        global config
-        config = read_config_and_load_components(args.config_file)
+        global config_groups
+        config_groups = load_config_groups(args.config_files, OUTPUTS)
 
     with Pool(
         processes=num_workers, initializer=initialize_config_for_all_workers
     ) as p:
         results = tqdm(
-            p.map(process_totalsegmentor_subject_helper, sorted(subject_list)),
+            p.map(process_totalsegmentor_subject_helper, subject_list),
             total=len(subject_list),
         )
         print("done")
@@ -2,20 +2,21 @@
 import os
 from multiprocessing import Pool
 import numpy as np
-import SimpleITK as sitk
 from xrayto3d_preprocess import (
-    ImageType,
-    ProjectionType,
-    extract_vertebra_around_vbcentroid,
-    generate_xray,
+    extract_vertebrae_around_vbcentroids,
+    generate_biplanar_landmark_xray,
+    generate_biplanar_xray,
     get_logger,
+    get_output_dtype,
     get_stem,
     load_centroids,
     read_config_and_load_components,
     read_image,
+    render_centroid_heatmap,
     save_overlays,
     spatialnet_reorient,
     write_image,
+    write_landmark,
 )
 
 
@@ -38,36 +39,64 @@ def process_subject(
         f"Image Size {ct_img.GetSize()} Spacing {np.around(ct_img.GetSpacing(),3)}"
     )
 
+    vb_ids, vb_centroids = [], []
     for vb_id, *ctd in centroids:
-        logger.debug(f"Vertebra {vb_id}")
-
         if dataset_name == "lidc":
             ctd_physical = spatialnet_reorient(seg_img, ctd)
             ctd = seg_img.TransformPhysicalPointToIndex(ctd_physical)
+        vb_ids.append(vb_id)
+        vb_centroids.append(ctd)
+
+    # extract ROI of every vertebra and orient to particular orientation
+    vertebra_rois = extract_vertebrae_around_vbcentroids(
+        config["ROI_properties"],
+        ct_img,
+        seg_img,
+        vb_ids,
+        vb_centroids,
+        mask_ct=config["ROI_properties"]["drr_from_ct_mask"],
+    )
+
+    for vb_id, (ct_roi, seg_roi, centroid_landmark) in zip(vb_ids, vertebra_rois):
+        logger.debug(f"Vertebra {vb_id}")
 
-        # extract ROI and orient to particular orientation
-        seg_roi, _ = extract_vertebra_around_vbcentroid(
-            config["ROI_properties"], seg_img, vb_id, ctd, ImageType.SEGMENTATION
-        )
         out_seg_path = generate_path(
             "seg_roi", "vert_seg", vb_id, subject_id, output_path_template, config
         )
-        write_image(seg_roi, out_seg_path)
-
-        ct_roi, centroid_heatmap = extract_vertebra_around_vbcentroid(
-            config["ROI_properties"], ct_img, vb_id, ctd, ImageType.IMAGE
+        write_image(
+            seg_roi, out_seg_path, output_dtype=get_output_dtype(config, "vert_seg")
         )
-        if config["ROI_properties"]["drr_from_ct_mask"]:
-            ct_roi = sitk.Mask(ct_roi, seg_roi > 0.5)
+
         out_ct_path = generate_path(
             "ct_roi", "vert_ct", vb_id, subject_id, output_path_template, config
         )
-        write_image(ct_roi, out_ct_path)
+        write_image(
+            ct_roi, out_ct_path, output_dtype=get_output_dtype(config, "vert_ct")
+        )
 
-        out_centroid_path = generate_path(
-            "centroid", "vert_centroid", vb_id, subject_id, output_path_template, config
+        out_landmark_path = generate_path(
+            "centroid",
+            "vert_centroid_landmark",
+            vb_id,
+            subject_id,
+            output_path_template,
+            config,
         )
-        write_image(centroid_heatmap, out_centroid_path)
+        write_landmark(centroid_landmark, out_landmark_path)
+        if config["ROI_properties"].get("write_centroid_heatmap", False):
+            out_centroid_path = generate_path(
+                "centroid",
+                "vert_centroid",
+                vb_id,
+                subject_id,
+                output_path_template,
+                config,
+            )
+            write_image(
+                render_centroid_heatmap(centroid_landmark, ct_roi),
+                out_centroid_path,
+                output_dtype=get_output_dtype(config, "vert_centroid"),
+            )
 
         if config["ROI_properties"]["drr_from_ct_mask"]:
             out_dir = "xray_from_ctmask"
@@ -78,23 +107,17 @@ def process_subject(
         out_xray_ap_path = generate_path(
             out_dir, "vert_xray_ap", vb_id, subject_id, output_path_template, config
         )
-        generate_xray(
-            out_ct_path,
-            ProjectionType.AP,
-            seg_roi,
-            config["xray_pose"],
-            out_xray_ap_path,
-        )
 
         out_xray_lat_path = generate_path(
             out_dir, "vert_xray_lat", vb_id, subject_id, output_path_template, config
         )
-        generate_xray(
+        generate_biplanar_xray(
             out_ct_path,
-            ProjectionType.LAT,
             seg_roi,
             config["xray_pose"],
+            out_xray_ap_path,
             out_xray_lat_path,
+            input_image=ct_roi,
         )
 
         out_ctd_xray_ap_path = generate_path(
@@ -105,13 +128,6 @@ def process_subject(
             output_path_template,
             config,
         )
-        generate_xray(
-            out_centroid_path,
-            ProjectionType.AP,
-            centroid_heatmap,
-            config["xray_pose"],
-            out_ctd_xray_ap_path,
-        )
 
         out_ctd_xray_lat_path = generate_path(
             out_dir,
@@ -121,11 +137,11 @@ def process_subject(
             output_path_template,
             config,
         )
-        generate_xray(
-            out_centroid_path,
-            ProjectionType.LAT,
-            centroid_heatmap,
+        generate_biplanar_landmark_xray(
+            centroid_landmark,
+            ct_roi,
             config["xray_pose"],
+            out_ctd_xray_ap_path,
             out_ctd_xray_lat_path,
         )
 
@@ -4,80 +4,140 @@ from pathlib import Path
 
 import numpy as np
 from xrayto3d_preprocess import (
-    ImageType,
-    ProjectionType,
-    extract_vertebra_around_vbcentroid,
-    generate_xray,
-    get_largest_connected_component,
+    LazySubject,
+    extract_vertebra_pair_around_vbcentroid,
+    generate_biplanar_landmark_xray,
+    generate_biplanar_xray,
+    get_largest_connected_components,
     get_orientation_code_itk,
+    get_output_dtype,
     get_segmentation_labels,
     get_segmentation_stats,
-    keep_only_label,
     read_config_and_load_components,
-    read_image,
+    render_centroid_heatmap,
     reorient_to,
+    sample_region,
     save_overlays,
     write_image,
+    write_landmark,
     get_stem,
     get_logger,
 )
 
 
 def process_subject(subject_id, ct_path, seg_path, config, output_path_template):
-    # read inputs
-    ct = read_image(ct_path)
-    seg = read_image(seg_path)
+    # read inputs, the ct pixels are read only if some vertebra is fully inside the scan
+    subject = LazySubject(ct_path, seg_path)
+    ct_header = subject.ct_header
+    seg = subject.seg
 
-    logger.debug(f"Image Size {ct.GetSize()} Spacing {np.around(ct.GetSpacing(),3)}")
+    logger.debug(
+        f"Image Size {ct_header.GetSize()} Spacing {np.around(ct_header.GetSpacing(),3)}"
+    )
 
     # extract ROI and orient to particular orientation
     roi_properties = config["ROI_properties"]
-    size = (roi_properties["size"],) * ct.GetDimension()
-
-    if get_orientation_code_itk(ct) != roi_properties["axcode"]:
-        ct = reorient_to(ct, axcodes_to=roi_properties["axcode"])
+    size = (roi_properties["size"],) * ct_header.GetDimension()
 
     if get_orientation_code_itk(seg) != roi_properties["axcode"]:
         seg = reorient_to(seg, axcodes_to=roi_properties["axcode"])
 
     stats = get_segmentation_stats(seg)
 
-    vb_labels = get_segmentation_labels(seg)
-    for vb_id in vb_labels:
+    vb_labels = []
+    for vb_id in get_segmentation_labels(seg):
         logger.debug(f"Vertebra {vb_id}")
         if stats.GetNumberOfPixelsOnBorder(vb_id) > 0:
             logger.debug(
                 f"{vb_id} Pixels on border {stats.GetNumberOfPixelsOnBorder(vb_id)}"
             )
             continue
+        vb_labels.append(vb_id)
+    if not vb_labels:
+        return
+
+    ct = subject.ct
+    if get_orientation_code_itk(ct) != roi_properties["axcode"]:
+        ct = reorient_to(ct, axcodes_to=roi_properties["axcode"])
+
+    rois = {}
+    for vb_id in vb_labels:
         # extract ROI and orient to particular orientation
         # ct_roi = extract_bbox(ct,seg,vb_id,physical_size=size,padding_value=roi_properties['ct_padding'])
         centroid_index = ct.TransformPhysicalPointToIndex(stats.GetCentroid(vb_id))
         logger.debug(f'Extraction ratio {config["ROI_properties"]["extraction_ratio"]}')
-        ct_roi, centroid_heatmap = extract_vertebra_around_vbcentroid(
-            config["ROI_properties"], ct, vb_id, centroid_index, ImageType.IMAGE
+        rois[vb_id] = extract_vertebra_pair_around_vbcentroid(
+            config["ROI_properties"], ct, seg, vb_id, centroid_index
         )
+
+    # some of the segmentations have islands in irrelevant places, keep the largest component
+    # of each vertebra inside its ROI. The seg is already in the ROI orientation, the ROIs are on its grid
+    vb_masks, removed_voxels = get_largest_connected_components(
+        seg,
+        stats,
+        label_ids=vb_labels,
+        regions={
+            vb_id: (seg.TransformPhysicalPointToIndex(seg_roi.GetOrigin()), seg_roi.GetSize())
+            for vb_id, (_, seg_roi, _) in rois.items()
+        },
+    )
+    for vb_id in vb_labels:
+        ct_roi, seg_roi, centroid_landmark = rois.pop(vb_id)
         out_ct_path = generate_path(
             "ct_roi", "vert_ct", vb_id, subject_id, output_path_template, config
         )
-        write_image(ct_roi, out_ct_path)
+        write_image(
+            ct_roi, out_ct_path, output_dtype=get_output_dtype(config, "vert_ct")
+        )
 
         # seg_roi = extract_bbox(seg,seg,vb_id,physical_size=size,padding_value=roi_properties['seg_padding'])
-        seg_roi, _ = extract_vertebra_around_vbcentroid(
-            config["ROI_properties"], seg, vb_id, centroid_index, ImageType.SEGMENTATION
-        )
-        seg_roi = keep_only_label(seg_roi, vb_id)
-        seg_roi = get_largest_connected_component(seg_roi)
+        if vb_id in vb_masks:
+            logger.debug(f"{vb_id} removed {removed_voxels[vb_id]} voxels outside of largest component")
+            # the largest component mask covers the bounding box of the vertebra within the ROI,
+            # bring it on the ROI grid
+            largest_component = sample_region(
+                vb_masks[vb_id],
+                seg_roi.GetOrigin(),
+                seg_roi.GetSize(),
+                seg_roi.GetSpacing(),
+                seg_roi.GetDirection(),
+                interpolator="nearest",
+            )
+            seg_roi = (seg_roi == vb_id) & largest_component
+        else:
+            # no voxel of the vertebra inside its ROI
+            seg_roi = seg_roi == vb_id
 
         out_seg_path = generate_path(
             "seg_roi", "vert_seg", vb_id, subject_id, output_path_template, config
         )
-        write_image(seg_roi, out_seg_path)
+        write_image(
+            seg_roi, out_seg_path, output_dtype=get_output_dtype(config, "vert_seg")
+        )
 
-        out_centroid_path = generate_path(
-            "centroid", "vert_centroid", vb_id, subject_id, output_path_template, config
+        out_landmark_path = generate_path(
+            "centroid",
+            "vert_centroid_landmark",
+            vb_id,
+            subject_id,
+            output_path_template,
+            config,
         )
-        write_image(centroid_heatmap, out_centroid_path)
+        write_landmark(centroid_landmark, out_landmark_path)
+        if config["ROI_properties"].get("write_centroid_heatmap", False):
+            out_centroid_path = generate_path(
+                "centroid",
+                "vert_centroid",
+                vb_id,
+                subject_id,
+                output_path_template,
+                config,
+            )
+            write_image(
+                render_centroid_heatmap(centroid_landmark, ct_roi),
+                out_centroid_path,
+                output_dtype=get_output_dtype(config, "vert_centroid"),
+            )
 
         if config["ROI_properties"]["drr_from_ct_mask"]:
             out_dir = "xray_from_ctmask"
@@ -89,23 +149,17 @@ def process_subject(subject_id, ct_path, seg_path, config, output_path_template)
         out_xray_ap_path = generate_path(
             out_dir, "vert_xray_ap", vb_id, subject_id, output_path_template, config
         )
-        generate_xray(
-            out_ct_path,
-            ProjectionType.AP,
-            seg_roi,
-            config["xray_pose"],
-            out_xray_ap_path,
-        )
 
         out_xray_lat_path = generate_path(
             out_dir, "vert_xray_lat", vb_id, subject_id, output_path_template, config
         )
-        generate_xray(
+        generate_biplanar_xray(
             out_ct_path,
-            ProjectionType.LAT,
             seg_roi,
             config["xray_pose"],
+            out_xray_ap_path,
             out_xray_lat_path,
+            input_image=ct_roi,
         )
 
         out_ctd_xray_ap_path = generate_path(
@@ -116,13 +170,6 @@ def process_subject(subject_id, ct_path, seg_path, config, output_path_template)
             output_path_template,
             config,
         )
-        generate_xray(
-            out_centroid_path,
-            ProjectionType.AP,
-            centroid_heatmap,
-            config["xray_pose"],
-            out_ctd_xray_ap_path,
-        )
 
         out_ctd_xray_lat_path = generate_path(
             out_dir,
@@ -132,11 +179,11 @@ def process_subject(subject_id, ct_path, seg_path, config, output_path_template)
             output_path_template,
             config,
         )
-        generate_xray(
-            out_centroid_path,
-            ProjectionType.LAT,
-            centroid_heatmap,
+        generate_biplanar_landmark_xray(
+            centroid_landmark,
+            ct_roi,
             config["xray_pose"],
+            out_ctd_xray_ap_path,
             out_ctd_xray_lat_path,
         )
 
@@ -0,0 +1,97 @@
+import pytest
+from omegaconf import OmegaConf
+
+from xrayto3d_preprocess.config import (
+    check_distinct_outputs,
+    get_output_dtype,
+    get_output_paths,
+    group_configs_by_roi_stage,
+    load_config_groups,
+)
+
+OUTPUTS = [("ct_roi", "ct_roi"), ("xray_from_ct", "xray_ap")]
+
+
+def get_test_config(derivatives="derivatives", xray_rx=-90):
+    return OmegaConf.create(
+        {
+            "subjects": {"subject_basepath": "dataset", "subject_list": "subjects.lst"},
+            "ROI_properties": {"axcode": "PIR", "size": 288},
+            "xray_pose": {"ap": {"rx": xray_rx}},
+            "out_directories": {
+                "derivatives": derivatives,
+                "ct_roi": "ct_roi",
+                "xray_from_ct": "xray_from_ct",
+            },
+            "filename_convention": {
+                "input": {"ct": "ct.nii.gz"},
+                "output": {"ct_roi": "{id}_hip-ct.nii.gz", "xray_ap": "{id}_hip-ap.png"},
+                "output_dtype": {"ct_roi": "int16", "xray_ap": {"dtype": "uint8", "scale": 2}},
+            },
+        }
+    )
+
+
+def test_group_configs_by_roi_stage():
+    configs = [get_test_config(), get_test_config("derivatives_rx", xray_rx=-80)]
+    assert len(group_configs_by_roi_stage(configs)) == 1
+
+
+def test_get_output_paths():
+    assert get_output_paths(get_test_config(), OUTPUTS, "s0001") == [
+        "dataset/s0001/derivatives/ct_roi/s0001_hip-ct.nii.gz",
+        "dataset/s0001/derivatives/xray_from_ct/s0001_hip-ap.png",
+    ]
+
+
+def test_check_distinct_outputs():
+    configs = [get_test_config(), get_test_config(xray_rx=-80)]
+    with pytest.raises(ValueError):
+        check_distinct_outputs(configs, [{"s0001", "s0002"}, {"s0002"}], OUTPUTS)
+    # different subjects or different derivatives do not collide
+    check_distinct_outputs(configs, [{"s0001"}, {"s0002"}], OUTPUTS)
+    configs[1] = get_test_config("derivatives_rx", xray_rx=-80)
+    check_distinct_outputs(configs, [{"s0001"}, {"s0001"}], OUTPUTS)
+
+
+def test_get_output_dtype():
+    config = get_test_config()
+    assert get_output_dtype(config, "ct_roi") == "int16"
+    assert get_output_dtype(config, "xray_ap") == {"dtype": "uint8", "scale": 2}
+    assert get_output_dtype(config, "seg_roi") is None
+
+
+def test_check_distinct_outputs_per_config():
+    # configs of different scripts write different outputs
+    configs = [get_test_config(), get_test_config(xray_rx=-80)]
+    outputs = [[("ct_roi", "ct_roi")], [("xray_from_ct", "xray_ap")]]
+    check_distinct_outputs(configs, [{"s0001"}, {"s0001"}], outputs)
+    outputs[1].append(("ct_roi", "ct_roi"))
+    with pytest.raises(ValueError):
+        check_distinct_outputs(configs, [{"s0001"}, {"s0001"}], outputs)
+
+
+def write_test_config(path, config, subjects):
+    (path.parent / f"{path.stem}.lst").write_text("".join(f"{s}\n" for s in subjects))
+    config.subjects.subject_list = str(path.parent / f"{path.stem}.lst")
+    OmegaConf.save(config, path)
+    return str(path)
+
+
+def test_load_config_groups(tmp_path):
+    config_files = [
+        write_test_config(tmp_path / "a.yaml", get_test_config(), ["s0001", "s0002"]),
+        write_test_config(
+            tmp_path / "b.yaml", get_test_config("derivatives_rx", xray_rx=-80), ["s0002"]
+        ),
+    ]
+    (config_group,) = load_config_groups(config_files, OUTPUTS)
+    assert [subjects for _, subjects in config_group] == [{"s0001", "s0002"}, {"s0002"}]
+    assert config_group[1][0].xray_pose.ap.rx == -80
+
+    # both configs write the same files for s0002
+    config_files[1] = write_test_config(
+        tmp_path / "c.yaml", get_test_config(xray_rx=-80), ["s0002"]
+    )
+    with pytest.raises(ValueError):
+        load_config_groups(config_files, OUTPUTS)
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from xrayto3d_preprocess import drr_utils
+from xrayto3d_preprocess.drr_utils import (
+    build_projection_operator,
+    cast_rays,
+    generate_drr,
+    get_euler_zyx_matrix,
+    get_projection_operator,
+    siddon_jacobs_intersections,
+)
+from xrayto3d_preprocess.enumutils import ProjectionType
+
+# configs/full/xray_pose_conf/PIR_pose.yaml
+PIR_POSE_CONFIG = {
+    "ap": {"rx": -90, "ry": 0, "rz": 90},
+    "lat": {"rx": -90, "ry": 0, "rz": 0},
+    "res": 1.0,
+    "size": 64,
+}
+
+
+def get_chord_length(extent, direction):
+    """length of the chord of a ray through the centre of a box of the given extent"""
+    direction = direction / np.linalg.norm(direction)
+    with np.errstate(divide="ignore"):
+        return np.min(np.asarray(extent) / np.abs(direction))
+
+
+@pytest.mark.parametrize(
+    "volume_size,spacing", [((8, 8, 8), (1.0, 1.0, 1.0)), ((7, 10, 5), (1.5, 0.8, 2.0))]
+)
+def test_intersections_sum_to_chord_length(volume_size, spacing):
+    extent = np.asarray(volume_size) * np.asarray(spacing)
+    centre = extent / 2.0
+    directions = np.concatenate(
+        [np.eye(3), -np.eye(3), np.random.RandomState(0).normal(size=(50, 3))]
+    )
+    for direction in directions:
+        focal_point = centre - 500.0 * direction / np.linalg.norm(direction)
+        ray_ids, voxel_ids, lengths = siddon_jacobs_intersections(
+            volume_size, spacing, focal_point, centre[None, :]
+        )
+        assert np.all(ray_ids == 0)
+        assert np.all((voxel_ids >= 0) & (voxel_ids < np.prod(volume_size)))
+        np.testing.assert_allclose(
+            lengths.sum(), get_chord_length(extent, direction), rtol=1e-9
+        )
+
+
+def test_intersections_along_an_axis():
+    volume_size, spacing = (4, 6, 5), (1.0, 2.0, 0.5)
+    # along +y through voxel column (x=1, z=3)
+    focal_point = np.array([1.5, -100.0, 1.75])
+    _, voxel_ids, lengths = siddon_jacobs_intersections(
+        volume_size, spacing, focal_point, np.array([[1.5, 0.0, 1.75]])
+    )
+    np.testing.assert_allclose(lengths, [2.0] * 6)
+    voxel_arr = np.zeros(volume_size[::-1])
+    voxel_arr.ravel()[voxel_ids] = 1
+    assert voxel_arr[3, :, 1].all() and voxel_arr.sum() == 6
+    # rays that miss the volume have no intersections
+    _, voxel_ids, _ = siddon_jacobs_intersections(
+        volume_size, spacing, focal_point, np.array([[10.0, 0.0, 1.75]])
+    )
+    assert len(voxel_ids) == 0
+
+
+@pytest.mark.parametrize("pose", [(0, 0, 0), (-90, 0, 90), (-90, 0, 0), (20, -35, 60)])
+def test_cast_rays_through_uniform_cube(pose):
+    volume_size, spacing = (12, 12, 12), (1.0, 1.0, 1.0)
+    rotation = get_euler_zyx_matrix(*pose)
+    projection = cast_rays(
+        np.ones(np.prod(volume_size)), volume_size, spacing, rotation, 5, 1.0, scd=1000.0
+    )
+    # the central ray passes through the isocentre along the rotated beam axis
+    direction = rotation.T @ np.array([0.0, 1.0, 0.0])
+    np.testing.assert_allclose(
+        projection[2, 2], get_chord_length(np.full(3, 12.0), direction), rtol=1e-9
+    )
+
+
+def get_pir_phantom(marker):
+    """PIR volume (index x: posterior, y: inferior, z: right) with a single marker
+    "right": a 4x6x6 voxel marker at the anterior-superior-right corner
+    "left": a 4x6x4 voxel marker at the posterior-inferior-left corner
+    """
+    size = (20, 30, 40)
+    phantom = np.zeros(size[::-1], dtype=np.float32)
+    if marker == "right":
+        phantom[32:38, 2:8, 2:6] = 1.0  # [z,y,x]
+    else:
+        phantom[2:6, 22:28, 14:18] = 1.0
+    img = sitk.GetImageFromArray(phantom)
+    img.SetDirection((0, 0, 1, -1, 0, 0, 0, -1, 0))
+    return img
+
+
+def get_marker_pixel(projection_type, marker):
+    """DRR and (row, column) centre of mass of the marker"""
+    drr = generate_drr(get_pir_phantom(marker), projection_type, PIR_POSE_CONFIG)
+    rows, cols = np.indices(drr.shape)
+    return drr, (np.sum(rows * drr) / drr.sum(), np.sum(cols * drr) / drr.sum())
+
+
+def test_generate_drr_pir_ap_view():
+    drr, (right_row, right_col) = get_marker_pixel(ProjectionType.AP, "right")
+    # the rays travel from anterior to posterior, through 4 voxels of the marker
+    np.testing.assert_allclose(drr.max(), 4.0, rtol=0.01)
+    _, (left_row, left_col) = get_marker_pixel(ProjectionType.AP, "left")
+    # superior at the top, patient right on the left of the image
+    assert right_row < 32 < left_row
+    assert right_col < 32 < left_col
+    # rows follow the inferior axis (marker centres at y 5 and y 25), columns the left axis (z 35 and z 4)
+    np.testing.assert_allclose(left_row - right_row, 20.0, rtol=0.02)
+    np.testing.assert_allclose(left_col - right_col, 31.0, rtol=0.02)
+
+
+def test_generate_drr_pir_lat_view():
+    drr, (right_row, right_col) = get_marker_pixel(ProjectionType.LAT, "right")
+    # the rays travel from the patient left to right, through 6 voxels of the marker
+    np.testing.assert_allclose(drr.max(), 6.0, rtol=0.01)
+    _, (left_row, left_col) = get_marker_pixel(ProjectionType.LAT, "left")
+    # superior at the top, anterior on the left of the image
+    assert right_row < 32 < left_row
+    assert right_col < 32 < left_col
+    # rows follow the inferior axis, columns the posterior axis (x 4 to x 16)
+    np.testing.assert_allclose(left_row - right_row, 20.0, rtol=0.02)
+    np.testing.assert_allclose(left_col - right_col, 12.0, rtol=0.02)
+
+
+@pytest.mark.parametrize("pose", [(-90, 0, 90), (20, -35, 60)])
+def test_projection_operator_equals_cast_rays(pose):
+    volume_size, spacing = (9, 7, 11), (1.2, 0.9, 1.5)
+    attenuation = np.random.RandomState(0).uniform(size=np.prod(volume_size))
+    operator = build_projection_operator(volume_size, spacing, pose, 16, 1.5)
+    projection = cast_rays(
+        attenuation, volume_size, spacing, get_euler_zyx_matrix(*pose), 16, 1.5
+    )
+    # the operator stores lengths as float32
+    np.testing.assert_allclose(
+        (operator @ attenuation).reshape(16, 16), projection, rtol=1e-5, atol=1e-5
+    )
+
+
+def test_projection_operator_cache_roundtrip(tmp_path):
+    geometry = ((9, 7, 11), (1.2, 0.9, 1.5), (-90, 0, 0), 16, 1.5)
+    drr_utils._get_projection_operator.cache_clear()
+    operator = get_projection_operator(*geometry, cache_dir=tmp_path)
+    (operator_path,) = tmp_path.glob("drr_operator_*.npz")
+
+    # a new process reads the operator back from the cache directory
+    drr_utils._get_projection_operator.cache_clear()
+    reloaded = get_projection_operator(*geometry, cache_dir=tmp_path)
+    assert reloaded is not operator
+    assert (reloaded != operator).nnz == 0
+    np.testing.assert_array_equal(
+        reloaded.toarray(), build_projection_operator(*geometry).toarray()
+    )
+    assert list(tmp_path.glob("*.npz")) == [operator_path]
@@ -0,0 +1,54 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from xrayto3d_preprocess.gzip_utils import (
+    get_gzip_blocks_path,
+    load_gzip_blocks,
+    read_gzip_range,
+    write_gzip_blocks,
+)
+
+
+def get_test_bytes(nbytes=100_000):
+    return np.random.RandomState(0).randint(0, 16, nbytes, dtype=np.uint8).tobytes()
+
+
+def test_write_gzip_blocks_is_one_gzip_stream(tmp_path):
+    data = get_test_bytes()
+    gz_path = tmp_path / "data.gz"
+    write_gzip_blocks(data, gz_path, block_size=4096, write_block_offsets=True)
+    with gzip.open(gz_path) as gz_file:
+        assert gz_file.read() == data
+    blocks = load_gzip_blocks(gz_path)
+    assert len(blocks["members"]) == -(-len(data) // 4096)
+    assert blocks["uncompressed_size"] == len(data)
+
+
+@pytest.mark.parametrize(
+    "start,stop",
+    [(0, 540), (4095, 4097), (10_000, 30_000), (99_000, 200_000), (5000, 5000)],
+)
+def test_read_gzip_range(tmp_path, start, stop):
+    data = get_test_bytes()
+    gz_path = tmp_path / "data.gz"
+    write_gzip_blocks(data, gz_path, block_size=4096, write_block_offsets=True)
+    assert read_gzip_range(gz_path, load_gzip_blocks(gz_path), start, stop) == data[start:stop]
+
+
+def test_stale_block_offsets_are_ignored(tmp_path):
+    gz_path = tmp_path / "data.gz"
+    write_gzip_blocks(get_test_bytes(), gz_path, block_size=4096, write_block_offsets=True)
+    assert load_gzip_blocks(gz_path) is not None
+
+    # the file is rewritten by another writer, the sidecar no longer describes it
+    with gzip.open(gz_path, "wb") as gz_file:
+        gz_file.write(get_test_bytes(50_000))
+    assert load_gzip_blocks(gz_path) is None
+
+    # a rewrite without block offsets removes the sidecar
+    write_gzip_blocks(get_test_bytes(), gz_path, block_size=4096, write_block_offsets=True)
+    write_gzip_blocks(get_test_bytes(), gz_path, block_size=4096)
+    assert not os.path.exists(get_gzip_blocks_path(gz_path))
@@ -0,0 +1,61 @@
+import os
+
+from conftest import get_test_volume, rewrite, write_test_volume
+from xrayto3d_preprocess.header_index import (
+    HEADER_INDEX_FILENAME,
+    HeaderIndex,
+    build_header_index,
+)
+
+# exact in the float32 geometry of the nifti header
+GEOMETRY = {"spacing": (0.5, 1.0, 2.0), "origin": (1.0, -2.0, 3.0)}
+
+
+def test_build_header_index(tmp_path):
+    img = write_test_volume(tmp_path / "s01" / "ct.nii.gz", size=(12, 10, 8), **GEOMETRY)
+    write_test_volume(tmp_path / "s02" / "ct.nii.gz", size=(6, 6, 6), **GEOMETRY)
+    with build_header_index(tmp_path) as index:
+        assert len(index) == 2
+        record = index.get(tmp_path / "s01" / "ct.nii.gz")
+        assert record["size"] == img.GetSize()
+        assert record["num_voxels"] == 12 * 10 * 8
+        assert record["axcode"] == "RAS"
+        header = index.get_header(tmp_path / "s01" / "ct.nii.gz")
+        assert header.GetSpacing() == img.GetSpacing()
+        assert header.GetOrigin() == img.GetOrigin()
+        assert header.GetDirection() == img.GetDirection()
+        assert len(index.records("num_voxels > ?", (300,))) == 1
+    assert os.path.exists(tmp_path / HEADER_INDEX_FILENAME)
+
+
+def test_header_index_refresh_and_prune(tmp_path):
+    img_paths = [tmp_path / f"s0{i}" / "ct.nii.gz" for i in range(3)]
+    for img_path in img_paths:
+        write_test_volume(img_path)
+    with HeaderIndex(tmp_path / "index.sqlite") as index:
+        assert index.update(img_paths) == 3
+        # unchanged files are not read again
+        assert index.update(img_paths) == 0
+
+        rewrite(img_paths[0], get_test_volume(size=(4, 5, 6)))
+        assert index.get(img_paths[0]) is None
+        assert index.update(img_paths) == 1
+        assert index.get(img_paths[0])["size"] == (4, 5, 6)
+
+        os.remove(img_paths[1])
+        assert index.get(img_paths[1]) is None
+        assert index.prune() == 1
+        assert len(index) == 2
+
+    # the index persists across sessions
+    with HeaderIndex(tmp_path / "index.sqlite") as index:
+        assert index.update(img_paths[::2]) == 0
+
+
+def test_header_index_records_by_path_pattern(tmp_path):
+    write_test_volume(tmp_path / "s01" / "s01_ct.nii.gz")
+    # in a LIKE pattern "_" matches any character, this file would match "%_ct.nii.gz"
+    write_test_volume(tmp_path / "s02" / "s02-ct.nii.gz")
+    with build_header_index(tmp_path) as index:
+        records = index.records("path GLOB ?", ("*_ct.nii.gz",))
+        assert [os.path.basename(record["path"]) for record in records] == ["s01_ct.nii.gz"]
@@ -0,0 +1,37 @@
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+from conftest import assert_same_image, get_test_volume
+from xrayto3d_preprocess.gzip_utils import load_gzip_blocks
+from xrayto3d_preprocess.ioutils import (
+    disable_parallel_gzip,
+    enable_parallel_gzip,
+    write_image,
+    write_nifti_gz_parallel,
+)
+
+
+def test_write_nifti_gz_parallel_roundtrip(tmp_path):
+    img = get_test_volume()
+    out_path = str(tmp_path / "ct.nii.gz")
+    write_nifti_gz_parallel(img, out_path, block_size=1000, write_block_offsets=True)
+    assert len(load_gzip_blocks(out_path)["members"]) > 1
+
+    assert_same_image(sitk.ReadImage(out_path), img)
+    # nibabel arrays are indexed [x,y,z], sitk arrays [z,y,x]
+    np.testing.assert_array_equal(
+        np.asarray(nib.load(out_path).dataobj), sitk.GetArrayViewFromImage(img).transpose()
+    )
+
+
+def test_write_image_with_parallel_gzip(tmp_path):
+    img = get_test_volume()
+    out_path = str(tmp_path / "ct.nii.gz")
+    enable_parallel_gzip(block_size=1000)
+    try:
+        write_image(img, out_path)
+    finally:
+        disable_parallel_gzip()
+    assert load_gzip_blocks(out_path) is None
+    assert_same_image(sitk.ReadImage(out_path), img)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from xrayto3d_preprocess.label_utils import relabel
+
+
+def test_relabel_merge_and_keep():
+    seg = sitk.GetImageFromArray(np.array([[[0, 1, 2, 3, 4]]], dtype=np.int16))
+    relabelled = relabel(seg, mapping={1: 1, 2: 1, 3: 1}, keep=[1])
+    assert relabelled.GetPixelID() == sitk.sitkUInt8
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(relabelled), [[[0, 1, 1, 1, 0]]]
+    )
+
+
+@pytest.mark.parametrize("label", [256, -1])
+def test_relabel_rejects_labels_out_of_range(label):
+    seg = sitk.GetImageFromArray(np.array([[[0, 1, label]]], dtype=np.int16))
+    with pytest.raises(ValueError):
+        relabel(seg, binarize=True)
+
+
+def test_relabel_rounds_float_labels():
+    seg = sitk.GetImageFromArray(np.array([[[0.2, 0.7, 1.4, 1.6, 2.5]]], dtype=np.float32))
+    relabelled = relabel(seg, mapping={1: 5, 2: 6}, keep=[5, 6])
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(relabelled), [[[0, 5, 5, 6, 6]]]
+    )
+    # labels that round to 0 are background, the same as binarizing with > 0.5
+    binarized = relabel(seg, binarize=True)
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(binarized),
+        (sitk.GetArrayViewFromImage(seg) > 0.5).astype(np.uint8),
+    )
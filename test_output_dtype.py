@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from conftest import get_test_volume
+from xrayto3d_preprocess.ioutils import cast_to_output_dtype, write_image
+
+
+def test_cast_to_output_dtype():
+    img = get_test_volume()
+    assert cast_to_output_dtype(img, "int16") is img
+    assert cast_to_output_dtype(img, "int32").GetPixelID() == sitk.sitkInt32
+
+    scaled = cast_to_output_dtype(
+        sitk.Cast(img, sitk.sitkFloat32), {"dtype": "int16", "scale": 0.5}
+    )
+    assert scaled.GetPixelID() == sitk.sitkInt16
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(scaled),
+        np.rint(sitk.GetArrayViewFromImage(img) * np.float32(0.5)),
+    )
+    assert scaled.GetOrigin() == img.GetOrigin()
+
+
+def test_cast_to_output_dtype_out_of_range():
+    img = get_test_volume()
+    with pytest.raises(ValueError, match="exceeds the range"):
+        cast_to_output_dtype(img, "uint8")
+    clipped = cast_to_output_dtype(img, {"dtype": "uint8", "clip": True})
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(clipped),
+        np.clip(sitk.GetArrayViewFromImage(img), 0, 255),
+    )
+
+
+def test_cast_to_output_dtype_nan():
+    img_arr = np.zeros((4, 5, 6), dtype=np.float32)
+    img_arr[1, 2, 3] = np.nan
+    img = sitk.GetImageFromArray(img_arr)
+    with pytest.raises(ValueError, match="NaN"):
+        cast_to_output_dtype(img, "int16")
+    with pytest.raises(ValueError, match="NaN"):
+        cast_to_output_dtype(img, {"dtype": "uint8", "clip": True})
+
+
+def test_write_image_with_output_dtype(tmp_path):
+    heatmap = sitk.Cast(get_test_volume(), sitk.sitkFloat64) / 6000.0
+    out_path = str(tmp_path / "heatmap.nii.gz")
+    write_image(heatmap, out_path, output_dtype={"dtype": "uint8", "scale": 255})
+    written = sitk.ReadImage(out_path)
+    assert written.GetPixelID() == sitk.sitkUInt8
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(written),
+        np.rint(sitk.GetArrayViewFromImage(heatmap) * 255),
+    )
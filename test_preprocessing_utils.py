@@ -0,0 +1,211 @@
+import logging
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from xrayto3d_preprocess import misc, preprocessing_utils
+from xrayto3d_preprocess.drr_utils import drr_to_image, generate_drr
+from xrayto3d_preprocess.enumutils import ProjectionType
+from xrayto3d_preprocess.preprocessing_utils import (
+    generate_biplanar_landmark_xray,
+    generate_biplanar_xray,
+    generate_xray_sweep,
+    process_subject_config_groups,
+)
+from xrayto3d_preprocess.roi_utils import render_centroid_heatmap
+
+XRAY_CONFIG = {
+    "ap": {"rx": -90, "ry": 0, "rz": 90},
+    "lat": {"rx": -90, "ry": 0, "rz": 0},
+    "res": 1.5,
+    "size": 64,
+    "drr_from_mask": False,
+}
+
+
+def get_reference(size=(48, 40, 56)):
+    reference = sitk.Image(size, sitk.sitkFloat32)
+    reference.SetSpacing((1.0, 1.25, 1.0))
+    reference.SetOrigin((-20.0, 10.0, 5.0))
+    return reference
+
+
+@pytest.fixture
+def no_drr_tool(monkeypatch):
+    def run_drr_tool(command):
+        raise AssertionError(f"DRR tool called: {command}")
+
+    monkeypatch.setattr(preprocessing_utils.os, "system", run_drr_tool)
+
+
+def test_landmark_xray_is_projected_in_closed_form(tmp_path, no_drr_tool):
+    reference = get_reference()
+    landmark = {"centroid": reference.TransformIndexToPhysicalPoint((20, 22, 30)), "sigma": 3.0}
+    config = {**XRAY_CONFIG, "drr_engine": "numpy"}
+    generate_biplanar_landmark_xray(
+        landmark, reference, config, str(tmp_path / "ap.png"), str(tmp_path / "lat.png")
+    )
+
+    # the in-process DRR of the rendered heatmap volume
+    heatmap = render_centroid_heatmap(landmark, reference)
+    generate_biplanar_xray(
+        None,
+        heatmap,
+        {**XRAY_CONFIG, "drr_engine": "numpy"},
+        str(tmp_path / "heatmap_ap.png"),
+        str(tmp_path / "heatmap_lat.png"),
+        input_image=heatmap,
+    )
+    for view in ("ap", "lat"):
+        xray = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / f"{view}.png")))
+        expected = sitk.GetArrayFromImage(
+            sitk.ReadImage(str(tmp_path / f"heatmap_{view}.png"))
+        )
+        assert xray.shape == (64, 64)
+        assert np.unravel_index(xray.argmax(), xray.shape) == np.unravel_index(
+            expected.argmax(), expected.shape
+        )
+        # the heatmap volume is piecewise constant over its voxels, the closed form is not
+        assert np.abs(xray.astype(int) - expected).max() <= 40
+
+
+def test_landmark_xray_projects_heatmap_with_drr_tool(tmp_path, monkeypatch):
+    reference = get_reference()
+    landmark = {"centroid": reference.TransformIndexToPhysicalPoint((20, 22, 30)), "sigma": 3.0}
+    commands = []
+
+    def run_drr_tool(command):
+        commands.append(command)
+        input_path = command.split()[1]
+        # the tool reads the rendered heatmap volume, as it reads the CT
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(sitk.ReadImage(input_path)),
+            sitk.GetArrayFromImage(render_centroid_heatmap(landmark, reference)),
+        )
+        out_xray_path = command.split(" -o ")[1].split()[0]
+        sitk.WriteImage(sitk.Image(8, 8, sitk.sitkUInt8), out_xray_path)
+
+    monkeypatch.setattr(misc, "get_drr_command", lambda: "DRRSiddonJacobs")
+    monkeypatch.setattr(preprocessing_utils.os, "system", run_drr_tool)
+    config = {**XRAY_CONFIG, "drr_engine": "siddonjacobs"}
+    generate_biplanar_landmark_xray(
+        landmark, reference, config, str(tmp_path / "ap.png"), str(tmp_path / "lat.png")
+    )
+
+    assert len(commands) == 2
+    assert f"-o {tmp_path / 'ap.png'} -rx -90.0 -ry 0.0 -rz 90.0 " in commands[0]
+    assert f"-o {tmp_path / 'lat.png'} -rx -90.0 -ry 0.0 -rz 0.0 " in commands[1]
+
+
+def get_sweep_views(tmp_path):
+    """the repeated AP view and the LAT view perturbed by +-5 degrees, with one pose given twice"""
+    offsets = [(0, 0, 5), (0, 0, -5), (0, 0, 5.0000000001)]
+    views = []
+    for i, offset in enumerate(offsets):
+        views.append((ProjectionType.AP, (0, 0, 0), str(tmp_path / f"ap_{i}.png")))
+        views.append((ProjectionType.LAT, offset, str(tmp_path / f"lat_{i}.png")))
+    return views
+
+
+def test_xray_sweep_runs_drr_tool_once_per_pose(tmp_path, monkeypatch):
+    commands = []
+
+    def run_drr_tool(command):
+        commands.append(command)
+        out_xray_path = command.split(" -o ")[1].split()[0]
+        sitk.WriteImage(sitk.Image(8, 8, sitk.sitkUInt8) + len(commands), out_xray_path)
+
+    monkeypatch.setattr(misc, "get_drr_command", lambda: "DRRSiddonJacobs")
+    monkeypatch.setattr(preprocessing_utils.os, "system", run_drr_tool)
+    views = get_sweep_views(tmp_path)
+    generate_xray_sweep("ct.nii.gz", views, {**XRAY_CONFIG, "drr_engine": "siddonjacobs"})
+
+    # AP, LAT +5 and LAT -5
+    assert len(commands) == 3
+    assert "-rx -90.0 -ry 0.0 -rz 90.0 " in commands[0]
+    assert "-rx -90.0 -ry 0.0 -rz 5.0 " in commands[1]
+    assert "-rx -90.0 -ry 0.0 -rz -5.0 " in commands[2]
+    # the remaining views are copies of the rendered ones
+    rendered_by = {"ap_0": 1, "ap_1": 1, "ap_2": 1, "lat_0": 2, "lat_1": 3, "lat_2": 2}
+    for name, command_id in rendered_by.items():
+        xray = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / f"{name}.png")))
+        assert np.all(xray == command_id)
+
+
+def test_xray_sweep_with_numpy_engine(tmp_path, monkeypatch):
+    ct = sitk.GetImageFromArray(
+        np.random.RandomState(0).uniform(0, 100, size=(20, 24, 16)).astype(np.float32)
+    )
+    ct_path = str(tmp_path / "ct.nii.gz")
+    sitk.WriteImage(ct, ct_path)
+    reads = []
+
+    def read_image(img_path):
+        reads.append(img_path)
+        return sitk.ReadImage(img_path)
+
+    monkeypatch.setattr(preprocessing_utils, "read_image", read_image)
+    views = get_sweep_views(tmp_path)
+    config = {**XRAY_CONFIG, "drr_engine": "numpy"}
+    generate_xray_sweep(ct_path, views, config)
+
+    assert reads == [ct_path]
+    for projection_type, offset, out_xray_path in views:
+        key = "ap" if projection_type == ProjectionType.AP else "lat"
+        pose_config = {**config, key: {**config[key], "rz": config[key]["rz"] + offset[2]}}
+        expected = drr_to_image(generate_drr(ct, projection_type, pose_config), config["res"])
+        np.testing.assert_array_equal(
+            sitk.GetArrayFromImage(sitk.ReadImage(out_xray_path)),
+            sitk.GetArrayViewFromImage(expected),
+        )
+
+
+def get_subject_config(derivatives, ct="ct.nii.gz"):
+    return {
+        "subjects": {"subject_basepath": "subjects"},
+        "filename_convention": {"input": {"ct": ct, "seg": "seg.nii.gz"}},
+        "out_directories": {"derivatives": derivatives},
+    }
+
+
+def test_config_groups_extract_rois_once_per_group():
+    calls = []
+    script = SimpleNamespace(
+        logger=logging.getLogger("test_preprocessing_utils"),
+        create_directories=lambda out_dir_template, config: calls.append(
+            ("create_directories", config["out_directories"]["derivatives"])
+        ),
+        # the second group has no ROI, e.g. the scan does not have the anatomy
+        extract_rois=lambda subject, config: calls.append(
+            ("extract_rois", config["out_directories"]["derivatives"], subject._ct)
+        )
+        or (None if config["out_directories"]["derivatives"] == "c" else "rois"),
+        write_outputs=lambda subject_id, rois, config, output_path_template: calls.append(
+            ("write_outputs", config["out_directories"]["derivatives"], output_path_template)
+        ),
+    )
+    a, b, c, d = (get_subject_config(name) for name in "abcd")
+    config_groups = [
+        [(a, {"s1"}), (b, {"s1", "s2"})],
+        [(c, {"s1"})],
+        [(d, {"s2"})],
+    ]
+    lazy_cts = {}
+    process_subject_config_groups("s1", config_groups, script, lazy_cts=lazy_cts)
+
+    assert [call[:2] for call in calls] == [
+        ("create_directories", "a"),
+        ("create_directories", "b"),
+        ("extract_rois", "a"),
+        ("write_outputs", "a"),
+        ("write_outputs", "b"),
+        ("create_directories", "c"),
+        ("extract_rois", "c"),
+    ]
+    assert calls[3][2] == "subjects/s1/a/{output_type}/{output_name}"
+    # both groups share the scan, its pixels are not read by the helper
+    assert len(lazy_cts) == 1
+    assert calls[2][2] is calls[6][2] is next(iter(lazy_cts.values()))
+    assert not calls[2][2].is_loaded
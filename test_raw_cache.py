@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from conftest import assert_same_image, get_test_volume, rewrite
+from xrayto3d_preprocess import ioutils
+from xrayto3d_preprocess.ioutils import read_image
+from xrayto3d_preprocess.raw_cache import (
+    RAW_CACHE_ENV,
+    build_raw_cache,
+    convert_to_raw_cache,
+    load_raw_cache_header,
+    read_raw_cache_array,
+    read_raw_cached_image,
+    read_raw_cached_region,
+)
+from xrayto3d_preprocess.roi_utils import extract_region
+
+
+def test_raw_cache_freshness(tmp_path):
+    img_path = str(tmp_path / "data" / "ct.nii.gz")
+    os.makedirs(os.path.dirname(img_path))
+    sitk.WriteImage(get_test_volume(), img_path)
+    cache_dir = tmp_path / "raw_cache"
+    assert convert_to_raw_cache(img_path, cache_dir)
+    assert not convert_to_raw_cache(img_path, cache_dir)
+    assert_same_image(read_raw_cached_image(img_path, cache_dir), get_test_volume())
+
+    # a modified source invalidates its cache until it is converted again
+    rewrite(img_path, get_test_volume(offset=500))
+    assert load_raw_cache_header(img_path, cache_dir) is None
+    assert read_raw_cached_image(img_path, cache_dir) is None
+    assert read_raw_cached_region(img_path, cache_dir, (0, 0, 0), (2, 2, 2)) is None
+    assert build_raw_cache([img_path], cache_dir) == 1
+    assert build_raw_cache([img_path], cache_dir) == 0
+    assert_same_image(
+        read_raw_cached_image(img_path, cache_dir), get_test_volume(offset=500)
+    )
+
+
+def test_raw_cached_region_is_read_from_memmap(tmp_path):
+    img_path = str(tmp_path / "ct.nii.gz")
+    img = get_test_volume()
+    sitk.WriteImage(img, img_path)
+    convert_to_raw_cache(img_path, tmp_path / "raw_cache")
+    img_arr, header = read_raw_cache_array(img_path, tmp_path / "raw_cache")
+    assert isinstance(img_arr, np.memmap) and img_arr.shape == tuple(header["shape"])
+    np.testing.assert_array_equal(img_arr, sitk.GetArrayViewFromImage(img))
+
+    for index, size in [((3, 5, 7), (10, 8, 1)), ((10, 4, 2), (17, 16, 6))]:
+        assert_same_image(
+            read_raw_cached_region(img_path, tmp_path / "raw_cache", index, size),
+            extract_region(img, index, size, -1024),
+        )
+
+
+def test_read_image_prefers_fresh_raw_cache(tmp_path, monkeypatch):
+    img_path = str(tmp_path / "ct.nii.gz")
+    sitk.WriteImage(get_test_volume(), img_path)
+    convert_to_raw_cache(img_path, tmp_path / "raw_cache")
+    monkeypatch.setenv(RAW_CACHE_ENV, str(tmp_path / "raw_cache"))
+    reads = []
+    monkeypatch.setattr(ioutils.sitk, "ReadImage", lambda *args: reads.append(args))
+    assert_same_image(read_image(img_path), get_test_volume())
+    assert reads == []
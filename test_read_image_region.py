@@ -0,0 +1,115 @@
+import pytest
+import SimpleITK as sitk
+
+from conftest import assert_same_image, get_test_volume, rewrite
+from xrayto3d_preprocess import ioutils
+from xrayto3d_preprocess.gzip_utils import load_gzip_blocks
+from xrayto3d_preprocess.ioutils import (
+    build_gzip_index,
+    read_image,
+    read_image_region,
+    write_nifti_gz_parallel,
+)
+from xrayto3d_preprocess.raw_cache import RAW_CACHE_ENV, convert_to_raw_cache
+from xrayto3d_preprocess.roi_utils import extract_region, extract_region_from_file
+
+REGIONS = [
+    ((0, 0, 0), (30, 20, 10)),
+    ((3, 5, 7), (10, 8, 1)),
+    ((29, 19, 9), (1, 1, 1)),
+    ((10, 4, 2), (17, 16, 6)),
+]
+
+
+def count_calls(monkeypatch, name):
+    calls = []
+    function = getattr(ioutils, name)
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(ioutils, name, counted)
+    return calls
+
+
+@pytest.fixture(params=["itk", "blocks", "indexed_gzip", "raw_cache"])
+def region_read_path(request, tmp_path, monkeypatch):
+    """image file that `read_image_region` reads through the given path,
+    and the calls to the reader of that path (None for the streamed itk read)
+    """
+    img_path = str(tmp_path / "ct.nii.gz")
+    if request.param == "blocks":
+        write_nifti_gz_parallel(
+            get_test_volume(), img_path, block_size=1000, write_block_offsets=True
+        )
+        return img_path, count_calls(monkeypatch, "_read_nifti_region_blocks")
+
+    sitk.WriteImage(get_test_volume(), img_path)
+    if request.param == "indexed_gzip":
+        pytest.importorskip("indexed_gzip")
+        build_gzip_index(img_path)
+        return img_path, count_calls(monkeypatch, "_read_nifti_region_indexed")
+    if request.param == "raw_cache":
+        convert_to_raw_cache(img_path, tmp_path / "raw_cache")
+        monkeypatch.setenv(RAW_CACHE_ENV, str(tmp_path / "raw_cache"))
+        return img_path, count_calls(monkeypatch, "read_raw_cached_region")
+    return img_path, None
+
+
+@pytest.mark.parametrize("index,size", REGIONS)
+def test_read_image_region(region_read_path, index, size):
+    img_path, calls = region_read_path
+    img = sitk.ReadImage(img_path)
+    region = read_image_region(img_path, index, size)
+    assert_same_image(region, extract_region(img, index, size, -1024))
+    if calls is not None:
+        assert len(calls) == 1
+
+
+def test_extract_region_from_file_beyond_border(region_read_path):
+    img_path, _ = region_read_path
+    img = sitk.ReadImage(img_path)
+    for index, size in [((-5, 2, 3), (12, 30, 4)), ((25, -3, -2), (10, 10, 20))]:
+        assert_same_image(
+            extract_region_from_file(img_path, index, size, -1024),
+            extract_region(img, index, size, -1024),
+        )
+
+
+def test_read_image_region_outside_raises(tmp_path):
+    img_path = str(tmp_path / "ct.nii.gz")
+    sitk.WriteImage(get_test_volume(), img_path)
+    with pytest.raises(ValueError):
+        read_image_region(img_path, (25, 0, 0), (10, 1, 1))
+
+
+def test_stale_gzip_index_is_ignored(tmp_path):
+    pytest.importorskip("indexed_gzip")
+    img_path = str(tmp_path / "ct.nii.gz")
+    sitk.WriteImage(get_test_volume(), img_path)
+    build_gzip_index(img_path)
+
+    rewritten = get_test_volume(offset=500)
+    rewrite(img_path, rewritten)
+    for index, size in REGIONS:
+        assert_same_image(
+            read_image_region(img_path, index, size),
+            extract_region(rewritten, index, size, -1024),
+        )
+    assert_same_image(read_image(img_path), rewritten)
+
+
+def test_stale_gzip_blocks_are_ignored(tmp_path):
+    img_path = str(tmp_path / "ct.nii.gz")
+    write_nifti_gz_parallel(
+        get_test_volume(), img_path, block_size=1000, write_block_offsets=True
+    )
+    rewritten = get_test_volume(offset=500)
+    rewrite(img_path, rewritten)
+    assert load_gzip_blocks(img_path) is None
+    for index, size in REGIONS:
+        assert_same_image(
+            read_image_region(img_path, index, size),
+            extract_region(rewritten, index, size, -1024),
+        )
@@ -0,0 +1,145 @@
+from functools import partial
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import conftest
+from xrayto3d_preprocess.roi_utils import (
+    extract_around_centroid_v2,
+    extract_around_centroids,
+    extract_pairs_around_centroids,
+    generate_gaussian_heatmap,
+    get_roi_start_indices,
+    sample_pairs_around_centroids,
+    sample_roi,
+)
+from xrayto3d_preprocess.sitk_utils import reorient_to
+
+EXTRACTION_RATIO = {"L": 0.5, "A": 0.5, "S": 0.5}
+
+get_test_volume = partial(
+    conftest.get_test_volume,
+    size=(20, 24, 28),
+    spacing=(1.0, 1.5, 2.0),
+    origin=(-10.0, 5.0, 30.0),
+    direction=(1, 0, 0, 0, 1, 0, 0, 0, 1),
+)
+assert_same_image = partial(conftest.assert_same_image, atol=1e-6)
+
+
+def test_roi_start_indices_without_centroids():
+    img = get_test_volume()
+    start_indices = get_roi_start_indices(img, (8, 8, 8), [], EXTRACTION_RATIO)
+    assert start_indices.shape == (0, 3)
+
+
+def test_extract_around_no_centroids():
+    img = get_test_volume()
+    seg = get_test_volume(pixeltype=sitk.sitkUInt8)
+    assert extract_around_centroids(img, (8, 8, 8), [], EXTRACTION_RATIO, -1024) == ([], [])
+    assert extract_pairs_around_centroids(
+        img, seg, (8, 8, 8), [], EXTRACTION_RATIO, -1024, 0
+    ) == ([], [], [])
+
+
+def test_sample_roi_equals_extract_and_reorient():
+    img = get_test_volume()
+    # the ROI reaches past the image border
+    for centroid_index in ([10, 12, 14], [2, 20, 3]):
+        roi, _ = extract_around_centroid_v2(
+            img,
+            (12, 15, 16),
+            centroid_index,
+            EXTRACTION_RATIO,
+            -1024,
+            verbose=False,
+            return_landmark=True,
+        )
+        expected = reorient_to(roi, axcodes_to="PIR")
+        sampled = sample_roi(
+            img, centroid_index, (12, 15, 16), EXTRACTION_RATIO, "PIR", padding_value=-1024
+        )
+        assert_same_image(sampled, expected)
+
+
+def test_sample_pairs_equals_extract_pairs_and_reorient():
+    img = get_test_volume()
+    seg = sitk.Cast(img > 3000, sitk.sitkUInt8)
+    centroid_indices = [[10, 12, 14], [2, 20, 3]]
+    img_rois, seg_rois, landmarks = extract_pairs_around_centroids(
+        img, seg, (12, 15, 16), centroid_indices, EXTRACTION_RATIO, -1024, 0
+    )
+    sampled_img_rois, sampled_seg_rois, sampled_landmarks = sample_pairs_around_centroids(
+        img, seg, (12, 15, 16), centroid_indices, EXTRACTION_RATIO, "PIR", -1024, 0
+    )
+    for img_roi, seg_roi, sampled_img_roi, sampled_seg_roi in zip(
+        img_rois, seg_rois, sampled_img_rois, sampled_seg_rois
+    ):
+        assert_same_image(sampled_img_roi, reorient_to(img_roi, axcodes_to="PIR"))
+        assert_same_image(sampled_seg_roi, reorient_to(seg_roi, axcodes_to="PIR"))
+    assert sampled_landmarks == landmarks
+
+
+def get_dense_heatmap(centroid_index, reference, sigma, amplitude):
+    """gaussian evaluated on every voxel of the reference grid"""
+    squared_distance = 0.0
+    for c, sz, sp in zip(centroid_index, reference.GetSize(), reference.GetSpacing()):
+        d = (np.arange(sz) - c) * sp
+        squared_distance = np.add.outer(d * d, squared_distance)
+    return amplitude * np.exp(-squared_distance / (2 * sigma**2))
+
+
+def test_gaussian_heatmap_support():
+    reference = get_test_volume(size=(30, 24, 20))
+    centroid_index, sigma, truncate = (12, 10, 9), 2.0, 3.0
+    heatmap = generate_gaussian_heatmap(centroid_index, reference, sigma, truncate)
+    assert heatmap.GetPixelID() == sitk.sitkFloat32
+    assert heatmap.GetSpacing() == reference.GetSpacing()
+    assert heatmap.GetOrigin() == reference.GetOrigin()
+    heatmap_arr = sitk.GetArrayFromImage(heatmap)
+    # peak is the smallest physical extent of the reference, 30 * 1.0 mm
+    amplitude = 30
+    assert heatmap_arr[9, 10, 12] == amplitude
+
+    # within truncate * sigma of the centroid along every axis, the heatmap is the gaussian
+    radius = [int(np.ceil(truncate * sigma / sp)) for sp in reference.GetSpacing()]
+    support = tuple(
+        slice(c - r, c + r + 1) for c, r in zip(centroid_index[::-1], radius[::-1])
+    )
+    expected = get_dense_heatmap(centroid_index, reference, sigma, amplitude)
+    np.testing.assert_allclose(heatmap_arr[support], expected[support], rtol=1e-5)
+    heatmap_arr[support] = 0
+    assert not heatmap_arr.any()
+
+
+def test_gaussian_heatmap_truncated_by_image_border():
+    reference = get_test_volume(size=(16, 12, 10))
+    heatmap = generate_gaussian_heatmap((1, 11, 0), reference, sigma=3.0)
+    expected = get_dense_heatmap((1, 11, 0), reference, 3.0, amplitude=16)
+    # beyond the default support of 4 sigma the gaussian is below 16 * exp(-8)
+    np.testing.assert_allclose(
+        sitk.GetArrayViewFromImage(heatmap), expected, rtol=1e-5, atol=16 * np.exp(-8)
+    )
+    # a centroid beyond the support of the image leaves the heatmap empty
+    heatmap = generate_gaussian_heatmap((40, 5, 5), reference, sigma=3.0)
+    assert not sitk.GetArrayViewFromImage(heatmap).any()
+
+
+@pytest.mark.parametrize(
+    "pixeltype,dtype", [(sitk.sitkUInt8, np.uint8), (sitk.sitkUInt16, np.uint16)]
+)
+def test_gaussian_heatmap_quantized(pixeltype, dtype):
+    reference = get_test_volume(size=(16, 12, 10))
+    heatmap = generate_gaussian_heatmap((8, 6, 5), reference, 3.0, pixeltype=pixeltype)
+    heatmap_arr = sitk.GetArrayViewFromImage(heatmap)
+    assert heatmap_arr.dtype == dtype
+    amplitude = np.iinfo(dtype).max
+    assert heatmap_arr.max() == amplitude
+    expected = get_dense_heatmap((8, 6, 5), reference, 3.0, amplitude)
+    assert np.abs(heatmap_arr - expected).max() <= 0.5 + 1e-3 * amplitude
+
+
+def test_gaussian_heatmap_rejects_pixeltype():
+    with pytest.raises(ValueError):
+        generate_gaussian_heatmap((1, 1, 1), get_test_volume(), pixeltype=sitk.sitkInt16)
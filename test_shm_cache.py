@@ -0,0 +1,109 @@
+import os
+import socket
+import stat
+import threading
+import time
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from conftest import write_test_volume
+from xrayto3d_preprocess import ioutils, shm_cache
+from xrayto3d_preprocess.ioutils import read_image, read_image_region
+from xrayto3d_preprocess.shm_cache import SHM_CACHE_ENV, ShmCacheServer, ShmVolumeCache
+
+
+def test_segment_is_private(tmp_path):
+    write_test_volume(tmp_path / "ct.nii.gz", size=(10, 9, 8))
+    cache = ShmVolumeCache(shm_dir=str(tmp_path))
+    segment = cache.get(tmp_path / "ct.nii.gz")
+    assert stat.S_IMODE(os.stat(segment["shm_path"]).st_mode) == 0o600
+    img_arr = np.fromfile(segment["shm_path"], dtype=segment["dtype"])
+    assert img_arr.reshape(segment["shape"])[1, 2, 3] == 1 * 90 + 2 * 10 + 3
+
+
+def test_concurrent_requests_read_once(tmp_path):
+    write_test_volume(tmp_path / "ct.nii.gz", size=(10, 9, 8))
+    cache = ShmVolumeCache(shm_dir=str(tmp_path))
+    read_volume = cache._read_volume
+
+    def slow_read_volume(img_path):
+        time.sleep(0.05)
+        return read_volume(img_path)
+
+    cache._read_volume = slow_read_volume
+    segments = []
+    threads = [
+        threading.Thread(target=lambda: segments.append(cache.get(tmp_path / "ct.nii.gz")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert cache.misses == 1 and cache.hits == 7
+    assert len({segment["shm_path"] for segment in segments}) == 1
+    assert not cache._read_locks
+
+
+def test_reads_through_the_daemon(tmp_path, monkeypatch):
+    img = write_test_volume(tmp_path / "ct.nii.gz", size=(10, 9, 8))
+    cache = ShmVolumeCache(shm_dir=str(tmp_path))
+    server = ShmCacheServer(str(tmp_path / "cache.sock"), cache)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv(SHM_CACHE_ENV, str(tmp_path / "cache.sock"))
+    region_reads = []
+    read_region = ioutils.read_shm_cached_region
+    monkeypatch.setattr(
+        ioutils,
+        "read_shm_cached_region",
+        lambda *args: region_reads.append(args) or read_region(*args),
+    )
+    try:
+        region = read_image_region(tmp_path / "ct.nii.gz", (2, 3, 1), (5, 4, 6))
+        expected = sitk.RegionOfInterest(img, (5, 4, 6), (2, 3, 1))
+        assert len(region_reads) == 1
+        # the nifti header stores the geometry as float32
+        np.testing.assert_allclose(region.GetOrigin(), expected.GetOrigin(), atol=1e-5)
+        np.testing.assert_array_equal(
+            sitk.GetArrayViewFromImage(region), sitk.GetArrayViewFromImage(expected)
+        )
+        cached_img = read_image(tmp_path / "ct.nii.gz")
+        np.testing.assert_array_equal(
+            sitk.GetArrayViewFromImage(cached_img), sitk.GetArrayViewFromImage(img)
+        )
+        assert cache.misses == 1 and cache.hits == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def serve_broken_daemon(socket_path, hang):
+    """accept one connection, then drop it or never reply"""
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+
+    def serve():
+        connection, _ = listener.accept()
+        connection.recv(4096)
+        if hang:
+            time.sleep(1.0)
+        connection.close()
+        listener.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+
+@pytest.mark.parametrize("hang", [False, True])
+def test_read_image_falls_back_on_broken_daemon(tmp_path, monkeypatch, hang):
+    img = write_test_volume(tmp_path / "ct.nii.gz", size=(10, 9, 8))
+    serve_broken_daemon(str(tmp_path / "cache.sock"), hang)
+    monkeypatch.setenv(SHM_CACHE_ENV, str(tmp_path / "cache.sock"))
+    monkeypatch.setattr(shm_cache, "SHM_CACHE_TIMEOUT", 0.1)
+    read_img = read_image(tmp_path / "ct.nii.gz")
+    np.testing.assert_array_equal(
+        sitk.GetArrayViewFromImage(read_img), sitk.GetArrayViewFromImage(img)
+    )
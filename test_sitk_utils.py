@@ -0,0 +1,225 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from xrayto3d_preprocess.enumutils import ProjectionType
+from xrayto3d_preprocess.sitk_utils import (
+    SegmentationIndex,
+    change_label,
+    combine_segmentations,
+    get_largest_connected_component,
+    get_largest_connected_components,
+    get_nearest_neighbour_indices,
+    keep_only_label,
+    make_isotropic,
+    simulate_biplanar_parallel_projection,
+    simulate_parallel_projection,
+)
+
+# spacings without samples halfway between two voxels, and spacings with such ties
+SPACINGS = [0.6, 0.7, 0.9, 1.5]
+TIED_SPACINGS = [0.8, 1.2, 2.0]
+
+
+def get_test_segmentation():
+    """label 1: a large slab reaching into the ROI and a smaller ball inside it
+    label 2: two blobs of different size, label 3: a single voxel
+    """
+    seg_arr = np.zeros((40, 50, 60), dtype=np.uint8)
+    seg_arr[2:14, 5:45, 5:45] = 1
+    z, y, x = np.ogrid[:40, :50, :60]
+    seg_arr[(z - 28) ** 2 + (y - 25) ** 2 + (x - 30) ** 2 <= 81] = 1
+    seg_arr[20:25, 2:6, 50:58] = 2
+    seg_arr[30:32, 40:42, 50:52] = 2
+    seg_arr[35, 45, 5] = 3
+    seg = sitk.GetImageFromArray(seg_arr)
+    seg.SetSpacing((0.8, 1.0, 1.5))
+    seg.SetOrigin((10.0, -5.0, 2.0))
+    return seg
+
+
+def assert_same_mask(mask, expected):
+    """mask covers a part of the grid of expected, voxels outside of it are background"""
+    index = expected.TransformPhysicalPointToIndex(mask.GetOrigin())
+    mask_arr = sitk.GetArrayViewFromImage(mask)
+    expected_arr = sitk.GetArrayFromImage(expected).astype(np.uint8)
+    window = tuple(slice(i, i + sz) for i, sz in zip(index[::-1], mask_arr.shape))
+    np.testing.assert_array_equal(mask_arr, expected_arr[window])
+    expected_arr[window] = 0
+    assert not expected_arr.any()
+
+
+def test_largest_connected_components_equals_per_label():
+    seg = get_test_segmentation()
+    masks, removed_voxels = get_largest_connected_components(seg)
+    assert sorted(masks) == [1, 2, 3]
+    for label, mask in masks.items():
+        assert_same_mask(mask, get_largest_connected_component(seg == label))
+    assert removed_voxels[2] == 8 and removed_voxels[3] == 0
+
+    full_masks, _ = get_largest_connected_components(seg, crop_to_bbox=False)
+    for label, mask in full_masks.items():
+        assert mask.GetSize() == seg.GetSize()
+        assert_same_mask(mask, get_largest_connected_component(seg == label))
+
+
+def test_largest_connected_components_within_region():
+    seg = get_test_segmentation()
+    # the ROI holds the ball and a corner of the slab, the slab is the largest component
+    # of the whole segmentation but only the ball is the largest inside the ROI
+    roi_start, roi_size = [20, 15, 10], [25, 25, 28]
+    seg_roi = sitk.RegionOfInterest(seg, roi_size, roi_start)
+    masks, removed_voxels = get_largest_connected_components(
+        seg, regions={1: (roi_start, roi_size)}
+    )
+    expected = get_largest_connected_component(keep_only_label(seg_roi, 1))
+    assert_same_mask(masks[1], expected)
+    ball = sitk.GetArrayViewFromImage(expected).sum()
+    # without the region, the slab is the largest component of label 1
+    slab_in_roi = 4 * 25 * 25
+    assert ball > slab_in_roi
+    whole_masks, _ = get_largest_connected_components(seg, label_ids=[1])
+    assert sitk.GetArrayViewFromImage(whole_masks[1]).sum() == 12 * 40 * 40
+    assert sitk.GetArrayViewFromImage(masks[1]).sum() == ball
+    assert removed_voxels[1] == (sitk.GetArrayViewFromImage(seg_roi) == 1).sum() - ball
+    # labels without a region are cleaned over their whole bounding box
+    assert_same_mask(masks[2], get_largest_connected_component(seg == 2))
+    # labels without voxels in their region are left out
+    masks, _ = get_largest_connected_components(
+        seg, label_ids=[3], regions={3: ([0, 0, 0], [5, 5, 5])}
+    )
+    assert masks == {}
+
+
+def get_resampled_indices(size, spacing):
+    """voxel indices sampled by `make_isotropic` along x, -1 outside of the image"""
+    ramp = sitk.GetImageFromArray(np.arange(1, size + 1, dtype=np.float32)[None, None, :])
+    ramp.SetSpacing((spacing, 1.0, 1.0))
+    resampled = make_isotropic(ramp, 1.0, "nearest")
+    return sitk.GetArrayViewFromImage(resampled)[0, 0].astype(np.int64) - 1
+
+
+@pytest.mark.parametrize("spacing", SPACINGS + TIED_SPACINGS)
+def test_nearest_neighbour_indices_match_itk(spacing):
+    for size in range(2, 60):
+        indices = get_nearest_neighbour_indices(size, spacing, 1.0)
+        expected = get_resampled_indices(size, spacing)
+        assert len(indices) == len(expected)
+        mismatch = np.nonzero(indices != expected)[0]
+        if spacing in SPACINGS:
+            assert len(mismatch) == 0
+        # only samples halfway between two voxels may be assigned to the other voxel
+        continuous_index = mismatch / spacing
+        np.testing.assert_allclose(continuous_index % 1, 0.5)
+        assert np.all(indices[mismatch] - expected[mismatch] == 1)
+
+
+def get_pir_mask(size, spacing):
+    rng = np.random.RandomState(0)
+    mask_arr = (rng.uniform(size=size[::-1]) > 0.7).astype(np.uint8)
+    mask = sitk.GetImageFromArray(mask_arr)
+    mask.SetSpacing(spacing)
+    mask.SetOrigin((12.0, -30.5, 8.25))
+    mask.SetDirection((0, 0, 1, -1, 0, 0, 0, -1, 0))
+    return mask
+
+
+@pytest.mark.parametrize("spacing", SPACINGS + TIED_SPACINGS)
+def test_biplanar_parallel_projection_equals_per_view(spacing):
+    mask = get_pir_mask((23, 17, 29), (spacing, 1.1, 0.7))
+    for projection, projection_type in zip(
+        simulate_biplanar_parallel_projection(mask),
+        (ProjectionType.AP, ProjectionType.LAT),
+    ):
+        expected = simulate_parallel_projection(mask, projection_type)
+        assert projection.GetSize() == expected.GetSize()
+        assert projection.GetOrigin() == expected.GetOrigin()
+        difference = np.abs(
+            sitk.GetArrayViewFromImage(projection).astype(int)
+            - sitk.GetArrayViewFromImage(expected)
+        )
+        if spacing in SPACINGS:
+            assert difference.max() == 0
+        else:
+            # a tied sample projects a neighbouring voxel, which moves a few pixels of the mean
+            assert difference.mean() < 5
+
+
+def get_rib_masks(num_masks=6, size=(12, 10, 8)):
+    """non overlapping masks, one slab of x per mask, the last one as float probabilities"""
+    masks = []
+    for i in range(num_masks):
+        mask_arr = np.zeros(size[::-1], dtype=np.uint8)
+        mask_arr[1:-1, 2:-2, 2 * i : 2 * i + 2] = 1
+        mask = sitk.GetImageFromArray(mask_arr)
+        mask.SetSpacing((0.8, 1.0, 1.5))
+        mask.SetOrigin((3.0, -2.0, 40.0))
+        masks.append(mask)
+    masks[-1] = sitk.Cast(masks[-1], sitk.sitkFloat32) * 0.7
+    return masks
+
+
+def test_combine_segmentations_streams_paths(tmp_path):
+    masks = get_rib_masks()
+    mask_paths = []
+    for i, mask in enumerate(masks):
+        mask_paths.append(str(tmp_path / f"rib_{i}.nii.gz"))
+        sitk.WriteImage(mask, mask_paths[-1])
+    # images and paths, consumed from a generator
+    sources = (
+        mask if i % 2 else mask_path
+        for i, (mask, mask_path) in enumerate(zip(masks, mask_paths))
+    )
+    combined, multilabel = combine_segmentations(
+        sources, fill_label=3, return_multilabel=True, num_workers=2
+    )
+
+    combined_arr = sitk.GetArrayViewFromImage(combined)
+    multilabel_arr = sitk.GetArrayViewFromImage(multilabel)
+    assert combined_arr.dtype == np.uint8 and multilabel_arr.dtype == np.uint8
+    expected = np.zeros(combined_arr.shape, dtype=np.uint8)
+    for i, mask in enumerate(masks):
+        expected[sitk.GetArrayViewFromImage(mask) > 0.5] = i + 1
+    np.testing.assert_array_equal(multilabel_arr, expected)
+    np.testing.assert_array_equal(combined_arr, np.where(expected > 0, 3, 0))
+    # the geometry of the first segmentation, read from its nifti header
+    for img in (combined, multilabel):
+        np.testing.assert_allclose(img.GetOrigin(), masks[0].GetOrigin(), atol=1e-5)
+        np.testing.assert_allclose(img.GetSpacing(), masks[0].GetSpacing(), atol=1e-5)
+
+
+def test_combine_segmentations_labels_and_reference():
+    masks = get_rib_masks(num_masks=3)
+    ref_img = sitk.Image(masks[0])
+    ref_img.SetOrigin((0.0, 0.0, 0.0))
+    combined, multilabel = combine_segmentations(
+        iter(masks), ref_img=ref_img, return_multilabel=True, labels=[11, 12, 13]
+    )
+    assert combined.GetOrigin() == (0.0, 0.0, 0.0)
+    assert sorted(np.unique(sitk.GetArrayViewFromImage(multilabel))) == [0, 11, 12, 13]
+    assert sorted(np.unique(sitk.GetArrayViewFromImage(combined))) == [0, 1]
+    with pytest.raises(ValueError):
+        combine_segmentations([])
+
+
+def test_segmentation_index_keeps_integer_labels():
+    # 300 would wrap around to 44 in uint8
+    seg_arr = np.zeros((10, 12, 14), dtype=np.int16)
+    seg_arr[1:4, 2:5, 3:6] = 44
+    seg_arr[6:9, 7:10, 8:12] = 300
+    seg = sitk.GetImageFromArray(seg_arr)
+    index = SegmentationIndex(seg)
+
+    fltr = sitk.LabelShapeStatisticsImageFilter()
+    fltr.Execute(seg)
+    assert index.GetLabels() == (44, 300)
+    for label in (44, 300):
+        assert index.GetBoundingBox(label) == fltr.GetBoundingBox(label)
+        assert index.GetNumberOfPixels(label) == fltr.GetNumberOfPixels(label)
+
+
+def test_change_label_truncates_float_labels():
+    seg = sitk.GetImageFromArray(np.array([[[0.2, 0.7, 1.4, 1.6, 2.5]]], dtype=np.float32))
+    changed = change_label(seg, {1: 5, 2: 6})
+    assert changed.GetPixelID() == sitk.sitkUInt8
+    np.testing.assert_array_equal(sitk.GetArrayViewFromImage(changed), [[[0, 0, 5, 5, 6]]])
@@ -0,0 +1,36 @@
+from conftest import get_test_volume
+from xrayto3d_preprocess import ioutils
+from xrayto3d_preprocess.ioutils import VolumeCache, read_image, volume_cache, write_image
+
+
+def test_volume_cache_eviction():
+    images = [get_test_volume(size=(10, 10, 10), offset=i) for i in range(3)]
+    nbytes = 10 * 10 * 10 * 2
+    cache = VolumeCache(max_bytes=2 * nbytes)
+    cache.put("a", images[0])
+    cache.put("b", images[1])
+    assert cache.get("a") is images[0]  # b is now least recently used
+    cache.put("c", images[2])
+    assert cache.get("b") is None
+    assert len(cache) == 2 and cache.nbytes == 2 * nbytes
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # images larger than the budget are not cached
+    cache.put("d", get_test_volume(size=(30, 20, 10)))
+    assert cache.get("d") is None and len(cache) == 2
+
+
+def test_volume_cache_invalidation(tmp_path):
+    img_path = str(tmp_path / "ct.nii.gz")
+    write_image(get_test_volume(size=(10, 10, 10)), img_path)
+    with volume_cache() as cache:
+        img = read_image(img_path)
+        # callers get a copy, modifying it does not change the cached image
+        img[0, 0, 0] = 1000
+        assert read_image(img_path)[0, 0, 0] == 0
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        write_image(get_test_volume(size=(10, 10, 10), offset=500), img_path)
+        assert len(cache) == 0
+        assert read_image(img_path)[0, 0, 0] == -500
+    assert ioutils.get_volume_cache() is None
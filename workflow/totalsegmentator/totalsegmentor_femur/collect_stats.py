@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from xrayto3d_preprocess import (
-    get_largest_connected_component,
+    get_largest_connected_components,
     get_nifti_stem,
     get_segmentation_stats,
     read_image,
@@ -30,37 +30,53 @@ def get_femur_position_from_filename(filepath) -> str:
 
 
 def get_subject_femur_stats(subject_seg_dir, femur_filenames):
+    """voxel count of the largest component of each femur and number of voxels outside of it"""
     full_paths = [str(Path(subject_seg_dir) / p) for p in femur_filenames]
 
     voxel_count = {}
+    removed_voxel_count = {}
     for sample_femur_path in full_paths:
         sample_femur = read_image(sample_femur_path)
-        sample_femur = get_largest_connected_component(
-            sample_femur
-        )  # some segmentations have islands of spurious segmentations
         stats_obj = get_segmentation_stats(sample_femur)
-        label_voxels = [stats_obj.GetNumberOfPixels(l) for l in stats_obj.GetLabels()]
+        # some segmentations have islands of spurious segmentations
+        _, removed_voxels = get_largest_connected_components(sample_femur, stats_obj)
+        label_voxels = [
+            stats_obj.GetNumberOfPixels(l) - removed_voxels[l]
+            for l in stats_obj.GetLabels()
+        ]
         femur_position = get_femur_position_from_filename(sample_femur_path)
         voxel_count[femur_position] = np.sum(label_voxels, dtype=np.int32)
-    return voxel_count
+        removed_voxel_count[femur_position] = np.sum(
+            list(removed_voxels.values()), dtype=np.int32
+        )
+    return voxel_count, removed_voxel_count
 
 
 def save_total_voxel_stats_for_whole_dataset(
     subjects_path, femur_filenames, stats_out_path
 ):
     femur_meta_dict = {}
+    femur_removed_voxels_dict = {}
     header = ["left", "right"]
+    removed_voxels_out_path = Path(stats_out_path).with_name("femur_removed_voxels.csv")
 
     for sample_subject_path in tqdm(subjects_path, total=len(subjects_path)):
         subject_seg_dir = f"{sample_subject_path}/segmentations"
 
         subject_id = str(Path(sample_subject_path).name)
-        voxel_count = get_subject_femur_stats(subject_seg_dir, femur_filenames)
+        voxel_count, removed_voxel_count = get_subject_femur_stats(
+            subject_seg_dir, femur_filenames
+        )
 
         femur_meta_dict[subject_id] = [voxel_count["left"], voxel_count["right"]]
+        femur_removed_voxels_dict[subject_id] = [
+            removed_voxel_count["left"],
+            removed_voxel_count["right"],
+        ]
 
         # overwrite csv once a new row of data is available
         write_csv(femur_meta_dict, header, stats_out_path)
+        write_csv(femur_removed_voxels_dict, header, removed_voxels_out_path)
 
 
 def analyze_stats(metadata_path):
@@ -51,9 +51,7 @@ def process_totalsegmentor_subject(
 ):
     full_paths = [str(Path(seg_dir) / p) for p in file_patterns]
 
-    seg_sitk = [read_image(p) for p in full_paths]
-
-    complete_seg_sitk = combine_segmentations(seg_sitk, seg_sitk[0], fill_label=1)
+    complete_seg_sitk = combine_segmentations(full_paths, fill_label=1)
 
     out_path = Path(ct_path).with_name(out_name)
 
@@ -45,11 +45,8 @@ def get_totalsegmentor_subjects(base_path: str) -> List[str]:
 def process_totalsegmentor_subject(ct_path, seg_dir, ribs_filenames):
     full_paths = [str(Path(seg_dir) / p) for p in ribs_filenames]
 
-    rib_seg_sitk = [read_image(p) for p in full_paths]
-
-    rib_complete_seg_sitk = combine_segmentations(
-        rib_seg_sitk, rib_seg_sitk[0], fill_label=1
-    )
+    # the rib masks are read and merged one by one
+    rib_complete_seg_sitk = combine_segmentations(full_paths, fill_label=1)
 
     stats_obj = get_segmentation_stats(rib_complete_seg_sitk)
 
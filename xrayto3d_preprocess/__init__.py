@@ -1,12 +1,18 @@
 from .config import *
 from .download_utils import *
+from .drr_utils import *
 from .enumutils import *
+from .gzip_utils import *
+from .header_index import *
 from .ioutils import *
+from .label_utils import *
 from .metadata_utils import *
 from .misc import *
 from .pathutils import *
 from .plot_utils import *
 from .preprocessing_utils import *
+from .raw_cache import *
 from .roi_utils import *
+from .shm_cache import *
 from .sitk_utils import *
 from .tuple_ops import *
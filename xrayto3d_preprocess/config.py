@@ -6,11 +6,15 @@ The detailed configuration of these modules may be shared across experiments
 and may be stored in a separate yaml file.
 These separate yaml are merged into main configuration with a special key '_load'
 """
+import json
+import os
 from pathlib import Path
-from typing import Any, Dict, Union, cast
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union, cast
 
 from omegaconf import DictConfig, ListConfig, OmegaConf
 
+from .ioutils import read_subject_list
+
 ConfigType = Union[DictConfig, ListConfig]
 
 
@@ -44,6 +48,123 @@ def to_dict(config: ConfigType) -> Dict[str, Any]:
     return dict_config
 
 
+# config entries that determine the extracted ROIs, configs that agree on these
+# read the same inputs and produce identical ROIs (they may differ in poses, output names/dirs)
+ROI_STAGE_KEYS = ("subjects.subject_basepath", "filename_convention.input", "ROI_properties")
+
+
+def get_roi_stage_key(config: ConfigType, stage_keys: Sequence[str] = ROI_STAGE_KEYS) -> str:
+    """hashable summary of the ROI stage of a config, see `group_configs_by_roi_stage`"""
+    stage = {}
+    for key in stage_keys:
+        value = OmegaConf.select(config, key)
+        if isinstance(value, (DictConfig, ListConfig)):
+            value = OmegaConf.to_container(value, resolve=True)
+        stage[key] = value
+    return json.dumps(stage, sort_keys=True, default=str)
+
+
+def group_configs_by_roi_stage(
+    configs: Sequence[ConfigType], stage_keys: Sequence[str] = ROI_STAGE_KEYS
+) -> List[List[ConfigType]]:
+    """group configs sharing an identical ROI stage, so that the ROIs are extracted once per group
+    groups and the configs within a group keep their input order
+    """
+    groups: Dict[str, List[ConfigType]] = {}
+    for config in configs:
+        groups.setdefault(get_roi_stage_key(config, stage_keys), []).append(config)
+    return list(groups.values())
+
+
+def get_output_paths(
+    config: ConfigType, outputs: Sequence[Tuple[str, str]], subject_id="{id}"
+) -> List[str]:
+    """paths of the files a script writes for subject_id, as built by the `generate_path` of the scripts
+    outputs: (out_directories key, filename_convention.output key) of every file written
+    """
+    out_dirs = config["out_directories"]
+    output_fileformat = config["filename_convention"]["output"]
+    derivatives_dir = os.path.join(
+        config["subjects"]["subject_basepath"], subject_id, out_dirs["derivatives"]
+    )
+    return [
+        os.path.normpath(
+            os.path.join(
+                derivatives_dir,
+                out_dirs[sub_dir],
+                output_fileformat[name].format(id=subject_id),
+            )
+        )
+        for sub_dir, name in outputs
+    ]
+
+
+def check_distinct_outputs(
+    configs: Sequence[ConfigType],
+    subject_sets: Sequence[Set],
+    outputs: Union[Sequence[Tuple[str, str]], Sequence[Sequence[Tuple[str, str]]]],
+    config_names: Optional[Sequence[str]] = None,
+):
+    """raise a ValueError if two configs write the same file for a subject they both list,
+    otherwise the config processed last would silently overwrite the outputs of the other
+    outputs: see `get_output_paths`, shared by all configs or one list per config (e.g. configs of different scripts)
+    """
+    if config_names is None:
+        config_names = [f"config {i}" for i in range(len(configs))]
+    if not outputs or isinstance(outputs[0][0], str):
+        outputs = [outputs] * len(configs)
+    writers: Dict[str, List[int]] = {}
+    for i, config in enumerate(configs):
+        for out_path in set(get_output_paths(config, outputs[i])):
+            for j in writers.setdefault(out_path, []):
+                shared_subjects = subject_sets[i] & subject_sets[j]
+                if shared_subjects:
+                    raise ValueError(
+                        f"{config_names[j]} and {config_names[i]} both write {out_path} "
+                        f"for {len(shared_subjects)} subjects, "
+                        "give them different out_directories or filename conventions"
+                    )
+            writers[out_path].append(i)
+
+
+def load_config_groups(
+    config_files: Sequence[str], outputs: Sequence[Tuple[str, str]]
+) -> List[List[Tuple[ConfigType, Set]]]:
+    """configs grouped by their ROI stage (see `group_configs_by_roi_stage`), each with the set of subjects it lists
+    outputs: the files the script writes per subject, see `get_output_paths`
+    raises a ValueError if two configs would write the same files
+    """
+    configs = [read_config_and_load_components(f) for f in config_files]
+    subject_sets = [
+        set(read_subject_list(config["subjects"]["subject_list"]).flatten())
+        for config in configs
+    ]
+    check_distinct_outputs(configs, subject_sets, outputs, config_files)
+    subjects_of = {id(config): subjects for config, subjects in zip(configs, subject_sets)}
+    return [
+        [(config, subjects_of[id(config)]) for config in group]
+        for group in group_configs_by_roi_stage(configs)
+    ]
+
+
+def get_output_dtype(
+    config: ConfigType, name: str
+) -> Optional[Union[str, Dict[str, Any]]]:
+    """dtype policy of the output `name`, None if the config does not set one
+    e.g.
+    filename_convention:
+      output_dtype:
+        ct_roi: int16
+        seg_roi: uint8
+        vert_centroid: {dtype: uint8, scale: 2.5}
+    see `cast_to_output_dtype`
+    """
+    output_dtype = OmegaConf.select(config, f"filename_convention.output_dtype.{name}")
+    if isinstance(output_dtype, DictConfig):
+        output_dtype = OmegaConf.to_container(output_dtype, resolve=True)
+    return output_dtype
+
+
 if __name__ == "__main__":
     test_configpath = "configs/test/LIDC-DRR-test.yaml"
     config_dict = read_config_and_load_components(test_configpath)
@@ -0,0 +1,465 @@
+"""digitally reconstructed radiograph (DRR) utils
+- in-process Siddon-Jacobs ray casting of a CT ROI
+- cached sparse projection operators for a fixed ROI/pose geometry
+- closed form DRR of a gaussian centroid landmark
+
+The geometry mirrors the defaults of the DRRSiddonJacobs tool:
+- the volume is rotated about its centre by (rx, ry, rz) degrees (Euler angles, ZYX order)
+- the focal point sits `scd` mm in front of the isocentre, the rays travel along +y
+- the virtual detector of `size` x `size` pixels at `res` mm passes through the isocentre
+- only intensities above `threshold` contribute to the line integral
+The volume is traced in its own index space (scaled by spacing),
+the direction cosines are ignored just like the external tool does.
+"""
+import hashlib
+import math
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse
+import SimpleITK as sitk
+
+from .enumutils import ProjectionType
+
+DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE = 1000.0  # mm, `-scd` of DRRSiddonJacobs
+DEFAULT_THRESHOLD = 0.0  # `-threshold` of DRRSiddonJacobs
+MAX_INTERSECTIONS_PER_CHUNK = 2**22  # bound the temporary arrays of the vectorized ray casting
+OPERATOR_MEMORY_CACHE_SIZE = 4  # projection operators kept in memory per process
+
+
+def get_orientation_key(projection_type: ProjectionType) -> str:
+    """ProjectionType.AP -> 'ap', ProjectionType.LAT -> 'lat'"""
+    return "ap" if projection_type == ProjectionType.AP else "lat"
+
+
+def get_euler_zyx_matrix(rx, ry, rz) -> np.ndarray:
+    """rotation matrix R = Rz @ Ry @ Rx, angles in degrees (itk.Euler3DTransform with ComputeZYX)"""
+    # constant for converting degrees to radians
+    dtr = math.atan(1.0) * 4.0 / 180.0
+    cx, sx = math.cos(dtr * rx), math.sin(dtr * rx)
+    cy, sy = math.cos(dtr * ry), math.sin(dtr * ry)
+    cz, sz = math.cos(dtr * rz), math.sin(dtr * rz)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rot_z @ rot_y @ rot_x
+
+
+def get_detector_points(size, res) -> np.ndarray:
+    """physical coordinates (in the beam frame) of the detector pixel centres, shape (size*size, 3)
+    row 0 of the DRR is at +z, column 0 at -x
+    """
+    offsets = (np.arange(size) - (size - 1) / 2.0) * res
+    v, u = np.meshgrid(-offsets, offsets, indexing="ij")
+    return np.stack(
+        [u.ravel(), np.zeros(size * size), v.ravel()], axis=1
+    )
+
+
+def get_ray_endpoints(
+    volume_size,
+    spacing,
+    rotation,
+    size,
+    res,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """return the focal point and the detector pixel centres in volume coordinates
+    volume coordinates: voxel (i,j,k) occupies [i*sx,(i+1)*sx) x [j*sy,(j+1)*sy) x [k*sz,(k+1)*sz)
+    """
+    isocenter = np.asarray(volume_size, dtype=float) * np.asarray(spacing) / 2.0
+    rotation = np.asarray(rotation)
+    # beam frame -> volume frame is the inverse (transpose) of the volume rotation
+    focal_point = rotation.T @ np.array([0.0, -scd, 0.0]) + isocenter
+    detector = get_detector_points(size, res) @ rotation + isocenter
+    return focal_point, detector
+
+
+def siddon_jacobs_intersections(volume_size, spacing, focal_point, targets):
+    """Siddon-Jacobs ray/voxel intersections of the rays `focal_point` -> `targets` (extended beyond the target)
+
+    Args:
+        volume_size (tuple): (nx, ny, nz) in voxels
+        spacing (tuple): (sx, sy, sz) in mm
+        focal_point (np.ndarray): (3,) ray source in volume coordinates
+        targets (np.ndarray): (M,3) a point on each ray in volume coordinates
+
+    Returns:
+        ray_ids, voxel_ids, lengths: flat arrays describing every traversed ray segment
+        voxel_ids index the C-ordered (z,y,x) array returned by sitk.GetArrayViewFromImage
+    """
+    volume_size = np.asarray(volume_size, dtype=np.int64)
+    spacing = np.asarray(spacing, dtype=float)
+    extent = volume_size * spacing
+    direction = np.asarray(targets, dtype=float) - focal_point  # (M,3)
+
+    # parametric values where the ray enters/leaves the slab of each axis
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha_lo = (0.0 - focal_point) / direction
+        alpha_hi = (extent - focal_point) / direction
+    parallel = direction == 0
+    inside = (focal_point >= 0) & (focal_point <= extent)
+    alpha_lo = np.where(parallel, np.where(inside, -np.inf, np.inf), alpha_lo)
+    alpha_hi = np.where(parallel, np.where(inside, np.inf, -np.inf), alpha_hi)
+    alpha_min = np.maximum(
+        np.max(np.minimum(alpha_lo, alpha_hi), axis=1), 0.0
+    )
+    alpha_max = np.min(np.maximum(alpha_lo, alpha_hi), axis=1)
+
+    # crossings with every plane of every axis, clipped to the traversed interval
+    plane_alphas = []
+    for axis in range(3):
+        planes = np.arange(volume_size[axis] + 1) * spacing[axis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            alphas = (planes[None, :] - focal_point[axis]) / direction[:, axis, None]
+        alphas[parallel[:, axis]] = np.inf
+        plane_alphas.append(alphas)
+    alphas = np.concatenate(
+        [alpha_min[:, None], *plane_alphas, alpha_max[:, None]], axis=1
+    )
+    alphas = np.clip(alphas, alpha_min[:, None], alpha_max[:, None])
+    alphas.sort(axis=1)
+
+    # each pair of consecutive crossings delimits the segment within a single voxel
+    ray_length = np.linalg.norm(direction, axis=1)
+    lengths = np.diff(alphas, axis=1) * ray_length[:, None]
+    midpoints = (alphas[:, 1:] + alphas[:, :-1]) / 2.0
+    ray_ids, segment_ids = np.nonzero(lengths > 1e-9)
+    mid = midpoints[ray_ids, segment_ids]
+    position = focal_point + mid[:, None] * direction[ray_ids]
+    voxel = np.floor(position / spacing).astype(np.int64)
+    voxel = np.minimum(np.maximum(voxel, 0), volume_size - 1)
+    voxel_ids = (voxel[:, 2] * volume_size[1] + voxel[:, 1]) * volume_size[0] + voxel[:, 0]
+    return ray_ids, voxel_ids, lengths[ray_ids, segment_ids]
+
+
+def iterate_ray_chunks(volume_size, num_rays):
+    """yield slices over the rays so that a chunk holds at most MAX_INTERSECTIONS_PER_CHUNK crossings"""
+    crossings_per_ray = int(np.sum(volume_size)) + 5
+    chunk = max(1, MAX_INTERSECTIONS_PER_CHUNK // crossings_per_ray)
+    for start in range(0, num_rays, chunk):
+        yield slice(start, min(start + chunk, num_rays))
+
+
+def get_pose(config, orientation: str) -> Tuple[float, float, float]:
+    """(rx, ry, rz) of the given view of the xray_pose config"""
+    return (
+        config[orientation]["rx"],
+        config[orientation]["ry"],
+        config[orientation]["rz"],
+    )
+
+
+def get_attenuation_volume(img: sitk.Image, threshold=DEFAULT_THRESHOLD) -> np.ndarray:
+    """flattened (value - threshold), zero for voxels at or below threshold"""
+    arr = sitk.GetArrayViewFromImage(img).astype(np.float64).ravel()
+    arr -= threshold
+    np.maximum(arr, 0.0, out=arr)
+    return arr
+
+
+def cast_rays(
+    attenuation: np.ndarray,
+    volume_size,
+    spacing,
+    rotation,
+    size,
+    res,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+) -> np.ndarray:
+    """return the (size, size) line integrals of the flattened `attenuation` volume rotated by `rotation`"""
+    focal_point, detector = get_ray_endpoints(
+        volume_size, spacing, rotation, size, res, scd
+    )
+    projection = np.zeros(len(detector))
+    for chunk in iterate_ray_chunks(volume_size, len(detector)):
+        ray_ids, voxel_ids, lengths = siddon_jacobs_intersections(
+            volume_size, spacing, focal_point, detector[chunk]
+        )
+        projection[chunk] = np.bincount(
+            ray_ids,
+            weights=lengths * attenuation[voxel_ids],
+            minlength=chunk.stop - chunk.start,
+        )
+    return projection.reshape(size, size)
+
+
+def siddon_jacobs_projection(
+    img: sitk.Image,
+    rotation,
+    size,
+    res,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+    threshold=DEFAULT_THRESHOLD,
+) -> np.ndarray:
+    """return the (size, size) line integrals of `img` rotated by `rotation` (3x3 matrix)"""
+    return cast_rays(
+        get_attenuation_volume(img, threshold),
+        img.GetSize(),
+        img.GetSpacing(),
+        rotation,
+        size,
+        res,
+        scd,
+    )
+
+
+def get_projection_operator_key(volume_size, spacing, pose, size, res, scd) -> str:
+    """hash identifying the ray/voxel geometry of a projection operator"""
+    geometry = (
+        tuple(int(sz) for sz in volume_size),
+        tuple(round(float(sp), 6) for sp in spacing),
+        tuple(round(float(angle), 6) for angle in pose),
+        int(size),
+        round(float(res), 6),
+        round(float(scd), 6),
+    )
+    return hashlib.sha1(repr(geometry).encode()).hexdigest()[:16]
+
+
+def build_projection_operator(
+    volume_size, spacing, pose, size, res, scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE
+) -> scipy.sparse.csr_matrix:
+    """sparse (size*size, num_voxels) matrix of ray/voxel intersection lengths
+    DRR = operator @ attenuation, see `get_attenuation_volume`
+    """
+    focal_point, detector = get_ray_endpoints(
+        volume_size, spacing, get_euler_zyx_matrix(*pose), size, res, scd
+    )
+    rows, cols, data = [], [], []
+    for chunk in iterate_ray_chunks(volume_size, len(detector)):
+        ray_ids, voxel_ids, lengths = siddon_jacobs_intersections(
+            volume_size, spacing, focal_point, detector[chunk]
+        )
+        rows.append((ray_ids + chunk.start).astype(np.int32))
+        cols.append(voxel_ids.astype(np.int32))
+        data.append(lengths.astype(np.float32))
+    num_voxels = int(np.prod(volume_size))
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(detector), num_voxels),
+    )
+
+
+@lru_cache(maxsize=OPERATOR_MEMORY_CACHE_SIZE)
+def _get_projection_operator(volume_size, spacing, pose, size, res, scd, cache_dir):
+    """memoized in-memory, persisted in `cache_dir` (if given)"""
+    if cache_dir is None:
+        return build_projection_operator(volume_size, spacing, pose, size, res, scd)
+
+    key = get_projection_operator_key(volume_size, spacing, pose, size, res, scd)
+    operator_path = Path(cache_dir) / f"drr_operator_{key}.npz"
+    if operator_path.exists():
+        return scipy.sparse.load_npz(operator_path).tocsr()
+
+    operator = build_projection_operator(volume_size, spacing, pose, size, res, scd)
+    operator_path.parent.mkdir(exist_ok=True, parents=True)
+    # several workers may build the same operator, write to a temporary file and rename atomically
+    tmp_path = operator_path.with_name(f"{operator_path.stem}.{os.getpid()}.tmp.npz")
+    scipy.sparse.save_npz(tmp_path, operator)
+    os.replace(tmp_path, operator_path)
+    return operator
+
+
+def get_projection_operator(
+    volume_size,
+    spacing,
+    pose,
+    size,
+    res,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+    cache_dir=None,
+) -> scipy.sparse.csr_matrix:
+    """return the projection operator for the given (ROI shape, spacing, pose, detector size/res)
+    built once per process and, if `cache_dir` is given, once per cache directory.
+    The DRR helpers only use operators when a `cache_dir` is given,
+    otherwise they cast the rays directly and keep no operator in memory
+    """
+    return _get_projection_operator(
+        tuple(int(sz) for sz in volume_size),
+        tuple(float(sp) for sp in spacing),
+        tuple(float(angle) for angle in pose),
+        int(size),
+        float(res),
+        float(scd),
+        None if cache_dir is None else str(cache_dir),
+    )
+
+
+def project_volumes(
+    operator: scipy.sparse.csr_matrix,
+    imgs: Sequence[sitk.Image],
+    size,
+    threshold=DEFAULT_THRESHOLD,
+) -> List[np.ndarray]:
+    """DRRs of several ROIs of identical geometry with one sparse matrix x stacked volumes product"""
+    attenuation = np.stack(
+        [get_attenuation_volume(img, threshold) for img in imgs], axis=1
+    )
+    if attenuation.shape[0] != operator.shape[1]:
+        raise ValueError(
+            f"ROI with {attenuation.shape[0]} voxels does not match projection operator {operator.shape}"
+        )
+    projections = operator @ attenuation
+    return [projections[:, i].reshape(size, size) for i in range(len(imgs))]
+
+
+def generate_drrs(
+    imgs: Sequence[sitk.Image],
+    projection_type: ProjectionType,
+    config,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+    threshold=DEFAULT_THRESHOLD,
+    cache_dir: Optional[str] = None,
+) -> List[np.ndarray]:
+    """return the DRRs of a batch of in-memory CT ROIs sharing size and spacing
+    the projection operator is reused from memory or `cache_dir`
+    """
+    if len(imgs) == 0:
+        return []
+    volume_size, spacing = imgs[0].GetSize(), imgs[0].GetSpacing()
+    operator = get_projection_operator(
+        volume_size,
+        spacing,
+        get_pose(config, get_orientation_key(projection_type)),
+        config["size"],
+        config["res"],
+        scd,
+        cache_dir,
+    )
+    return project_volumes(operator, imgs, config["size"], threshold)
+
+
+def generate_drr(
+    img: sitk.Image,
+    projection_type: ProjectionType,
+    config,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+    threshold=DEFAULT_THRESHOLD,
+    cache_dir: Optional[str] = None,
+) -> np.ndarray:
+    """return the DRR of an in-memory CT ROI for the given view of the `xray_pose` config
+    (rx/ry/rz of config['ap'] or config['lat'], config['res'], config['size'])
+    if `cache_dir` is given, the DRR is computed with the cached projection operator,
+    otherwise the rays are cast on every call (building an operator for one DRR costs more)
+    """
+    if cache_dir is not None:
+        return generate_drrs([img], projection_type, config, scd, threshold, cache_dir)[0]
+    rotation = get_euler_zyx_matrix(*get_pose(config, get_orientation_key(projection_type)))
+    return siddon_jacobs_projection(
+        img, rotation, config["size"], config["res"], scd, threshold
+    )
+
+
+def normalize_pose(pose) -> Tuple[float, float, float]:
+    """(rx, ry, rz) rounded so that numerically identical poses compare equal"""
+    return tuple(round(float(angle), 6) for angle in pose)
+
+
+def generate_drr_sweep(
+    img: sitk.Image,
+    poses: Sequence[Tuple[float, float, float]],
+    size,
+    res,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+    threshold=DEFAULT_THRESHOLD,
+    cache_dir: Optional[str] = None,
+) -> List[np.ndarray]:
+    """return one DRR per (rx, ry, rz) pose of `poses`, all rendered from a single attenuation volume
+    identical poses are rendered once. With `cache_dir`, the projection operators of all poses
+    are stacked and applied in a single sparse product.
+    """
+    unique_poses = list(dict.fromkeys(normalize_pose(pose) for pose in poses))
+    attenuation = get_attenuation_volume(img, threshold)
+    volume_size, spacing = img.GetSize(), img.GetSpacing()
+
+    if cache_dir is not None:
+        operator = scipy.sparse.vstack(
+            [
+                get_projection_operator(
+                    volume_size, spacing, pose, size, res, scd, cache_dir
+                )
+                for pose in unique_poses
+            ],
+            format="csr",
+        )
+        projections = list((operator @ attenuation).reshape(-1, size, size))
+    else:
+        projections = [
+            cast_rays(
+                attenuation,
+                volume_size,
+                spacing,
+                get_euler_zyx_matrix(*pose),
+                size,
+                res,
+                scd,
+            )
+            for pose in unique_poses
+        ]
+    drr_per_pose = dict(zip(unique_poses, projections))
+    return [drr_per_pose[normalize_pose(pose)] for pose in poses]
+
+
+def project_gaussian_landmark(
+    point,
+    sigma,
+    volume_size,
+    spacing,
+    rotation,
+    size,
+    res,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+) -> np.ndarray:
+    """closed form (size, size) DRR of an isotropic 3D gaussian centred at `point` (volume coordinates)
+    the line integral of the gaussian along a ray at distance d from its centre is
+    sqrt(2 pi) sigma exp(-d^2 / (2 sigma^2)), so the perspective magnification comes for free
+    """
+    focal_point, detector = get_ray_endpoints(
+        volume_size, spacing, rotation, size, res, scd
+    )
+    direction = detector - focal_point
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    offset = np.asarray(point, dtype=float) - focal_point
+    along = direction @ offset
+    squared_distances = np.maximum(offset @ offset - along * along, 0.0)
+    projection = (
+        math.sqrt(2 * math.pi) * sigma * np.exp(-squared_distances / (2 * sigma**2))
+    )
+    return projection.reshape(size, size)
+
+
+def generate_landmark_drr(
+    centroid_index,
+    sigma,
+    reference: sitk.Image,
+    projection_type: ProjectionType,
+    config,
+    scd=DEFAULT_FOCAL_POINT_TO_ISOCENTER_DISTANCE,
+) -> np.ndarray:
+    """return the DRR of the gaussian heatmap centred at `centroid_index` of the `reference` ROI
+    without rendering the heatmap volume, see `roi_utils.generate_gaussian_heatmap`
+    """
+    spacing = np.asarray(reference.GetSpacing())
+    point = (np.asarray(centroid_index, dtype=float) + 0.5) * spacing
+    rotation = get_euler_zyx_matrix(*get_pose(config, get_orientation_key(projection_type)))
+    return project_gaussian_landmark(
+        point,
+        sigma,
+        reference.GetSize(),
+        spacing,
+        rotation,
+        config["size"],
+        config["res"],
+        scd,
+    )
+
+
+def drr_to_image(drr: np.ndarray, res) -> sitk.Image:
+    """rescale DRR line integrals to an 8-bit image like DRRSiddonJacobs"""
+    drr_img = sitk.GetImageFromArray(drr)
+    drr_img.SetSpacing((res, res))
+    return sitk.Cast(sitk.RescaleIntensity(drr_img), sitk.sitkUInt8)
@@ -0,0 +1,136 @@
+"""multi-member gzip compression on a thread pool
+
+The stream is split into blocks of `block_size` uncompressed bytes, each compressed into an
+independent gzip member. Concatenated members form a valid gzip file (RFC 1952) that gzip, zlib,
+nibabel and itk read as one stream. zlib releases the GIL while compressing, so blocks are
+compressed in parallel by threads.
+
+The offsets of the members can be saved in a json sidecar, a reader can then decompress
+only the members covering a byte range, see `read_gzip_range`.
+"""
+import bisect
+import gzip
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+GZIP_BLOCKS_SUFFIX = ".gzblocks"
+DEFAULT_GZIP_BLOCK_SIZE = 2**22  # uncompressed bytes per gzip member
+DEFAULT_GZIP_COMPRESSLEVEL = 6  # zlib default, also used by itk
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # zlib window bits of a gzip member
+
+
+def get_gzip_blocks_path(gz_path) -> str:
+    """member offsets of a multi-member gzip file are stored next to it, e.g. ct.nii.gz.gzblocks"""
+    return f"{gz_path}{GZIP_BLOCKS_SUFFIX}"
+
+
+def compress_gzip_blocks(
+    data,
+    compresslevel=DEFAULT_GZIP_COMPRESSLEVEL,
+    block_size=DEFAULT_GZIP_BLOCK_SIZE,
+    num_workers: Optional[int] = None,
+) -> Tuple[List[bytes], List[Tuple[int, int]]]:
+    """compress data into independent gzip members
+
+    Returns:
+        compressed members and the (compressed offset, uncompressed offset) of each member
+    """
+    data = memoryview(data).cast("B")
+    blocks = [data[start : start + block_size] for start in range(0, len(data), block_size)]
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        members = list(
+            executor.map(lambda block: gzip.compress(block, compresslevel, mtime=0), blocks)
+        )
+
+    offsets = []
+    compressed_offset = 0
+    for i, member in enumerate(members):
+        offsets.append((compressed_offset, i * block_size))
+        compressed_offset += len(member)
+    return members, offsets
+
+
+def write_gzip_blocks(
+    data,
+    out_path,
+    compresslevel=DEFAULT_GZIP_COMPRESSLEVEL,
+    block_size=DEFAULT_GZIP_BLOCK_SIZE,
+    num_workers: Optional[int] = None,
+    write_block_offsets=False,
+):
+    """write data as a multi-member gzip file, see `compress_gzip_blocks`
+    the file is written next to out_path and renamed, readers never see a partial file.
+    If write_block_offsets, the member offsets are saved in the `get_gzip_blocks_path` sidecar,
+    otherwise a sidecar left by a previous write is removed
+    """
+    out_path = str(out_path)
+    members, offsets = compress_gzip_blocks(data, compresslevel, block_size, num_workers)
+
+    tmp_path = f"{out_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as out_file:
+        for member in members:
+            out_file.write(member)
+    os.replace(tmp_path, out_path)
+
+    blocks_path = get_gzip_blocks_path(out_path)
+    if write_block_offsets:
+        blocks = {
+            "block_size": block_size,
+            "compressed_size": sum(len(member) for member in members),
+            "uncompressed_size": len(memoryview(data).cast("B")),
+            "members": offsets,
+        }
+        with open(blocks_path, "w") as blocks_file:
+            json.dump(blocks, blocks_file)
+    elif os.path.exists(blocks_path):
+        os.remove(blocks_path)
+
+
+def load_gzip_blocks(gz_path) -> Optional[Dict]:
+    """member offsets of gz_path, None if there is no sidecar or the file was rewritten since"""
+    gz_path = str(gz_path)
+    blocks_path = get_gzip_blocks_path(gz_path)
+    if not os.path.exists(blocks_path):
+        return None
+    if os.stat(blocks_path).st_mtime_ns < os.stat(gz_path).st_mtime_ns:
+        return None
+    with open(blocks_path) as blocks_file:
+        blocks = json.load(blocks_file)
+    if blocks["compressed_size"] != os.path.getsize(gz_path):
+        return None
+    return blocks
+
+
+def read_gzip_range(gz_path, blocks: Dict, start: int, stop: int) -> bytes:
+    """uncompressed bytes [start, stop) of a multi-member gzip file,
+    only the members overlapping the range are read and decompressed
+    """
+    stop = min(stop, blocks["uncompressed_size"])
+    if start >= stop:
+        return b""
+    uncompressed_offsets = [offset for _, offset in blocks["members"]]
+    first = bisect.bisect_right(uncompressed_offsets, start) - 1
+    last = bisect.bisect_left(uncompressed_offsets, stop) - 1
+
+    # member boundaries relative to the first member read
+    compressed_offsets = [offset for offset, _ in blocks["members"][first : last + 1]]
+    compressed_offsets.append(
+        blocks["members"][last + 1][0]
+        if last + 1 < len(blocks["members"])
+        else blocks["compressed_size"]
+    )
+    with open(gz_path, "rb") as gz_file:
+        gz_file.seek(compressed_offsets[0])
+        compressed = memoryview(gz_file.read(compressed_offsets[-1] - compressed_offsets[0]))
+    bounds = [offset - compressed_offsets[0] for offset in compressed_offsets]
+    # members are decompressed one by one, gzip.decompress of concatenated members is much slower
+    data = b"".join(
+        zlib.decompress(compressed[lo:up], GZIP_WBITS)
+        for lo, up in zip(bounds[:-1], bounds[1:])
+    )
+
+    member_start = uncompressed_offsets[first]
+    return data[start - member_start : stop - member_start]
@@ -0,0 +1,223 @@
+"""persistent index of image headers of a dataset tree
+
+The size, spacing, origin, direction, pixel type and orientation of every volume are
+read once (header only, in parallel) and stored in a sqlite file next to the dataset.
+An entry is keyed by the resolved path and is refreshed when the file's mtime or size changes,
+so planning, statistics and scheduling can query the geometry of the dataset without opening files.
+
+e.g.
+    with build_header_index("2D-3D-Reconstruction-Datasets/verse19/subjectwise", "*_ct.nii.gz") as index:
+        df = index.to_dataframe()
+        large_scans = index.records("num_voxels > ?", (512**3,))
+"""
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from .ioutils import ImageHeader
+from .metadata_utils import (
+    get_metadata,
+    get_orientation_code_itk,
+    get_orientation_code_nifti_from_direction,
+)
+
+HEADER_INDEX_FILENAME = ".header_index.sqlite"
+
+_HEADER_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    dimension INTEGER NOT NULL,
+    size TEXT NOT NULL,
+    spacing TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    num_voxels INTEGER NOT NULL,
+    pixel_id INTEGER NOT NULL,
+    pixel_type TEXT NOT NULL,
+    axcode TEXT NOT NULL,
+    axcode_nifti TEXT NOT NULL
+)
+"""
+
+# columns holding json encoded tuples
+_TUPLE_COLUMNS = ("size", "spacing", "origin", "direction")
+
+
+def _get_file_key(img_path: str):
+    stat = os.stat(img_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_header_record(img_path) -> Dict:
+    """header of img_path as a row of the header index, without reading the pixels"""
+    img_path = str(Path(img_path).resolve())
+    mtime_ns, file_size = _get_file_key(img_path)
+    reader = get_metadata(img_path)
+    direction = reader.GetDirection()
+    return {
+        "path": img_path,
+        "mtime_ns": mtime_ns,
+        "file_size": file_size,
+        "dimension": reader.GetDimension(),
+        "size": reader.GetSize(),
+        "spacing": reader.GetSpacing(),
+        "origin": reader.GetOrigin(),
+        "direction": direction,
+        "num_voxels": int(np.prod(reader.GetSize())),
+        "pixel_id": reader.GetPixelID(),
+        "pixel_type": sitk.GetPixelIDValueAsString(reader.GetPixelID()),
+        "axcode": get_orientation_code_itk(direction),
+        "axcode_nifti": get_orientation_code_nifti_from_direction(direction),
+    }
+
+
+class HeaderIndex:
+    """sqlite backed index of image headers, see `build_header_index`"""
+
+    def __init__(self, index_path):
+        self.index_path = str(index_path)
+        self._connection = sqlite3.connect(self.index_path)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute(_HEADER_INDEX_SCHEMA)
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> Dict:
+        record = dict(row)
+        for column in _TUPLE_COLUMNS:
+            record[column] = tuple(json.loads(record[column]))
+        return record
+
+    def _get_row(self, img_path: str) -> Optional[sqlite3.Row]:
+        return self._connection.execute(
+            "SELECT * FROM headers WHERE path = ?", (img_path,)
+        ).fetchone()
+
+    def is_fresh(self, img_path) -> bool:
+        """is the entry of img_path up to date with the file on disk"""
+        img_path = str(Path(img_path).resolve())
+        row = self._get_row(img_path)
+        if row is None or not os.path.exists(img_path):
+            return False
+        return (row["mtime_ns"], row["file_size"]) == _get_file_key(img_path)
+
+    def update(self, img_paths: Iterable, num_workers=8) -> int:
+        """read the headers of new and modified files in a thread pool
+
+        Returns:
+            number of entries (re)read
+        """
+        stale_paths = [
+            str(Path(p).resolve()) for p in img_paths if not self.is_fresh(p)
+        ]
+        if not stale_paths:
+            return 0
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            records = list(executor.map(read_header_record, stale_paths))
+        self._connection.executemany(
+            """INSERT OR REPLACE INTO headers VALUES (
+            :path, :mtime_ns, :file_size, :dimension, :size, :spacing, :origin, :direction,
+            :num_voxels, :pixel_id, :pixel_type, :axcode, :axcode_nifti)""",
+            [
+                {
+                    **record,
+                    **{column: json.dumps(record[column]) for column in _TUPLE_COLUMNS},
+                }
+                for record in records
+            ],
+        )
+        self._connection.commit()
+        return len(records)
+
+    def prune(self) -> int:
+        """remove the entries of files that no longer exist
+
+        Returns:
+            number of entries removed
+        """
+        missing_paths = [
+            (row["path"],)
+            for row in self._connection.execute("SELECT path FROM headers")
+            if not os.path.exists(row["path"])
+        ]
+        self._connection.executemany("DELETE FROM headers WHERE path = ?", missing_paths)
+        self._connection.commit()
+        return len(missing_paths)
+
+    def get(self, img_path) -> Optional[Dict]:
+        """header record of img_path, None if it is not indexed or the file changed since"""
+        if not self.is_fresh(img_path):
+            return None
+        return self._decode(self._get_row(str(Path(img_path).resolve())))
+
+    def get_header(self, img_path) -> Optional[ImageHeader]:
+        """`ImageHeader` of img_path, can be passed to the ROI helpers in place of the image"""
+        record = self.get(img_path)
+        if record is None:
+            return None
+        return ImageHeader(
+            record["size"],
+            record["spacing"],
+            record["origin"],
+            record["direction"],
+            record["pixel_id"],
+        )
+
+    def records(self, where: Optional[str] = None, params: Sequence = ()) -> List[Dict]:
+        """header records, optionally filtered by an sql condition on the columns
+        e.g. index.records("axcode != ? AND num_voxels > ?", ("PIR", 10**8))
+        """
+        query = "SELECT * FROM headers"
+        if where:
+            query += f" WHERE {where}"
+        return [
+            self._decode(row) for row in self._connection.execute(query, tuple(params))
+        ]
+
+    def to_dataframe(self, where: Optional[str] = None, params: Sequence = ()) -> pd.DataFrame:
+        """header records as a dataframe, with one column per axis for size, spacing and origin"""
+        df = pd.DataFrame.from_records(self.records(where, params))
+        if len(df) == 0:
+            return df
+        for column in ("size", "spacing", "origin"):
+            axes = pd.DataFrame(df[column].tolist(), index=df.index)
+            axes.columns = [f"{column}_{i}" for i in axes.columns]
+            df = pd.concat([df, axes], axis=1)
+        return df
+
+
+def build_header_index(
+    dataset_dir, pattern="*.nii.gz", index_path=None, num_workers=8, prune=True
+) -> HeaderIndex:
+    """index the headers of all files under dataset_dir matching pattern
+    only files that are new or changed since the last call are read.
+    index_path defaults to `HEADER_INDEX_FILENAME` inside dataset_dir
+    """
+    if index_path is None:
+        index_path = Path(dataset_dir) / HEADER_INDEX_FILENAME
+    index = HeaderIndex(index_path)
+    if prune:
+        index.prune()
+    index.update(sorted(Path(dataset_dir).rglob(pattern)), num_workers=num_workers)
+    return index
@@ -1,9 +1,19 @@
 """i/o utils
 - read/write volume
 - read centroid
+- read/write centroid landmark sidecar
+- read image header, lazy ct/seg loading
+- opt-in LRU cache of read volumes, node-wide shared memory and raw on-disk caches
+- read a region of a volume without decompressing the whole file
+- parallel gzip compression of nifti outputs
 """
+import io
 import json
 import logging
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Tuple, Sequence
 from typing import Dict, List, Optional
@@ -15,6 +25,23 @@ import numpy as np
 import SimpleITK as sitk
 import yaml
 
+from .gzip_utils import (
+    DEFAULT_GZIP_BLOCK_SIZE,
+    DEFAULT_GZIP_COMPRESSLEVEL,
+    load_gzip_blocks,
+    read_gzip_range,
+    write_gzip_blocks,
+)
+from .metadata_utils import get_metadata
+from .raw_cache import get_raw_cache_dir, read_raw_cached_image, read_raw_cached_region
+from .shm_cache import get_shm_cache_socket, read_shm_cached_image, read_shm_cached_region
+
+try:
+    # optional: seek point indices of .nii.gz files, see `build_gzip_index`
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
 
 def read_nibabel(image_path):
     """read volume using nibabel"""
@@ -76,8 +103,137 @@ def load_centroids(ctd_path) -> Tuple[Sequence, Sequence]:
     return direction, ctd_list
 
 
+def load_landmark(landmark_path) -> Dict:
+    """loads the json sidecar of a centroid landmark, see `roi_utils.get_centroid_landmark`"""
+    with open(landmark_path) as json_data:
+        return json.load(json_data)
+
+
+def write_landmark(landmark: Dict, out_path):
+    """save centroid landmark (physical coordinates and sigma of the gaussian heatmap) as json"""
+    with open(out_path, "w") as json_data:
+        json.dump(landmark, json_data, indent=2)
+
+
+DEFAULT_VOLUME_CACHE_BYTES = 2**30
+
+
+def get_image_nbytes(img: sitk.Image) -> int:
+    """memory taken by the pixel buffer of img"""
+    return (
+        img.GetNumberOfPixels()
+        * img.GetNumberOfComponentsPerPixel()
+        * img.GetSizeOfPixelComponent()
+    )
+
+
+class VolumeCache:
+    """LRU cache of the images read by `read_image`, keyed by (resolved path, mtime, file size)
+    so that a file rewritten on disk is read again. Least recently used images are evicted
+    once the cached pixels take more than `max_bytes`, an image larger than `max_bytes` is not cached.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_VOLUME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images: "OrderedDict[tuple, sitk.Image]" = OrderedDict()
+
+    @staticmethod
+    def get_key(img_path: str) -> tuple:
+        stat = os.stat(img_path)
+        return img_path, stat.st_mtime_ns, stat.st_size
+
+    def get(self, key) -> Optional[sitk.Image]:
+        img = self._images.get(key)
+        if img is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._images.move_to_end(key)
+        return img
+
+    def put(self, key, img: sitk.Image):
+        nbytes = get_image_nbytes(img)
+        if nbytes > self.max_bytes:
+            return
+        self.pop(key)
+        self._images[key] = img
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.nbytes -= get_image_nbytes(evicted)
+
+    def pop(self, key):
+        img = self._images.pop(key, None)
+        if img is not None:
+            self.nbytes -= get_image_nbytes(img)
+
+    def invalidate(self, img_path: str):
+        """drop every cached version of img_path, e.g. when it is overwritten"""
+        for key in [key for key in self._images if key[0] == img_path]:
+            self.pop(key)
+
+    def clear(self):
+        self._images.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __repr__(self):
+        return (
+            f"VolumeCache({len(self)} images, {self.nbytes}/{self.max_bytes} bytes,"
+            f" hits {self.hits} misses {self.misses})"
+        )
+
+
+# process-local cache used by read_image, disabled unless enabled explicitly
+_volume_cache: Optional[VolumeCache] = None
+
+
+def enable_volume_cache(max_bytes=DEFAULT_VOLUME_CACHE_BYTES) -> VolumeCache:
+    """cache the images read by `read_image` in this process, see `VolumeCache`"""
+    global _volume_cache
+    _volume_cache = VolumeCache(max_bytes)
+    return _volume_cache
+
+
+def disable_volume_cache():
+    global _volume_cache
+    _volume_cache = None
+
+
+def get_volume_cache() -> Optional[VolumeCache]:
+    return _volume_cache
+
+
+@contextmanager
+def volume_cache(max_bytes=DEFAULT_VOLUME_CACHE_BYTES):
+    """cache the images read by `read_image` within the context, e.g. while processing one subject
+    the previous cache (if any) is restored on exit
+
+    with volume_cache() as cache:
+        process_subject(...)
+    logger.debug(cache)
+    """
+    global _volume_cache
+    previous_cache = _volume_cache
+    _volume_cache = VolumeCache(max_bytes)
+    try:
+        yield _volume_cache
+    finally:
+        _volume_cache = previous_cache
+
+
 def read_image(img_path) -> sitk.Image:
     """returns the SimpleITK image read from given path
+    if the volume cache is enabled (see `volume_cache`), repeated reads of an unchanged file
+    return a copy of the cached image. Volumes are copied from the node's cache daemon if the
+    XRAYTO3D_SHM_CACHE environment variable points to its socket (see `shm_cache`), this is a full
+    copy of the shared segment, use `map_shm_cached_volume` for a zero-copy array. Files in the
+    raw cache directory set by XRAYTO3D_RAW_CACHE are read from their uncompressed copy (see `raw_cache`)
 
     Parameters:
     -----------
@@ -86,6 +242,33 @@ def read_image(img_path) -> sitk.Image:
     img_path = Path(img_path).resolve()
     img_path = str(img_path)
 
+    if _volume_cache is not None:
+        key = VolumeCache.get_key(img_path)
+        img = _volume_cache.get(key)
+        if img is None:
+            img = _read_image_file(img_path)
+            _volume_cache.put(key, img)
+        # callers may modify the image in place, the copy shares the buffer until then
+        return sitk.Image(img)
+
+    return _read_image_file(img_path)
+
+
+def _read_image_file(img_path: str) -> sitk.Image:
+    """read from the node's shared memory cache daemon if one is running (see `shm_cache`),
+    or from the raw cache if it holds an up to date copy of img_path (see `raw_cache`)
+    """
+    if get_shm_cache_socket() is not None:
+        img = read_shm_cached_image(img_path)
+        if img is not None:
+            return img
+
+    raw_cache_dir = get_raw_cache_dir()
+    if raw_cache_dir is not None:
+        img = read_raw_cached_image(img_path, raw_cache_dir)
+        if img is not None:
+            return img
+
     # sitk.ReadImage itself is robust
     # specifying pixelType resulted in more trouble
     # if pixeltype == ImagePixelType.ImageType:
@@ -102,12 +285,423 @@ def read_image(img_path) -> sitk.Image:
     return sitk.ReadImage(img_path)
 
 
-def write_image(img, out_path, pixeltype=None):
-    """save image"""
+class ImageHeader:
+    """geometry of an image file read without its pixels, see `read_image_header`
+    exposes the geometry getters and index/physical point transforms of `sitk.Image`
+    """
+
+    def __init__(self, size, spacing, origin, direction, pixel_id, num_components=1):
+        self._size = tuple(size)
+        self._pixel_id = pixel_id
+        self._num_components = num_components
+        # 1-voxel image with the same geometry, so that transforms use itk's own arithmetic
+        self._reference = sitk.Image([1] * len(self._size), sitk.sitkUInt8)
+        self._reference.SetOrigin(origin)
+        self._reference.SetSpacing(spacing)
+        self._reference.SetDirection(direction)
+
+    def GetSize(self):
+        return self._size
+
+    def GetDimension(self):
+        return len(self._size)
+
+    def GetPixelID(self):
+        return self._pixel_id
+
+    def GetNumberOfComponentsPerPixel(self):
+        return self._num_components
+
+    def GetOrigin(self):
+        return self._reference.GetOrigin()
+
+    def GetSpacing(self):
+        return self._reference.GetSpacing()
+
+    def GetDirection(self):
+        return self._reference.GetDirection()
+
+    def TransformPhysicalPointToIndex(self, point):
+        return self._reference.TransformPhysicalPointToIndex(point)
+
+    def TransformPhysicalPointToContinuousIndex(self, point):
+        return self._reference.TransformPhysicalPointToContinuousIndex(point)
+
+    def TransformIndexToPhysicalPoint(self, index):
+        return self._reference.TransformIndexToPhysicalPoint(index)
+
+    def TransformContinuousIndexToPhysicalPoint(self, index):
+        return self._reference.TransformContinuousIndexToPhysicalPoint(index)
+
+
+def read_image_header(img_path) -> ImageHeader:
+    """read size, spacing, origin and direction of an image without reading its pixels"""
+    reader = get_metadata(str(Path(img_path).resolve()))
+    return ImageHeader(
+        reader.GetSize(),
+        reader.GetSpacing(),
+        reader.GetOrigin(),
+        reader.GetDirection(),
+        reader.GetPixelID(),
+        reader.GetNumberOfComponents(),
+    )
+
+
+class LazyImage:
+    """image at `img_path` whose pixels are read on first access of `image`
+    `header` is available without reading the pixels
+    """
+
+    def __init__(self, img_path, image: Optional[sitk.Image] = None):
+        self.path = img_path
+        self._image = image
+        self._header = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._image is not None
+
+    @property
+    def header(self):
+        """the image itself once loaded, its `ImageHeader` otherwise"""
+        if self._image is not None:
+            return self._image
+        if self._header is None:
+            self._header = read_image_header(self.path)
+        return self._header
+
+    @property
+    def image(self) -> sitk.Image:
+        if self._image is None:
+            self._image = read_image(self.path)
+        return self._image
+
+
+def as_lazy_image(img_path, img=None) -> LazyImage:
+    """img: None, an already loaded sitk.Image or a LazyImage of img_path"""
+    if isinstance(img, LazyImage):
+        return img
+    return LazyImage(img_path, img)
+
+
+class LazySubject:
+    """ct and segmentation of a subject, read in the order they are needed:
+    headers first, then the segmentation, and the ct pixels only once a ROI is known to be produced,
+    so that skipped subjects cost a segmentation read
+
+    ct may be an already loaded sitk.Image or a LazyImage shared with other subjects reading the same scan
+    """
+
+    def __init__(self, ct_path, seg_path, ct=None):
+        self._ct = as_lazy_image(ct_path, ct)
+        self._seg = LazyImage(seg_path)
+
+    @property
+    def ct_header(self):
+        return self._ct.header
+
+    @property
+    def seg_header(self):
+        return self._seg.header
+
+    @property
+    def seg(self) -> sitk.Image:
+        return self._seg.image
+
+    @property
+    def ct_path(self):
+        return self._ct.path
+
+    @property
+    def ct(self) -> sitk.Image:
+        return self._ct.image
+
+    @property
+    def is_ct_loaded(self) -> bool:
+        return self._ct.is_loaded
+
+
+GZIP_INDEX_SUFFIX = ".gzidx"
+
+
+def get_gzip_index_path(img_path) -> str:
+    """seek point index of a gzip compressed image is stored next to it, e.g. ct.nii.gz.gzidx"""
+    return f"{img_path}{GZIP_INDEX_SUFFIX}"
+
+
+def build_gzip_index(img_path, spacing=4 * 2**20) -> str:
+    """build the seek point index (a zlib checkpoint every `spacing` uncompressed bytes) of a
+    .nii.gz file, used by `read_image_region`. Requires indexed_gzip
+
+    Returns:
+        path of the index file
+    """
+    if indexed_gzip is None:
+        raise ImportError("building a gzip seek point index requires indexed_gzip")
+    img_path = str(Path(img_path).resolve())
+    index_path = get_gzip_index_path(img_path)
+    with indexed_gzip.IndexedGzipFile(img_path, spacing=spacing) as gzip_file:
+        gzip_file.build_full_index()
+        gzip_file.export_index(index_path)
+    return index_path
+
+
+def _has_fresh_gzip_index(img_path: str) -> bool:
+    index_path = get_gzip_index_path(img_path)
+    return (
+        os.path.exists(index_path)
+        and os.stat(index_path).st_mtime_ns >= os.stat(img_path).st_mtime_ns
+    )
+
+
+def _read_nifti_region_indexed(img_path: str, header: ImageHeader, index, size):
+    """region of a .nii.gz decompressed from the nearest seek point through the last needed slice"""
+    with indexed_gzip.IndexedGzipFile(
+        img_path, index_file=get_gzip_index_path(img_path)
+    ) as gzip_file:
+        nifti = nib.Nifti1Image.from_file_map(
+            {"image": nib.FileHolder(fileobj=gzip_file)}
+        )
+        region_arr = np.asarray(
+            nifti.dataobj[tuple(slice(i, i + sz) for i, sz in zip(index, size))]
+        )
+    # nifti arrays are indexed [x,y,z(,c)], sitk arrays [z,y,x(,c)]
+    dim = header.GetDimension()
+    region_arr = region_arr.transpose(
+        tuple(range(dim))[::-1] + tuple(range(dim, region_arr.ndim))
+    )
+    # same pixel type as sitk.ReadImage, e.g. after applying the nifti intensity scaling
+    pixel_dtype = sitk.GetArrayViewFromImage(
+        sitk.Image([1] * dim, header.GetPixelID())
+    ).dtype
+    region = sitk.GetImageFromArray(
+        np.ascontiguousarray(region_arr, dtype=pixel_dtype),
+        isVector=region_arr.ndim > dim,
+    )
+    region.SetSpacing(header.GetSpacing())
+    region.SetDirection(header.GetDirection())
+    region.SetOrigin(header.TransformIndexToPhysicalPoint(index))
+    return region
+
+
+def _read_nifti_region_blocks(
+    img_path: str, blocks: Dict, header: ImageHeader, index, size
+) -> Optional[sitk.Image]:
+    """region of a multi-member .nii.gz written by `write_nifti_gz_parallel`,
+    only the gzip members holding the slices of the region are decompressed.
+    None if the nifti layout is not supported
+    """
+    header_bytes = read_gzip_range(img_path, blocks, 0, 540)
+    try:
+        nifti_header = nib.Nifti1Header.from_fileobj(io.BytesIO(header_bytes))
+    except nib.spatialimages.HeaderDataError:
+        nifti_header = nib.Nifti2Header.from_fileobj(io.BytesIO(header_bytes))
+    shape = nifti_header.get_data_shape()
+    dim = header.GetDimension()
+    if tuple(shape) != tuple(header.GetSize()):
+        return None
+
+    # voxels are stored x fastest, read the slab of whole slices along the last axis
+    dtype = nifti_header.get_data_dtype()
+    slice_nbytes = int(np.prod(shape[:-1])) * dtype.itemsize
+    slab_start = int(nifti_header["vox_offset"]) + index[-1] * slice_nbytes
+    slab = read_gzip_range(
+        img_path, blocks, slab_start, slab_start + size[-1] * slice_nbytes
+    )
+    slab_arr = np.frombuffer(slab, dtype=dtype).reshape(
+        tuple(shape[:-1]) + (size[-1],), order="F"
+    )
+    region_arr = slab_arr[
+        tuple(slice(i, i + sz) for i, sz in zip(index[:-1], size[:-1]))
+    ]
+    slope, inter = nifti_header.get_slope_inter()
+    if slope is not None and (slope, inter) != (1.0, 0.0):
+        region_arr = region_arr * slope + (inter or 0.0)
+
+    # same pixel type as sitk.ReadImage, sitk arrays are indexed [z,y,x]
+    pixel_dtype = sitk.GetArrayViewFromImage(
+        sitk.Image([1] * dim, header.GetPixelID())
+    ).dtype
+    region = sitk.GetImageFromArray(
+        np.ascontiguousarray(region_arr.transpose(), dtype=pixel_dtype)
+    )
+    region.SetSpacing(header.GetSpacing())
+    region.SetDirection(header.GetDirection())
+    region.SetOrigin(header.TransformIndexToPhysicalPoint(index))
+    return region
+
+
+def read_image_region(img_path, index, size) -> sitk.Image:
+    """read the region of `size` voxels starting at `index` of the image at img_path,
+    the region keeps its physical position (origin of the region, spacing and direction of the image)
+
+    Images served by the node's cache daemon (see `shm_cache`) and images in the raw cache
+    (see `raw_cache`) are read from their memory map, copying only the region,
+    .nii.gz files written with block offsets (see `write_nifti_gz_parallel`) decompress only the
+    gzip members holding the region, files with a seek point index (see `build_gzip_index`) are
+    decompressed from the nearest seek point before the region, other files are streamed by itk
+    which decompresses from the start of the file through the last needed slice.
+    The full image is never decompressed.
+    """
+    img_path = str(Path(img_path).resolve())
+    index = [int(i) for i in index]
+    size = [int(sz) for sz in size]
+    header = read_image_header(img_path)
+    if not all(
+        0 <= i and sz > 0 and i + sz <= img_sz
+        for i, sz, img_sz in zip(index, size, header.GetSize())
+    ):
+        raise ValueError(
+            f"region index {index} size {size} is not inside image of size {header.GetSize()}"
+        )
+
+    if get_shm_cache_socket() is not None:
+        region = read_shm_cached_region(img_path, index, size)
+        if region is not None:
+            return region
+
+    raw_cache_dir = get_raw_cache_dir()
+    if raw_cache_dir is not None:
+        region = read_raw_cached_region(img_path, raw_cache_dir, index, size)
+        if region is not None:
+            return region
+
+    if header.GetNumberOfComponentsPerPixel() > 1:
+        # itk's streamed read of a region of vector images corrupts memory, read the whole image
+        return sitk.RegionOfInterest(read_image(img_path), size, index)
+
+    if img_path.endswith(".nii.gz"):
+        blocks = load_gzip_blocks(img_path)
+        if blocks is not None:
+            region = _read_nifti_region_blocks(img_path, blocks, header, index, size)
+            if region is not None:
+                return region
+
+    if (
+        indexed_gzip is not None
+        and img_path.endswith(".nii.gz")
+        and _has_fresh_gzip_index(img_path)
+    ):
+        return _read_nifti_region_indexed(img_path, header, index, size)
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img_path)
+    reader.SetExtractIndex(index)
+    reader.SetExtractSize(size)
+    return reader.Execute()
+
+
+# options of `write_nifti_gz_parallel` used by write_image for .nii.gz outputs,
+# disabled (single threaded itk compression) unless enabled explicitly
+_parallel_gzip_options: Optional[Dict] = None
+
+
+def enable_parallel_gzip(
+    compresslevel=DEFAULT_GZIP_COMPRESSLEVEL,
+    block_size=DEFAULT_GZIP_BLOCK_SIZE,
+    num_workers: Optional[int] = None,
+    write_block_offsets=False,
+):
+    """compress the .nii.gz outputs of `write_image` on a thread pool, see `write_nifti_gz_parallel`"""
+    global _parallel_gzip_options
+    _parallel_gzip_options = {
+        "compresslevel": compresslevel,
+        "block_size": block_size,
+        "num_workers": num_workers,
+        "write_block_offsets": write_block_offsets,
+    }
+
+
+def disable_parallel_gzip():
+    global _parallel_gzip_options
+    _parallel_gzip_options = None
+
+
+def write_nifti_gz_parallel(
+    img: sitk.Image,
+    out_path,
+    compresslevel=DEFAULT_GZIP_COMPRESSLEVEL,
+    block_size=DEFAULT_GZIP_BLOCK_SIZE,
+    num_workers: Optional[int] = None,
+    write_block_offsets=False,
+):
+    """write img as .nii.gz, the nifti byte stream written by itk is compressed in blocks
+    of `block_size` bytes on a thread pool into a multi-member gzip file, see `gzip_utils`.
+    With write_block_offsets, `read_image_region` decompresses only the blocks holding a region
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        nii_path = os.path.join(tmp_dir, "img.nii")
+        sitk.WriteImage(img, nii_path, False)
+        with open(nii_path, "rb") as nii_file:
+            nii_bytes = nii_file.read()
+    write_gzip_blocks(
+        nii_bytes, out_path, compresslevel, block_size, num_workers, write_block_offsets
+    )
+
+
+def cast_to_output_dtype(img: sitk.Image, output_dtype) -> sitk.Image:
+    """cast img to the dtype of an output dtype policy, see `get_output_dtype`
+
+    Args:
+        img (sitk.Image): image to be written
+        output_dtype (str|dict): numpy dtype name e.g. "int16",
+            or {"dtype": "uint8", "scale": 2.5, "clip": False}.
+            Intensities are multiplied by scale and rounded for integer dtypes.
+            Values outside of the range of dtype raise a ValueError, or are clipped if clip is set
+    """
+    if isinstance(output_dtype, str):
+        output_dtype = {"dtype": output_dtype}
+    dtype = np.dtype(output_dtype["dtype"])
+    scale = output_dtype.get("scale", 1)
+    clip = output_dtype.get("clip", False)
+
+    img_arr = sitk.GetArrayViewFromImage(img)
+    if scale == 1 and np.can_cast(img_arr.dtype, dtype, "safe"):
+        if img_arr.dtype == dtype:
+            return img
+        out_arr = img_arr.astype(dtype)
+    else:
+        if scale != 1:
+            img_arr = img_arr * np.float32(scale)
+        if np.issubdtype(dtype, np.integer) and img_arr.dtype.kind == "f":
+            # owned arrays are updated in place, the view of img is never written to
+            img_arr = np.rint(img_arr, out=img_arr if scale != 1 else None)
+        dtype_info = np.iinfo(dtype) if np.issubdtype(dtype, np.integer) else np.finfo(dtype)
+        min_value, max_value = img_arr.min(), img_arr.max()
+        if np.isnan(min_value) or np.isnan(max_value):
+            raise ValueError(f"image has NaN values, can not be written as {dtype}")
+        if min_value < dtype_info.min or max_value > dtype_info.max:
+            if not clip:
+                raise ValueError(
+                    f"intensity range [{min_value}, {max_value}] exceeds the range of {dtype} "
+                    f"[{dtype_info.min}, {dtype_info.max}], set clip in the output dtype policy"
+                )
+            img_arr = np.clip(img_arr, dtype_info.min, dtype_info.max)
+        out_arr = img_arr.astype(dtype, copy=False)
+
+    out_img = sitk.GetImageFromArray(
+        out_arr, isVector=img.GetNumberOfComponentsPerPixel() > 1
+    )
+    out_img.CopyInformation(img)
+    return out_img
+
+
+def write_image(img, out_path, pixeltype=None, output_dtype=None):
+    """save image
+    output_dtype: dtype policy of the output, see `cast_to_output_dtype`
+    .nii.gz outputs are compressed on a thread pool if enabled, see `enable_parallel_gzip`
+    """
     if isinstance(out_path, Path):
         out_path = str(out_path)
     if pixeltype:
         img = sitk.Cast(img, pixeltype)
+    if output_dtype is not None:
+        img = cast_to_output_dtype(img, output_dtype)
+    if _volume_cache is not None:
+        _volume_cache.invalidate(str(Path(out_path).resolve()))
+    if _parallel_gzip_options is not None and out_path.endswith(".nii.gz"):
+        write_nifti_gz_parallel(img, out_path, **_parallel_gzip_options)
+        return
     sitk.WriteImage(img, out_path)
 
 
@@ -0,0 +1,96 @@
+"""label algebra on segmentations using uint8 lookup tables
+
+A relabelling (merge, keep, drop, binarize) is compiled into a single 256-entry
+lookup table and applied in one vectorized pass over the voxels, instead of chaining
+sitk label filters that each allocate a full-size image.
+
+e.g. merge left hip, right hip and sacrum into label 1 and remove everything else:
+    seg = relabel(seg, mapping={1: 1, 2: 1, 3: 1}, keep=[1])
+"""
+from functools import lru_cache
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import SimpleITK as sitk
+
+NUM_LABELS = 256  # labels are uint8
+
+
+def _check_label_range(labels, name):
+    labels = np.asarray(list(labels))
+    if np.any((labels < 0) | (labels >= NUM_LABELS)):
+        raise ValueError(f"{name} labels must be in [0, {NUM_LABELS - 1}], got {labels}")
+
+
+def compile_label_lut(
+    mapping: Optional[Dict[int, int]] = None,
+    keep: Optional[Sequence[int]] = None,
+    drop: Optional[Sequence[int]] = None,
+    binarize=False,
+    fill_label=1,
+) -> np.ndarray:
+    """compile label operations into a uint8 lookup table, the operations are applied in this order
+
+    Args:
+        mapping (dict, optional): {label: new label}, other labels are unchanged.
+            Labels are merged by mapping them to the same new label
+        keep (sequence, optional): labels (after mapping) to keep, all other labels become background
+        drop (sequence, optional): labels (after mapping) that become background
+        binarize (bool, optional): set all remaining foreground labels to fill_label
+    """
+    lut = np.arange(NUM_LABELS)
+    if mapping:
+        _check_label_range(mapping.keys(), "mapping")
+        _check_label_range(mapping.values(), "mapping")
+        lut[list(mapping.keys())] = list(mapping.values())
+    if keep is not None:
+        lut[~np.isin(lut, keep)] = 0
+    if drop is not None:
+        lut[np.isin(lut, drop)] = 0
+    if binarize:
+        _check_label_range([fill_label], "fill")
+        lut[lut != 0] = fill_label
+    return lut.astype(np.uint8)
+
+
+@lru_cache(maxsize=16)
+def _get_uint16_lut(lut_bytes: bytes) -> np.ndarray:
+    """lookup table indexed by 16 bit labels, see `apply_label_lut`"""
+    return np.tile(np.frombuffer(lut_bytes, dtype=np.uint8), NUM_LABELS)
+
+
+def apply_label_lut(segmentation: sitk.Image, lut: np.ndarray) -> sitk.Image:
+    """relabel segmentation with a lookup table from `compile_label_lut`
+    labels must be in [0, 255], a ValueError is raised otherwise. The result is a uint8 segmentation
+    floating point labels are rounded to the nearest label, e.g. after linear resampling
+    """
+    seg_arr = sitk.GetArrayViewFromImage(segmentation)
+    if seg_arr.dtype.kind == "f":
+        seg_arr = np.rint(seg_arr)
+    if seg_arr.dtype != np.uint8:
+        # labels out of the range of the table would wrap around when read as uint8
+        _check_label_range([seg_arr.min(), seg_arr.max()], "segmentation")
+    if seg_arr.dtype.kind in "iu" and seg_arr.dtype.itemsize == 1:
+        out_arr = np.take(lut, seg_arr.view(np.uint8))
+    elif seg_arr.dtype.kind in "iu" and seg_arr.dtype.itemsize == 2:
+        out_arr = np.take(_get_uint16_lut(lut.tobytes()), seg_arr.view(np.uint16))
+    else:
+        out_arr = np.take(lut, seg_arr.astype(np.uint8))
+
+    out_seg = sitk.GetImageFromArray(out_arr)
+    out_seg.CopyInformation(segmentation)
+    return out_seg
+
+
+def relabel(
+    segmentation: sitk.Image,
+    mapping: Optional[Dict[int, int]] = None,
+    keep: Optional[Sequence[int]] = None,
+    drop: Optional[Sequence[int]] = None,
+    binarize=False,
+    fill_label=1,
+) -> sitk.Image:
+    """apply label operations to segmentation in a single pass, see `compile_label_lut`"""
+    return apply_label_lut(
+        segmentation, compile_label_lut(mapping, keep, drop, binarize, fill_label)
+    )
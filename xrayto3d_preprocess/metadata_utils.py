@@ -86,6 +86,38 @@ def get_orientation_code_itk(img_or_affine_mtrx: Union[sitk.Image, Sequence]) ->
         )
 
 
+def get_direction_from_orientation_code(orientation: str) -> Tuple:
+    """direction cosines of an itk orientation code, inverse of `get_orientation_code_itk`
+    e.g. LPS -> identity, PIR -> (0, 0, -1, 1, 0, 0, 0, -1, 0)
+    """
+    # physical (LPS) unit vector along which the index of each axis increases
+    axis_vectors = {
+        "L": (1, 0, 0),
+        "R": (-1, 0, 0),
+        "P": (0, 1, 0),
+        "A": (0, -1, 0),
+        "S": (0, 0, 1),
+        "I": (0, 0, -1),
+    }
+    if len(orientation) != 3 or not all(axis in axis_vectors for axis in orientation):
+        raise ValueError(f"invalid orientation string {orientation}")
+    columns = np.array([axis_vectors[axis] for axis in orientation], dtype=float).T
+    if round(abs(np.linalg.det(columns))) != 1:
+        raise ValueError(f"invalid orientation string {orientation}")
+    return tuple(columns.flatten())
+
+
 def get_orientation_code_nifti(img: nib.Nifti1Image) -> str:
     """get nibabel image and return nifti orientation"""
     return "".join(nib.aff2axcodes(img.affine))
+
+
+def get_orientation_code_nifti_from_direction(direction: Sequence) -> str:
+    """nifti (nibabel) orientation of an image with itk direction cosines, without reading the nifti header
+    itk directions are in LPS, nifti affines in RAS
+    """
+    dim = int(round(np.sqrt(len(direction))))
+    lps_to_ras = np.diag([-1, -1] + [1] * (dim - 2))
+    affine = np.eye(dim + 1)
+    affine[:dim, :dim] = lps_to_ras @ np.reshape(direction, (dim, dim))
+    return "".join(nib.aff2axcodes(affine))
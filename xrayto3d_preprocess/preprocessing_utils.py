@@ -1,15 +1,43 @@
 import os
-from typing import Dict, Sequence, Tuple
+import shutil
+import tempfile
+from pathlib import Path
+from types import ModuleType
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 from copy import deepcopy
 
 import SimpleITK as sitk
 
+from .drr_utils import (
+    drr_to_image,
+    generate_drr,
+    generate_drr_sweep,
+    generate_landmark_drr,
+    get_orientation_key,
+    get_pose,
+    normalize_pose,
+)
 from .enumutils import ImageType, ProjectionType
-from .ioutils import write_image
+from .ioutils import LazyImage, LazySubject, read_image, write_image
+from .label_utils import relabel
 from .metadata_utils import get_orientation_code_itk
 from .misc import get_drrsiddonjacobs_command_string
-from .roi_utils import extract_around_centroid_v2
-from .sitk_utils import keep_only_label, reorient_to, simulate_parallel_projection
+from .roi_utils import (
+    extract_around_centroid_v2,
+    extract_pair_around_centroid,
+    extract_pairs_around_centroids,
+    get_landmark_index,
+    render_centroid_heatmap,
+    sample_pairs_around_centroids,
+)
+from .sitk_utils import (
+    keep_only_label,
+    reorient_to,
+    simulate_biplanar_landmark_projection,
+    simulate_biplanar_parallel_projection,
+    simulate_parallel_projection,
+)
+from .tuple_ops import add_tuple
 
 
 def extract_vertebra_around_vbcentroid(
@@ -18,9 +46,9 @@ def extract_vertebra_around_vbcentroid(
     vertebra_level,
     vertebra_centroid,
     image_type: ImageType,
-) -> Tuple[sitk.Image, sitk.Image]:
+) -> Tuple[sitk.Image, Dict]:
     """return region of interest defined by vertebra centroid and bounding box size (defined in config)
-    also, return centroid heatmap"""
+    also, return centroid landmark (render the heatmap with `render_centroid_heatmap`)"""
     roi_physical_size = (config["size"],) * img.GetDimension()
     padding_intensity_value = (
         config["seg_padding"]
@@ -28,25 +56,192 @@ def extract_vertebra_around_vbcentroid(
         else config["ct_padding"]
     )
 
-    region_of_interest, centroid_heatmap = extract_around_centroid_v2(
+    region_of_interest, centroid_landmark = extract_around_centroid_v2(
         img=img,
         physical_size=roi_physical_size,
         centroid_index=vertebra_centroid,
         extraction_ratio=config["extraction_ratio"],
         padding_value=padding_intensity_value,
         verbose=False,
+        return_landmark=True,
     )
     if image_type == ImageType.SEGMENTATION:
         region_of_interest = keep_only_label(region_of_interest, vertebra_level)
 
-    # reorient ROI if required
+    # reorient ROI if required, the landmark is in physical coordinates
     if get_orientation_code_itk(region_of_interest) != config["axcode"]:
         region_of_interest = reorient_to(
             region_of_interest, axcodes_to=config["axcode"]
         )
-        centroid_heatmap = reorient_to(centroid_heatmap, axcodes_to=config["axcode"])
 
-    return region_of_interest, centroid_heatmap
+    return region_of_interest, centroid_landmark
+
+
+def extract_vertebra_pair_around_vbcentroid(
+    config: Dict,
+    ct: sitk.Image,
+    seg: sitk.Image,
+    vertebra_level,
+    vertebra_centroid,
+    return_heatmap=False,
+) -> Tuple[sitk.Image, sitk.Image, Union[Dict, sitk.Image]]:
+    """`extract_vertebra_around_vbcentroid` of the CT and segmentation of a vertebra
+    the ROI geometry is computed once for both, the centroid heatmap is only rendered if `return_heatmap`
+
+    Returns:
+        (ct_roi, seg_roi, centroid_landmark), or the centroid heatmap in place of the landmark
+    """
+    roi_physical_size = (config["size"],) * ct.GetDimension()
+    ct_roi, seg_roi, centroid_landmark = extract_pair_around_centroid(
+        ct,
+        seg,
+        roi_physical_size,
+        vertebra_centroid,
+        config["extraction_ratio"],
+        config["ct_padding"],
+        config["seg_padding"],
+    )
+    seg_roi = keep_only_label(seg_roi, vertebra_level)
+
+    # reorient ROI if required, the landmark is in physical coordinates
+    if get_orientation_code_itk(ct_roi) != config["axcode"]:
+        ct_roi = reorient_to(ct_roi, axcodes_to=config["axcode"])
+    if get_orientation_code_itk(seg_roi) != config["axcode"]:
+        seg_roi = reorient_to(seg_roi, axcodes_to=config["axcode"])
+
+    if return_heatmap:
+        return ct_roi, seg_roi, render_centroid_heatmap(centroid_landmark, ct_roi)
+    return ct_roi, seg_roi, centroid_landmark
+
+
+def extract_vertebrae_around_vbcentroids(
+    config: Dict,
+    ct: sitk.Image,
+    seg: sitk.Image,
+    vertebra_levels: Sequence,
+    vertebra_centroids: Sequence,
+    mask_ct=False,
+) -> List[Tuple[sitk.Image, sitk.Image, Dict]]:
+    """`extract_vertebra_around_vbcentroid` of the CT and segmentation of all vertebrae of a subject
+    the ROI boxes of all vertebrae are computed together. ROIs already in the orientation of config
+    are cut from one numpy view of each volume, otherwise every ROI is extracted and reoriented
+    in one pass, see `sample_pairs_around_centroids`
+
+    Returns:
+        (ct_roi, seg_roi, centroid_landmark) per vertebra, ct_roi is masked by seg_roi if mask_ct
+    """
+    roi_physical_size = (config["size"],) * ct.GetDimension()
+    if get_orientation_code_itk(ct) == config["axcode"]:
+        ct_rois, seg_rois, centroid_landmarks = extract_pairs_around_centroids(
+            ct,
+            seg,
+            roi_physical_size,
+            vertebra_centroids,
+            config["extraction_ratio"],
+            config["ct_padding"],
+            config["seg_padding"],
+        )
+    else:
+        # the landmark is in physical coordinates, it does not depend on the orientation
+        ct_rois, seg_rois, centroid_landmarks = sample_pairs_around_centroids(
+            ct,
+            seg,
+            roi_physical_size,
+            vertebra_centroids,
+            config["extraction_ratio"],
+            config["axcode"],
+            config["ct_padding"],
+            config["seg_padding"],
+        )
+
+    rois = []
+    for vertebra_level, ct_roi, seg_roi, centroid_landmark in zip(
+        vertebra_levels, ct_rois, seg_rois, centroid_landmarks
+    ):
+        seg_roi = keep_only_label(seg_roi, vertebra_level)
+        if mask_ct:
+            ct_roi = sitk.Mask(ct_roi, relabel(seg_roi, binarize=True))
+        rois.append((ct_roi, seg_roi, centroid_landmark))
+    return rois
+
+
+def process_subject_config_groups(
+    subject_id: str,
+    config_groups: Sequence[Sequence[Tuple[Dict, set]]],
+    script: ModuleType,
+    lazy_cts: Optional[Dict] = None,
+):
+    """create the output dirs and write the outputs of every config listing subject_id
+    config_groups: (config, subjects) of configs sharing the ROI stage, see `load_config_groups`
+                   of the scripts. The ROIs are extracted once per group
+    script: the preprocessing script module providing `extract_rois`, `write_outputs`,
+            `create_directories` and `logger`
+    lazy_cts: `LazyImage` of the scans by path, shared with other calls (e.g. other anatomies of
+              the subject). A scan is read only if a ROI is produced
+    """
+    if lazy_cts is None:
+        lazy_cts = {}
+    for config_group in config_groups:
+        configs = [config for config, subjects in config_group if subject_id in subjects]
+        if not configs:
+            continue
+        # define paths, the inputs are the same for all configs of a group
+        input_fileformat = configs[0]["filename_convention"]["input"]
+
+        subject_basepath = configs[0]["subjects"]["subject_basepath"]
+
+        ct_path = Path(subject_basepath) / subject_id / input_fileformat["ct"]
+        seg_path = Path(subject_basepath) / subject_id / input_fileformat["seg"]
+
+        script.logger.debug(f"reading ct and seg from {ct_path} {seg_path}")
+        output_path_templates = []
+        for config in configs:
+            OUT_DIR_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}'
+            OUT_PATH_TEMPLATE = f'{subject_basepath}/{subject_id}/{config["out_directories"]["derivatives"]}/{{output_type}}/{{output_name}}'
+
+            script.create_directories(OUT_DIR_TEMPLATE, config)
+            output_path_templates.append(OUT_PATH_TEMPLATE)
+
+        ct = lazy_cts.setdefault(ct_path, LazyImage(ct_path))
+        rois = script.extract_rois(LazySubject(ct_path, seg_path, ct=ct), configs[0])
+        if rois is None:
+            continue
+        for config, output_path_template in zip(configs, output_path_templates):
+            script.write_outputs(subject_id, rois, config, output_path_template)
+
+
+def use_numpy_drr_engine(config) -> bool:
+    """xray_pose.drr_engine: 'siddonjacobs' (external DRRSiddonJacobs, default) or 'numpy' (in-process)"""
+    return config.get("drr_engine", "siddonjacobs") == "numpy"
+
+
+def generate_ct_xray(
+    input_image_path,
+    projection_type: ProjectionType,
+    config,
+    out_xray_path,
+    input_image: Optional[sitk.Image] = None,
+):
+    """Generate DRR from CT with the engine selected by config['drr_engine']
+    the in-process engine uses `input_image` if given, so that the ROI is not read back from disk
+    and the projection operators cached in config['drr_operator_cache'] if given
+    """
+    orientation = "ap" if projection_type == ProjectionType.AP else "lat"
+    if use_numpy_drr_engine(config):
+        if input_image is None:
+            input_image = read_image(input_image_path)
+        drr = generate_drr(
+            input_image,
+            projection_type,
+            config,
+            cache_dir=config.get("drr_operator_cache"),
+        )
+        write_image(drr_to_image(drr, config["res"]), out_xray_path)
+    else:
+        drr_command = get_drrsiddonjacobs_command_string(
+            input_image_path, out_xray_path, orientation=orientation, config=config
+        )
+        os.system(drr_command)
 
 
 def generate_perturbed_xray(
@@ -55,38 +250,163 @@ def generate_perturbed_xray(
     config,
     out_xray_path,
     lat_view_perturbation_angle: int,
+    input_image: Optional[sitk.Image] = None,
 ):
     """ "Generate perturbed x-ray from CT i.e. instead of Biplanar x-rays, the LAT view can vary by given perturbation angle"""
     orientation = "ap" if projection_type == ProjectionType.AP else "lat"
     perturbed_config = deepcopy(config)
     perturbed_config[orientation]["rz"] += lat_view_perturbation_angle
-    drr_command = get_drrsiddonjacobs_command_string(
+    generate_ct_xray(
         input_image_path,
+        projection_type,
+        perturbed_config,
         out_xray_path,
-        orientation=orientation,
-        config=perturbed_config,
+        input_image=input_image,
     )
-    os.system(drr_command)
+
+
+def generate_xray_sweep(
+    input_image_path,
+    views: Sequence[Tuple[ProjectionType, Tuple[float, float, float], str]],
+    config,
+    input_image: Optional[sitk.Image] = None,
+):
+    """Generate DRRs of several poses of the same CT
+    views: (projection_type, (drx, dry, drz), out_xray_path) i.e. the pose of the AP/LAT view in config
+           offset by the given angles in degrees
+    identical poses are rendered once and copied to the remaining output paths
+    - numpy engine: the CT is loaded once and all poses are rendered in one pass
+    - DRRSiddonJacobs: the external tool is run (and reads the CT) once per distinct pose
+    """
+    poses = [
+        normalize_pose(
+            add_tuple(get_pose(config, get_orientation_key(projection_type)), offset)
+        )
+        for projection_type, offset, _ in views
+    ]
+    out_xray_paths = [out_xray_path for *_, out_xray_path in views]
+
+    if use_numpy_drr_engine(config):
+        if input_image is None:
+            input_image = read_image(input_image_path)
+        unique_poses = list(dict.fromkeys(poses))
+        drrs = generate_drr_sweep(
+            input_image,
+            unique_poses,
+            config["size"],
+            config["res"],
+            cache_dir=config.get("drr_operator_cache"),
+        )
+        drr_per_pose = dict(zip(unique_poses, drrs))
+
+    rendered_paths = {}
+    for pose, out_xray_path in zip(poses, out_xray_paths):
+        if pose in rendered_paths:
+            shutil.copyfile(rendered_paths[pose], out_xray_path)
+            continue
+        if use_numpy_drr_engine(config):
+            write_image(drr_to_image(drr_per_pose[pose], config["res"]), out_xray_path)
+        else:
+            pose_config = deepcopy(config)
+            pose_config["ap"]["rx"], pose_config["ap"]["ry"], pose_config["ap"]["rz"] = pose
+            drr_command = get_drrsiddonjacobs_command_string(
+                input_image_path, out_xray_path, orientation="ap", config=pose_config
+            )
+            os.system(drr_command)
+        rendered_paths[pose] = out_xray_path
 
 
 def generate_xray(
-    input_image_path, projection_type: ProjectionType, mask_roi, config, out_xray_path
+    input_image_path,
+    projection_type: ProjectionType,
+    mask_roi,
+    config,
+    out_xray_path,
+    input_image: Optional[sitk.Image] = None,
 ):
     """Generate X-ray from CT
-    - use DRRSiddonJacobs if CT
+    - use DRRSiddonJacobs (or the in-process engine, see `generate_ct_xray`) if CT
     - simulate projection if Segmentation (DRRSiddonJacobs does not work well for segmentation)
     """
     drr_from_mask = config["drr_from_mask"]
-    orientation = "ap" if projection_type == ProjectionType.AP else "lat"
 
     if drr_from_mask:
         lat_img = simulate_parallel_projection(mask_roi, projectiontype=projection_type)
         write_image(lat_img, out_xray_path)
     else:
-        lat_command = get_drrsiddonjacobs_command_string(
-            input_image_path, out_xray_path, orientation=orientation, config=config
+        generate_ct_xray(
+            input_image_path,
+            projection_type,
+            config,
+            out_xray_path,
+            input_image=input_image,
+        )
+
+
+def generate_biplanar_xray(
+    input_image_path,
+    mask_roi,
+    config,
+    out_xray_ap_path,
+    out_xray_lat_path,
+    input_image: Optional[sitk.Image] = None,
+):
+    """Generate AP and LAT X-ray from CT in one call
+    - segmentation is projected once for both views without resampling the volume
+    - CT views are rendered as a sweep, see `generate_xray_sweep`
+    """
+    if config["drr_from_mask"]:
+        ap_img, lat_img = simulate_biplanar_parallel_projection(mask_roi)
+        write_image(ap_img, out_xray_ap_path)
+        write_image(lat_img, out_xray_lat_path)
+    else:
+        views = [
+            (ProjectionType.AP, (0, 0, 0), out_xray_ap_path),
+            (ProjectionType.LAT, (0, 0, 0), out_xray_lat_path),
+        ]
+        generate_xray_sweep(input_image_path, views, config, input_image=input_image)
+
+
+def generate_biplanar_landmark_xray(
+    landmark: Dict,
+    reference: sitk.Image,
+    config,
+    out_xray_ap_path,
+    out_xray_lat_path,
+):
+    """Generate AP and LAT X-ray of a centroid landmark
+    - `reference` is the ROI the heatmap would be rendered on
+    - drr_from_mask or numpy engine: both projections are evaluated in closed form, without the
+      voxelization of the heatmap (about 10% of the peak for a sigma of 2-3 voxels)
+    - DRRSiddonJacobs: the rendered heatmap volume is projected by the external tool, exactly as
+      the CT is, so that the centroid X-rays line up with the CT X-rays
+    """
+    if not config["drr_from_mask"] and not use_numpy_drr_engine(config):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            heatmap_path = os.path.join(tmp_dir, "centroid_heatmap.nii.gz")
+            write_image(render_centroid_heatmap(landmark, reference), heatmap_path)
+            generate_biplanar_xray(
+                heatmap_path, None, config, out_xray_ap_path, out_xray_lat_path
+            )
+        return
+
+    centroid_index = get_landmark_index(landmark, reference)
+    if config["drr_from_mask"]:
+        ap_img, lat_img = simulate_biplanar_landmark_projection(
+            centroid_index, landmark["sigma"], reference
+        )
+    else:
+        ap_img, lat_img = (
+            drr_to_image(
+                generate_landmark_drr(
+                    centroid_index, landmark["sigma"], reference, projection_type, config
+                ),
+                config["res"],
+            )
+            for projection_type in (ProjectionType.AP, ProjectionType.LAT)
         )
-        os.system(lat_command)
+    write_image(ap_img, out_xray_ap_path)
+    write_image(lat_img, out_xray_lat_path)
 
 
 def spatialnet_reorient(img: sitk.Image, saved_landmark: Sequence):
@@ -0,0 +1,178 @@
+"""cache of volumes as uncompressed, memory-mapped arrays
+
+Reading a .nii.gz decompresses the whole file every time. The cache mirrors the input files
+into a cache directory as raw little-endian arrays ([z,y,x(,c)], C order) with a json header,
+once; `read_image` and `read_image_region` then read the raw array instead, as long as the source
+file is unchanged (same mtime and size). Arrays are exposed as `np.memmap`, so cropping a region
+only touches the pages it needs.
+
+The cache directory is given by the XRAYTO3D_RAW_CACHE environment variable, e.g.
+    python -m xrayto3d_preprocess.raw_cache /scratch/raw_cache 2D-3D-Reconstruction-Datasets/totalsegmentator --pattern "ct.nii.gz"
+    XRAYTO3D_RAW_CACHE=/scratch/raw_cache python preprocess_totalsegmentor_hip.py configs/...
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+RAW_CACHE_ENV = "XRAYTO3D_RAW_CACHE"
+
+
+def get_raw_cache_dir() -> Optional[str]:
+    """cache directory set in the XRAYTO3D_RAW_CACHE environment variable, None if unset"""
+    return os.environ.get(RAW_CACHE_ENV) or None
+
+
+def get_raw_cache_paths(img_path, cache_dir) -> Tuple[str, str]:
+    """raw array and json header of img_path, at the resolved path of img_path mirrored under cache_dir"""
+    img_path = Path(img_path).resolve()
+    mirrored_path = Path(cache_dir).resolve() / img_path.relative_to(img_path.anchor)
+    return f"{mirrored_path}.raw", f"{mirrored_path}.json"
+
+
+def load_raw_cache_header(img_path, cache_dir) -> Optional[Dict]:
+    """json header of the cached array of img_path, None if not cached or the source changed since"""
+    _, header_path = get_raw_cache_paths(img_path, cache_dir)
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path) as header_file:
+        header = json.load(header_file)
+    stat = os.stat(img_path)
+    if (header["source_mtime_ns"], header["source_size"]) != (
+        stat.st_mtime_ns,
+        stat.st_size,
+    ):
+        return None
+    return header
+
+
+def convert_to_raw_cache(img_path, cache_dir, overwrite=False) -> bool:
+    """write the raw array and json header of img_path into cache_dir
+
+    Returns:
+        False if the cache of img_path was already fresh
+    """
+    if not overwrite and load_raw_cache_header(img_path, cache_dir) is not None:
+        return False
+    img_path = str(Path(img_path).resolve())
+    stat = os.stat(img_path)
+    img = sitk.ReadImage(img_path)
+    img_arr = sitk.GetArrayViewFromImage(img)
+    raw_dtype = img_arr.dtype.newbyteorder("<")
+
+    raw_path, header_path = get_raw_cache_paths(img_path, cache_dir)
+    Path(raw_path).parent.mkdir(exist_ok=True, parents=True)
+    # the header is written last, a cache entry without header is never read
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    tmp_path = f"{raw_path}.tmp{os.getpid()}"
+    np.ascontiguousarray(img_arr, dtype=raw_dtype).tofile(tmp_path)
+    os.replace(tmp_path, raw_path)
+
+    header = {
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_size": stat.st_size,
+        "shape": list(img_arr.shape),
+        "dtype": raw_dtype.str,
+        "size": list(img.GetSize()),
+        "spacing": list(img.GetSpacing()),
+        "origin": list(img.GetOrigin()),
+        "direction": list(img.GetDirection()),
+        "pixel_id": img.GetPixelID(),
+        "num_components": img.GetNumberOfComponentsPerPixel(),
+    }
+    with open(header_path, "w") as header_file:
+        json.dump(header, header_file)
+    return True
+
+
+def build_raw_cache(img_paths, cache_dir, num_workers=4, overwrite=False) -> int:
+    """convert every image of img_paths whose cache is missing or stale, see `convert_to_raw_cache`
+
+    Returns:
+        number of images converted
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        converted = executor.map(
+            lambda img_path: convert_to_raw_cache(img_path, cache_dir, overwrite),
+            img_paths,
+        )
+        return sum(converted)
+
+
+def read_raw_cache_array(img_path, cache_dir) -> Optional[Tuple[np.memmap, Dict]]:
+    """read-only memory map of the cached [z,y,x(,c)] array of img_path and its header,
+    None if img_path is not cached or its cache is stale
+    """
+    header = load_raw_cache_header(img_path, cache_dir)
+    if header is None:
+        return None
+    raw_path, _ = get_raw_cache_paths(img_path, cache_dir)
+    img_arr = np.memmap(
+        raw_path, dtype=np.dtype(header["dtype"]), mode="r", shape=tuple(header["shape"])
+    )
+    return img_arr, header
+
+
+def _raw_cache_array_to_image(img_arr: np.ndarray, header: Dict, index=None) -> sitk.Image:
+    """copy img_arr (the whole cached array or a region of it starting at index) into a sitk.Image"""
+    img = sitk.GetImageFromArray(
+        np.asarray(img_arr, dtype=img_arr.dtype.newbyteorder("=")),
+        isVector=header["num_components"] > 1,
+    )
+    img.SetSpacing(header["spacing"])
+    img.SetDirection(header["direction"])
+    img.SetOrigin(header["origin"])
+    if index is not None:
+        img.SetOrigin(img.TransformIndexToPhysicalPoint([int(i) for i in index]))
+    return img
+
+
+def read_raw_cached_image(img_path, cache_dir) -> Optional[sitk.Image]:
+    """image at img_path read from its raw cache, None if not cached or stale"""
+    cached = read_raw_cache_array(img_path, cache_dir)
+    if cached is None:
+        return None
+    return _raw_cache_array_to_image(*cached)
+
+
+def read_raw_cached_region(img_path, cache_dir, index, size) -> Optional[sitk.Image]:
+    """region of `size` voxels starting at `index` of the raw cache of img_path,
+    only the pages of the region are read. None if not cached or stale
+    """
+    cached = read_raw_cache_array(img_path, cache_dir)
+    if cached is None:
+        return None
+    img_arr, header = cached
+    # flip from [x,y,z] to [z,y,x]
+    region = tuple(slice(i, i + sz) for i, sz in zip(index[::-1], size[::-1]))
+    return _raw_cache_array_to_image(img_arr[region], header, index)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="mirror the volumes of a dataset tree into a raw memory-mappable cache"
+    )
+    parser.add_argument("cache_dir")
+    parser.add_argument("dataset_dirs", nargs="+")
+    parser.add_argument("--pattern", default="*.nii.gz")
+    parser.add_argument("--num_workers", default=4, type=int)
+    parser.add_argument("--overwrite", action="store_true")
+
+    args = parser.parse_args()
+
+    img_paths = sorted(
+        p for dataset_dir in args.dataset_dirs for p in Path(dataset_dir).rglob(args.pattern)
+    )
+    print(f"found {len(img_paths)} images")
+    num_converted = build_raw_cache(
+        img_paths, args.cache_dir, args.num_workers, args.overwrite
+    )
+    print(f"converted {num_converted}, {len(img_paths) - num_converted} already cached")
+    print(f"export {RAW_CACHE_ENV}={Path(args.cache_dir).resolve()} to read from the cache")
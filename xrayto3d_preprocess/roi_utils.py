@@ -1,19 +1,30 @@
 import math
+from functools import lru_cache
 from logging import Logger
-from typing import Optional
+from typing import List, Optional, Sequence, Tuple
 
 import numpy as np
 import SimpleITK as sitk
 
+from .ioutils import ImageHeader, read_image_header, read_image_region
 from .metadata_utils import (
+    get_direction_from_orientation_code,
     get_opposite_axis,
     get_orientation_code_itk,
     is_superior_to_inferior,
     physical_size_to_voxel_size,
-    set_image_metadata,
+)
+from .sitk_utils import (
+    SegmentationIndex,
+    flip_image,
+    get_interpolator,
+    get_labels_bounding_box,
+    get_segmentation_index,
 )
 from .tuple_ops import add_tuple, divide_tuple_scalar, multiply_tuple, subtract_tuple
 
+DEFAULT_HEATMAP_TRUNCATE = 4.0  # heatmap support radius in units of sigma
+
 
 def infer_roi_origin_from_center(centre, roi_size):
     """Given a ROI of size `roi_size` in voxel units and whose centroid index is `centre`,
@@ -151,43 +162,392 @@ def required_padding_v2(
     return lowerbound_pad, upperbound_pad
 
 
-def extract_bbox_topleft(
+def _get_overlap_slices(img_size, start_index, size):
+    """numpy (z,y,x) slices of the overlap of a region with the image, in image and in region coordinates
+    None if the region does not overlap the image
+    """
+    lower = [max(st, 0) for st in start_index]
+    upper = [min(st + sz, img_sz) for st, sz, img_sz in zip(start_index, size, img_size)]
+    if not all(lo < up for lo, up in zip(lower, upper)):
+        return None
+    # flip from [x,y,z] to [z,y,x]
+    src = tuple(slice(lo, up) for lo, up in zip(lower[::-1], upper[::-1]))
+    dst = tuple(
+        slice(lo - st, up - st)
+        for lo, up, st in zip(lower[::-1], upper[::-1], start_index[::-1])
+    )
+    return src, dst
+
+
+def get_outside_region_mask(img_size, start_index, size) -> np.ndarray:
+    """boolean (z,y,x) mask of the voxels of a region that lie outside of an image of img_size"""
+    outside = np.ones([int(sz) for sz in size[::-1]], dtype=bool)
+    overlap = _get_overlap_slices(img_size, start_index, size)
+    if overlap is not None:
+        outside[overlap[1]] = False
+    return outside
+
+
+def _extract_region_from_array(
+    img: sitk.Image, img_arr: np.ndarray, start_index, size, padding_value
+) -> sitk.Image:
+    """copy the overlap of the region with `img_arr` (a view of img) into a buffer filled with padding_value"""
+    is_vector = img.GetNumberOfComponentsPerPixel() > 1
+    shape = size[::-1] + ([img.GetNumberOfComponentsPerPixel()] if is_vector else [])
+    roi_arr = np.empty(shape, dtype=img_arr.dtype)
+    # cast like itk does for the padding constant, e.g. -1024 in an unsigned image
+    roi_arr.fill(np.array(padding_value).astype(img_arr.dtype))
+
+    overlap = _get_overlap_slices(img.GetSize(), start_index, size)
+    if overlap is not None:
+        src, dst = overlap
+        roi_arr[dst] = img_arr[src]
+
+    region_of_interest = sitk.GetImageFromArray(roi_arr, isVector=is_vector)
+    region_of_interest.SetSpacing(img.GetSpacing())
+    region_of_interest.SetDirection(img.GetDirection())
+    region_of_interest.SetOrigin(img.TransformIndexToPhysicalPoint(start_index))
+    return region_of_interest
+
+
+def extract_region(img: sitk.Image, start_index, size, padding_value) -> sitk.Image:
+    """return the region of `size` voxels starting at `start_index` of img
+    the region may extend beyond the image, voxels outside of the image are set to `padding_value`.
+
+    Same output as `sitk.RegionOfInterest` of a sufficiently padded image, without padding the image:
+    only the slab overlapping the image is copied into a buffer filled with `padding_value`.
+    """
+    start_index = [int(idx) for idx in start_index]
+    size = [int(sz) for sz in size]
+    inside = all(
+        st >= 0 and st + sz <= img_sz
+        for st, sz, img_sz in zip(start_index, size, img.GetSize())
+    )
+    if inside:
+        return sitk.RegionOfInterest(img, size, start_index)
+    return _extract_region_from_array(
+        img, sitk.GetArrayViewFromImage(img), start_index, size, padding_value
+    )
+
+
+def extract_region_from_file(img_path, start_index, size, padding_value) -> sitk.Image:
+    """`extract_region` of the image at img_path without reading the whole image,
+    only the slab overlapping the region is read, see `read_image_region`
+    """
+    start_index = [int(idx) for idx in start_index]
+    size = [int(sz) for sz in size]
+    img_size = read_image_header(img_path).GetSize()
+    # overlap of the region with the image, at least one voxel so that the geometry is read
+    # along with it when the region is fully outside of the image
+    lower = [min(max(st, 0), img_sz - 1) for st, img_sz in zip(start_index, img_size)]
+    upper = [
+        max(min(st + sz, img_sz), lo + 1)
+        for st, sz, img_sz, lo in zip(start_index, size, img_size, lower)
+    ]
+    overlap = read_image_region(img_path, lower, subtract_tuple(upper, lower))
+    if list(overlap.GetSize()) == size:
+        return overlap
+    return _extract_region_from_array(
+        overlap,
+        sitk.GetArrayViewFromImage(overlap),
+        subtract_tuple(start_index, lower),
+        size,
+        padding_value,
+    )
+
+
+def extract_regions(
+    img: sitk.Image, start_indices, size, padding_value
+) -> List[sitk.Image]:
+    """`extract_region` of several regions of the same size, all cut from one numpy view of img"""
+    img_arr = sitk.GetArrayViewFromImage(img)
+    size = [int(sz) for sz in size]
+    return [
+        _extract_region_from_array(
+            img, img_arr, [int(idx) for idx in start_index], size, padding_value
+        )
+        for start_index in start_indices
+    ]
+
+
+def get_mirrored_region_start(start_index, size, img_size, flip_axes) -> List[int]:
+    """start index in img of the region starting at `start_index` in `mirror_image(img, flip_axes)`
+    flip_axes are numpy (z,y,x) axes like in `mirror_image`
+    """
+    flip_axes = [flip_axes] if isinstance(flip_axes, int) else list(flip_axes)
+    flip_dims = [len(img_size) - 1 - axis for axis in flip_axes]
+    return [
+        int(img_sz - st - sz) if dim in flip_dims else int(st)
+        for dim, (st, sz, img_sz) in enumerate(zip(start_index, size, img_size))
+    ]
+
+
+def extract_mirrored_region(
+    img: sitk.Image, start_index, size, padding_value, flip_axes
+) -> sitk.Image:
+    """`extract_region(mirror_image(img, flip_axes), ...)` without mirroring the whole img"""
+    start_index = [int(idx) for idx in start_index]
+    size = [int(sz) for sz in size]
+    region = extract_region(
+        img,
+        get_mirrored_region_start(start_index, size, img.GetSize(), flip_axes),
+        size,
+        padding_value,
+    )
+    mirrored_region = flip_image(region, flip_axes)
+    # mirror_image keeps the metadata of img
+    mirrored_region.SetOrigin(img.TransformIndexToPhysicalPoint(start_index))
+    return mirrored_region
+
+
+def mirror_crop(
+    crop: sitk.Image, crop_start_index, img: sitk.Image, flip_axes
+) -> Tuple[sitk.Image, List[int]]:
+    """the crop of `mirror_image(img, flip_axes)` corresponding to `crop` of img at crop_start_index
+
+    Returns:
+        mirrored crop and its start index in the mirrored img
+    """
+    start_index = get_mirrored_region_start(
+        crop_start_index, crop.GetSize(), img.GetSize(), flip_axes
+    )
+    mirrored_crop = flip_image(crop, flip_axes)
+    mirrored_crop.SetOrigin(img.TransformIndexToPhysicalPoint(start_index))
+    return mirrored_crop, start_index
+
+
+def extract_masked_rois(
+    ct: sitk.Image,
+    seg: sitk.Image,
+    seg_crop: sitk.Image,
+    crop_start_index,
+    roi_start_index,
+    voxel_size,
+    ct_padding,
+    seg_padding,
+    flip_axes=None,
+    label_id=1,
+) -> Tuple[sitk.Image, sitk.Image, sitk.Image]:
+    """ROI of the CT, the segmentation and the CT masked by `label_id` of the segmentation
+
+    `seg_crop` (at `crop_start_index` of seg) holds every non-zero voxel of the segmentation,
+    so the full segmentation volume and the full masked CT are never built.
+    With flip_axes, seg_crop and the indices are in the frame of `mirror_image(seg, flip_axes)`,
+    see `mirror_crop`.
+    Same output as `extract_region` of ct, seg and `mask_ct_with_seg(ct, seg)` (mirrored if flip_axes).
+    """
+    roi_start_index = [int(idx) for idx in roi_start_index]
+    voxel_size = [int(sz) for sz in voxel_size]
+    if flip_axes is None:
+        ct_roi = extract_region(ct, roi_start_index, voxel_size, ct_padding)
+    else:
+        ct_roi = extract_mirrored_region(
+            ct, roi_start_index, voxel_size, ct_padding, flip_axes
+        )
+    ct_arr = sitk.GetArrayViewFromImage(ct_roi)
+
+    # the segmentation is zero outside of the crop
+    seg_arr = sitk.GetArrayFromImage(
+        _extract_region_from_array(
+            seg_crop,
+            sitk.GetArrayViewFromImage(seg_crop),
+            subtract_tuple(roi_start_index, crop_start_index),
+            voxel_size,
+            0,
+        )
+    )
+    outside = get_outside_region_mask(seg.GetSize(), roi_start_index, voxel_size)
+
+    ct_mask_arr = np.where(seg_arr == label_id, ct_arr, 0).astype(ct_arr.dtype)
+    ct_mask_arr[outside] = np.array(ct_padding).astype(ct_arr.dtype)
+    seg_arr[outside] = np.array(seg_padding).astype(seg_arr.dtype)
+
+    seg_roi = sitk.GetImageFromArray(seg_arr)
+    seg_roi.SetSpacing(seg.GetSpacing())
+    seg_roi.SetDirection(seg.GetDirection())
+    seg_roi.SetOrigin(seg.TransformIndexToPhysicalPoint(roi_start_index))
+    ct_mask_roi = sitk.GetImageFromArray(ct_mask_arr)
+    ct_mask_roi.CopyInformation(ct_roi)
+    return ct_roi, seg_roi, ct_mask_roi
+
+
+def get_roi_start_indices(
+    img: sitk.Image, voxel_size, centroid_indices, extraction_ratio: dict
+) -> np.ndarray:
+    """(N, dim) start indices of the ROIs of `voxel_size` around (N, dim) centroid indices
+    at the given extraction ratio, see `extract_around_centroid_v2`
+    """
+    extraction_tuple = np.asarray(
+        update_extraction_ratio(get_orientation_code_itk(img), extraction_ratio)
+    )
+    # nearest voxel of the centroid (rounded half up like itk)
+    nearest_centroid_indices = np.floor(
+        np.asarray(centroid_indices, dtype=float).reshape(-1, img.GetDimension()) + 0.5
+    )
+    # s * r carries floating point noise, e.g. 60 * (1 - 0.7) = 18.000000000000004
+    start_indices = np.round(
+        nearest_centroid_indices - np.asarray(voxel_size) * extraction_tuple, 6
+    )
+    return np.floor(start_indices).astype(np.int64)
+
+
+def sample_region(
+    img: sitk.Image,
+    origin,
+    size,
+    spacing,
+    direction,
+    interpolator="linear",
+    padding_value=0,
+) -> sitk.Image:
+    """resample img onto the output grid (origin, size, spacing, direction) in a single pass
+    only the output grid is allocated, points outside of img are set to `padding_value`
+    """
+    if not isinstance(spacing, (tuple, list)):
+        spacing = (spacing,) * img.GetDimension()
+    return sitk.Resample(
+        img,
+        [int(sz) for sz in size],
+        sitk.Transform(),
+        get_interpolator(interpolator),
+        [float(o) for o in origin],
+        [float(sp) for sp in spacing],
+        [float(d) for d in direction],
+        float(padding_value),
+        img.GetPixelID(),
+    )
+
+
+def get_roi_sample_grid(img, start_index, voxel_size, axcode: str, res=None) -> Tuple:
+    """(origin, size, spacing, direction) of the ROI of `voxel_size` starting at `start_index` of img
+    after `reorient_to(roi, axcode)` and `make_isotropic(roi, res)`, see `sample_roi`
+    """
+    # source axis d maps onto the target axis e with alignment[d, e] = +-1
+    target_direction = get_direction_from_orientation_code(axcode)
+    alignment = np.round(
+        np.asarray(img.GetDirection()).reshape(3, 3).T
+        @ np.asarray(target_direction).reshape(3, 3)
+    )
+    # the corner of the ROI that becomes the first voxel after reorientation
+    first_index = [
+        int(st + sz - 1) if alignment[d].sum() < 0 else int(st)
+        for d, (st, sz) in enumerate(zip(start_index, voxel_size))
+    ]
+    target_axis = np.abs(alignment).argmax(axis=1)
+    target_size, target_spacing = [0] * 3, [0.0] * 3
+    for d, e in enumerate(target_axis):
+        target_spacing[e] = img.GetSpacing()[d] if res is None else res
+        target_size[e] = round(voxel_size[d] * img.GetSpacing()[d] / target_spacing[e])
+    return (
+        img.TransformIndexToPhysicalPoint(first_index),
+        target_size,
+        target_spacing,
+        target_direction,
+    )
+
+
+def sample_roi(
+    img: sitk.Image,
+    centroid_index,
+    physical_size,
+    extraction_ratio: dict,
+    axcode: str,
+    res=None,
+    interpolator=None,
+    padding_value=0,
+) -> sitk.Image:
+    """extract, reorient and resample a ROI with one interpolation pass
+
+    same grid as `extract_around_centroid_v2` followed by `reorient_to(roi, axcode)` and
+    `make_isotropic(roi, res)`, but img is resampled directly onto it, so every voxel is
+    interpolated once and only the ROI is allocated. res=None keeps the voxel spacing of img.
+    interpolator defaults to "nearest" if res is None (the output grid is a permutation of the
+    voxels of img, the ROI is exact) and to "linear" otherwise.
+    Use interpolator="nearest" for segmentations.
+    """
+    if interpolator is None:
+        interpolator = "nearest" if res is None else "linear"
+    voxel_size = physical_size_to_voxel_size(img, physical_size)
+    start_index = get_roi_start_indices(
+        img, voxel_size, [centroid_index], extraction_ratio
+    )[0]
+    return sample_region(
+        img,
+        *get_roi_sample_grid(img, start_index, voxel_size, axcode, res),
+        interpolator,
+        padding_value,
+    )
+
+
+def sample_pairs_around_centroids(
     img,
     seg,
-    label_id,
     physical_size,
-    padding_value,
-    add_topleft_space_in_voxels=3,
-    verbose=True,
-):
-    """extract ROI from img of given physical size by finding the bounding box with label id from seg image
-    and then extracting certain volume starting from top-left of the bounding box
-    This is for a specific use-case of extracting femur bones of certain length from varying crops.
-    This code only works for Totalsegmentator.
-    Various assumptions are built into the code (refactor/generalize!!)
-    1. Assume: The 3rd dim represents Superior-Inferior axis
+    centroid_indices: Sequence,
+    extraction_ratio: dict,
+    axcode: str,
+    img_padding_value,
+    seg_padding_value,
+) -> Tuple[List[sitk.Image], List[sitk.Image], List[dict]]:
+    """`extract_pairs_around_centroids` followed by `reorient_to(roi, axcode)` of every ROI,
+    each ROI is sampled from img (and seg) in one nearest neighbour pass, see `sample_roi`
+
+    Returns:
+        img ROIs, seg ROIs and centroid landmarks, one per centroid index
     """
     assert isinstance(img, sitk.Image)
     assert isinstance(seg, sitk.Image)
+    voxel_size = physical_size_to_voxel_size(img, physical_size)
+    start_indices = get_roi_start_indices(
+        img, voxel_size, centroid_indices, extraction_ratio
+    )
+    img_rois, seg_rois, roi_headers = [], [], []
+    for start_index in start_indices:
+        grid = get_roi_sample_grid(img, start_index, voxel_size, axcode)
+        img_rois.append(sample_region(img, *grid, "nearest", img_padding_value))
+        seg_rois.append(sample_region(seg, *grid, "nearest", seg_padding_value))
+        # the landmarks are placed on the ROI before reorientation, like `extract_pairs_around_centroids`
+        roi_headers.append(
+            ImageHeader(
+                voxel_size,
+                img.GetSpacing(),
+                img.TransformIndexToPhysicalPoint([int(idx) for idx in start_index]),
+                img.GetDirection(),
+                img.GetPixelID(),
+            )
+        )
+    return img_rois, seg_rois, get_roi_centroid_landmarks(img, roi_headers, centroid_indices)
 
-    voxel_size = physical_size_to_voxel_size(seg, physical_size)
 
-    # execute filter to obtain bounding box and centroid of given segmentation label
-    filtr = sitk.LabelShapeStatisticsImageFilter()
-    filtr.Execute(seg)
+def get_bbox_topleft_roi_start(
+    img,
+    seg,
+    label_id,
+    physical_size,
+    add_topleft_space_in_voxels=3,
+    verbose=True,
+) -> Tuple[List[int], Tuple]:
+    """start index in img and voxel size of the ROI extracted by `extract_bbox_topleft`
+    seg may also be a crop of the segmentation of img, e.g. see `crop_to_labels`,
+    or its `SegmentationIndex`
+    """
+    seg = get_segmentation_index(seg)
+    voxel_size = physical_size_to_voxel_size(seg, physical_size)
 
-    labels = filtr.GetLabels()
+    labels = seg.GetLabels()
 
     # make sure the label being asked for exists in the segmentation map
     assert label_id in labels
 
-    bbox = filtr.GetBoundingBox(label_id)
-    centroid_index = img.TransformPhysicalPointToIndex(filtr.GetCentroid(label_id))
-    bbox_origin, bbox_size = list(bbox[:3]), list(bbox[3:])
+    # index of the first voxel of seg in img (zero unless seg is a crop)
+    seg_offset = img.TransformPhysicalPointToIndex(seg.GetOrigin())
+    bbox = seg.GetBoundingBox(label_id)
+    centroid_index = img.TransformPhysicalPointToIndex(seg.GetCentroid(label_id))
+    bbox_origin, bbox_size = list(add_tuple(bbox[:3], seg_offset)), list(bbox[3:])
     bbox_origin[0] = int(centroid_index[0] - voxel_size[0] // 2)
     bbox_origin[1] = int(centroid_index[1] - voxel_size[1] // 2)
 
-    orientation = get_orientation_code_itk(seg)
+    orientation = get_orientation_code_itk(seg.GetDirection())
     # crop along the Inferior-Superior axis
     if (
         bbox_size[2] >= voxel_size[2]
@@ -203,23 +563,64 @@ def extract_bbox_topleft(
             pass
             # TODO: handle the inferior to superior axis
 
-    # pad the image and obtain the bbox origin index in padded image
-    lb_padded = (50,) * 3
-    ub_padded = (50,) * 3
-    padded_img: sitk.Image = sitk.ConstantPad(img, lb_padded, ub_padded, padding_value)
-    physical_coords_bbox_origin = img.TransformIndexToPhysicalPoint(bbox_origin)
-    padded_bbox_origin_index = padded_img.TransformPhysicalPointToIndex(
-        physical_coords_bbox_origin
-    )
     if verbose:
-        print(f"Centroid {filtr.GetCentroid(label_id)}")
+        print(f"Centroid {seg.GetCentroid(label_id)}")
         print(
-            f"origin {bbox_origin} padded origin {padded_bbox_origin_index} padded imagesize {padded_img.GetSize()} Extent {add_tuple(voxel_size,padded_bbox_origin_index)}"
+            f"origin {bbox_origin} imagesize {img.GetSize()} Extent {add_tuple(voxel_size,bbox_origin)}"
         )
-    region_of_interest = sitk.RegionOfInterest(
-        padded_img, voxel_size, padded_bbox_origin_index
+    return bbox_origin, voxel_size
+
+
+def extract_bbox_topleft(
+    img,
+    seg,
+    label_id,
+    physical_size,
+    padding_value,
+    add_topleft_space_in_voxels=3,
+    verbose=True,
+):
+    """extract ROI from img of given physical size by finding the bounding box with label id from seg image
+    and then extracting certain volume starting from top-left of the bounding box
+    This is for a specific use-case of extracting femur bones of certain length from varying crops.
+    This code only works for Totalsegmentator.
+    Various assumptions are built into the code (refactor/generalize!!)
+    1. Assume: The 3rd dim represents Superior-Inferior axis
+    seg may also be the `SegmentationIndex` of the segmentation
+    """
+    assert isinstance(img, sitk.Image)
+    assert isinstance(seg, (sitk.Image, SegmentationIndex))
+
+    roi_start_index, voxel_size = get_bbox_topleft_roi_start(
+        img, seg, label_id, physical_size, add_topleft_space_in_voxels, verbose
     )
-    return region_of_interest
+    return extract_region(img, roi_start_index, voxel_size, padding_value)
+
+
+def get_bbox_roi_start(
+    img, seg, label_id, physical_size, verbose=True
+) -> Tuple[List[int], Tuple]:
+    """start index in img and voxel size of the ROI extracted by `extract_bbox`
+    seg may also be a crop of the segmentation of img, e.g. see `crop_to_labels`,
+    or its `SegmentationIndex`
+    """
+    voxel_size = physical_size_to_voxel_size(img, physical_size)
+
+    seg = get_segmentation_index(seg)
+    labels = seg.GetLabels()
+
+    # make sure the label being asked for exists in the segmentation map
+    assert label_id in labels
+
+    # ROI of given voxel size around the Bounding Box centroid
+    centroid_index = img.TransformPhysicalPointToIndex(seg.GetCentroid(label_id))
+    roi_start_index = list(infer_roi_origin_from_center(centroid_index, voxel_size))
+
+    if verbose:
+        print(f"Label Bounding Box: {seg.GetBoundingBox(label_id)}")
+        print(f"Coordinates of Segmentation Centroid {centroid_index}")
+
+    return roi_start_index, voxel_size
 
 
 def extract_bbox(img, seg, label_id, physical_size, padding_value, verbose=True):
@@ -227,52 +628,47 @@ def extract_bbox(img, seg, label_id, physical_size, padding_value, verbose=True)
 
     Args:
         img (sitk.Image):
-        seg (sitk.Image):
+        seg (sitk.Image or SegmentationIndex):
         physical_size (tuple): _description_
         padding_value (scalar): value to fill in for region outside of the image
         verbose (bool, optional): print additional information. Defaults to True.
     """
     assert isinstance(img, sitk.Image)
-    assert isinstance(seg, sitk.Image)
-
-    voxel_size = physical_size_to_voxel_size(img, physical_size)
-
-    # execute filter to obtain bounding box and centroid of given segmentation label
-    fltr = sitk.LabelShapeStatisticsImageFilter()
-    fltr.Execute(seg)
+    assert isinstance(seg, (sitk.Image, SegmentationIndex))
 
-    labels = fltr.GetLabels()
-
-    # make sure the label being asked for exists in the segmentation map
-    assert label_id in labels
-
-    # pad around Bounding Box centroid to attain given voxel size
-    centroid_index = img.TransformPhysicalPointToIndex(fltr.GetCentroid(label_id))
-    lb, ub = required_padding(img, voxel_size, centroid_index, verbose=True)
-    lb_padded = add_tuple(lb, (50,) * 3)
-    ub_padded = add_tuple(
-        ub, (50,) * 3
-    )  # the exact padding can be off due to floating point ops, hence add safety padding
-    padded_img: sitk.Image = sitk.ConstantPad(img, lb_padded, ub_padded, padding_value)
-
-    # find the index of the centroid in the padded image
-    padded_centroid_index = padded_img.TransformPhysicalPointToIndex(
-        fltr.GetCentroid(label_id)
+    roi_start_index, voxel_size = get_bbox_roi_start(
+        img, seg, label_id, physical_size, verbose
     )
+    return extract_region(img, roi_start_index, voxel_size, padding_value)
 
-    # get the start of the ROI
-    roi_start_index = infer_roi_origin_from_center(padded_centroid_index, voxel_size)
-    region_of_interest: sitk.Image = sitk.RegionOfInterest(
-        padded_img, voxel_size, roi_start_index
-    )
 
-    if verbose:
-        print(f"Label Bounding Box: {fltr.GetBoundingBox(label_id)}")
-        print(
-            f"Coordinates of Segmentation Centroid {img.TransformPhysicalPointToIndex(fltr.GetCentroid(label_id))}"
-        )
+def crop_to_labels(
+    seg: sitk.Image,
+    stats: Optional[SegmentationIndex] = None,
+    label_ids: Optional[Sequence] = None,
+    margin=1,
+) -> Tuple[Optional[sitk.Image], Optional[List[int]]]:
+    """crop seg to the bounding box of `label_ids` (default: all labels) plus `margin` voxels
+    the crop keeps its physical position, so ROI geometry can be computed on it.
+    stats defaults to the memoized `SegmentationIndex` of seg
 
-    return region_of_interest
+    Returns:
+        crop and its start index in seg, (None, None) if none of the labels is present
+    """
+    if stats is None:
+        stats = get_segmentation_index(seg)
+    bbox = get_labels_bounding_box(stats, label_ids)
+    if bbox is None:
+        return None, None
+    start_index = [max(st - margin, 0) for st in bbox[0]]
+    end_index = [
+        min(st + sz + margin, seg_sz)
+        for st, sz, seg_sz in zip(bbox[0], bbox[1], seg.GetSize())
+    ]
+    return (
+        sitk.RegionOfInterest(seg, subtract_tuple(end_index, start_index), start_index),
+        start_index,
+    )
 
 
 def extract_around_centroid_v2(
@@ -283,6 +679,7 @@ def extract_around_centroid_v2(
     padding_value,
     verbose=True,
     logger: Optional[Logger] = None,
+    return_landmark=False,
 ):
     """extract ROI from img of given physical size at a given ratio w.r.t the centroid_index
 
@@ -293,6 +690,8 @@ def extract_around_centroid_v2(
         extraction_ratio (dict): {'P':0.33, 'L':0.5,'S': 0.5}
         padding_value (scalar): value to fill in for region outside of img
         verbose (bool, optional): print diagnostic info. Defaults to True.
+        return_landmark (bool, optional): return the centroid landmark (see `get_centroid_landmark`)
+            instead of rendering the centroid heatmap volume. Defaults to False.
 
     postcondition:
         The actual extracted voxel tuple can be less by 1 voxel due to truncation error.
@@ -301,51 +700,28 @@ def extract_around_centroid_v2(
     assert isinstance(img, sitk.Image)
     voxel_size = physical_size_to_voxel_size(img, physical_size)
 
-    lower_bound, upper_bound = required_padding_v2(
-        img, voxel_size, centroid_index, extraction_ratio, verbose=verbose
-    )
-    lb_padded = add_tuple(lower_bound, (50,) * 3)
-    ub_padded = add_tuple(
-        upper_bound, (50,) * 3
-    )  # the exact padding can be off due to floating point ops, hence add safety padding
-    padded_vol: sitk.Image = sitk.ConstantPad(img, lb_padded, ub_padded, padding_value)
-
-    # find the index of the centroid in the padded image
     original_centroid_coords = img.TransformContinuousIndexToPhysicalPoint(
         centroid_index
     )
-    padded_centroid_index = padded_vol.TransformPhysicalPointToIndex(
-        original_centroid_coords
-    )
-
-    # get the start of the ROI
-    extraction_tuple = update_extraction_ratio(
-        get_orientation_code_itk(img), extraction_ratio
-    )
-
-    roi_start_index = infer_roi_origin_from_center_v2(
-        padded_centroid_index, voxel_size, extraction_tuple
-    )
+    roi_start_index = get_roi_start_indices(
+        img, voxel_size, [centroid_index], extraction_ratio
+    )[0].tolist()
 
     if logger:
-        # check ROI outside the largest possible region
-        roi_outside = [
-            True if elem < 0 else False
-            for elem in subtract_tuple(
-                padded_vol.GetSize(), add_tuple(roi_start_index, voxel_size)
-            )
+        # check ROI outside of the image
+        lower_pad = [max(0, -st) for st in roi_start_index]
+        upper_pad = [
+            max(0, ub - img_sz)
+            for ub, img_sz in zip(add_tuple(roi_start_index, voxel_size), img.GetSize())
         ]
-        if np.any(roi_outside):
-            spilled_volume = subtract_tuple(
-                padded_vol.GetSize(), add_tuple(roi_start_index, voxel_size)
-            )
+        if np.any(lower_pad) or np.any(upper_pad):
             logger.debug(
-                f"possibly requested ROI outside of region: origin {roi_start_index} to extract {voxel_size}\
-                  from padded_img size {padded_vol.GetSize()} by {spilled_volume}"
+                f"requested ROI partially outside of image: origin {roi_start_index} to extract {voxel_size}\
+                  from img size {img.GetSize()}, padding lower {lower_pad} upper {upper_pad}"
             )
 
-    region_of_interest: sitk.Image = sitk.RegionOfInterest(
-        padded_vol, voxel_size, roi_start_index
+    region_of_interest = extract_region(
+        img, roi_start_index, voxel_size, padding_value
     )
 
     roi_vertebra_centroid_index = (
@@ -354,53 +730,213 @@ def extract_around_centroid_v2(
         )
     )
 
-    heatmap = generate_gaussian_heatmap(roi_vertebra_centroid_index, region_of_interest)
     if verbose:
         print(f"Vertebra centroid in ROI Index{roi_vertebra_centroid_index}")
 
+    if return_landmark:
+        return region_of_interest, get_centroid_landmark(
+            roi_vertebra_centroid_index, region_of_interest
+        )
+    heatmap = generate_gaussian_heatmap(roi_vertebra_centroid_index, region_of_interest)
     return region_of_interest, heatmap
 
 
-def generate_gaussian_heatmap(centroid_index, reference_image, sigma=5):
+def extract_around_centroids(
+    img,
+    physical_size,
+    centroid_indices: Sequence,
+    extraction_ratio: dict,
+    padding_value,
+) -> Tuple[List[sitk.Image], List[dict]]:
+    """`extract_around_centroid_v2(..., return_landmark=True)` of several centroids at once
+    the ROI boxes are computed in one vectorized step and cut from one numpy view of img
+
+    Returns:
+        ROIs and centroid landmarks, one per centroid index
+    """
+    assert isinstance(img, sitk.Image)
+    voxel_size = physical_size_to_voxel_size(img, physical_size)
+    start_indices = get_roi_start_indices(
+        img, voxel_size, centroid_indices, extraction_ratio
+    )
+    regions = extract_regions(img, start_indices, voxel_size, padding_value)
+    return regions, get_roi_centroid_landmarks(img, regions, centroid_indices)
+
+
+def extract_pair_around_centroid(
+    img,
+    seg,
+    physical_size,
+    centroid_index,
+    extraction_ratio: dict,
+    img_padding_value,
+    seg_padding_value,
+    return_heatmap=False,
+):
+    """`extract_around_centroid_v2` of an image and its segmentation (on the same grid)
+    the ROI geometry is computed once and both ROIs are cut from it.
+    The centroid heatmap is only rendered if `return_heatmap`, otherwise the centroid
+    landmark is returned (see `get_centroid_landmark`)
+
+    Returns:
+        img ROI, seg ROI and centroid landmark (or heatmap)
+    """
+    img_rois, seg_rois, landmarks = extract_pairs_around_centroids(
+        img,
+        seg,
+        physical_size,
+        [centroid_index],
+        extraction_ratio,
+        img_padding_value,
+        seg_padding_value,
+    )
+    img_roi, seg_roi, landmark = img_rois[0], seg_rois[0], landmarks[0]
+    if return_heatmap:
+        return img_roi, seg_roi, render_centroid_heatmap(landmark, img_roi)
+    return img_roi, seg_roi, landmark
+
+
+def extract_pairs_around_centroids(
+    img,
+    seg,
+    physical_size,
+    centroid_indices: Sequence,
+    extraction_ratio: dict,
+    img_padding_value,
+    seg_padding_value,
+) -> Tuple[List[sitk.Image], List[sitk.Image], List[dict]]:
+    """`extract_around_centroids` of an image and its segmentation (on the same grid)
+    sharing the ROI boxes computed from img
+
+    Returns:
+        img ROIs, seg ROIs and centroid landmarks, one per centroid index
+    """
+    assert isinstance(img, sitk.Image)
+    assert isinstance(seg, sitk.Image)
+    voxel_size = physical_size_to_voxel_size(img, physical_size)
+    start_indices = get_roi_start_indices(
+        img, voxel_size, centroid_indices, extraction_ratio
+    )
+    img_rois = extract_regions(img, start_indices, voxel_size, img_padding_value)
+    seg_rois = extract_regions(seg, start_indices, voxel_size, seg_padding_value)
+    return img_rois, seg_rois, get_roi_centroid_landmarks(img, img_rois, centroid_indices)
+
+
+def get_roi_centroid_landmarks(img, rois: Sequence, centroid_indices: Sequence) -> List[dict]:
+    """centroid landmark (see `get_centroid_landmark`) of each centroid index of img in its ROI"""
+    landmarks = []
+    for region_of_interest, centroid_index in zip(rois, centroid_indices):
+        roi_centroid_index = region_of_interest.TransformPhysicalPointToContinuousIndex(
+            img.TransformContinuousIndexToPhysicalPoint(centroid_index)
+        )
+        landmarks.append(get_centroid_landmark(roi_centroid_index, region_of_interest))
+    return landmarks
+
+
+def get_centroid_landmark(centroid_index, reference_image, sigma=5) -> dict:
+    """parameters of the gaussian heatmap `generate_gaussian_heatmap` would render
+
+    the (truncated) centroid index is stored as a physical point so that the landmark
+    remains valid after the reference image is reoriented
+    """
+    centroid_index = [int(idx) for idx in centroid_index]
+    return {
+        "centroid": list(reference_image.TransformIndexToPhysicalPoint(centroid_index)),
+        "sigma": sigma,
+    }
+
+
+def get_landmark_index(landmark: dict, reference_image) -> tuple:
+    """voxel index of the landmark centroid in the reference image"""
+    return reference_image.TransformPhysicalPointToIndex(landmark["centroid"])
+
+
+def render_centroid_heatmap(landmark: dict, reference_image):
+    """render the gaussian heatmap volume of a centroid landmark on the reference image grid"""
+    return generate_gaussian_heatmap(
+        get_landmark_index(landmark, reference_image),
+        reference_image,
+        sigma=landmark["sigma"],
+    )
+
+
+@lru_cache(maxsize=32)
+def get_gaussian_kernel_1d(spacing, sigma, truncate=DEFAULT_HEATMAP_TRUNCATE) -> np.ndarray:
+    """1D gaussian exp(-x^2 / 2 sigma^2) sampled every `spacing` mm within `truncate` sigma of the centre
+    the centre sample is at index `len(kernel) // 2`
+    """
+    radius = int(math.ceil(truncate * sigma / spacing))
+    distance = np.arange(-radius, radius + 1) * spacing
+    kernel = np.exp(-(distance * distance) / (2 * math.pow(sigma, 2))).astype(np.float32)
+    kernel.flags.writeable = False
+    return kernel
+
+
+def generate_gaussian_heatmap(
+    centroid_index,
+    reference_image,
+    sigma=5,
+    truncate=DEFAULT_HEATMAP_TRUNCATE,
+    pixeltype=sitk.sitkFloat32,
+):
     """Generate a Centroid Landmark Image represented by a Gaussian at the centroid index
     with same physical attributes as the reference image
 
     adapted from https://github.com/christianpayer/MedicalDataAugmentationTool/tree/master/utils/landmark
 
+    The gaussian is evaluated directly on the reference grid as an outer product of 1D kernels,
+    only voxels within `truncate` * sigma of the centroid are written.
+
     Args:
-        centroid_index (tuple:int):
-        volume_size (tuple): _description_
-        reference_image (sitk.Image): _description_
+        centroid_index (tuple:int): index of the centroid in the reference image
+        reference_image (sitk.Image): image whose grid the heatmap is rendered on
+        sigma (float): standard deviation in mm
+        truncate (float): support radius of the gaussian in units of sigma
+        pixeltype: sitk.sitkFloat32 (peak value is the smallest physical extent of the image in mm)
+            or an unsigned integer type (peak value is quantized to the maximum of the type)
     """
     img_sz = reference_image.GetSize()
     img_thickness = reference_image.GetSpacing()
-    iso_img_sz = multiply_tuple(img_sz, img_thickness)
-    iso_img_sz = list(map(int, iso_img_sz))
-
-    # flip point from [x,y,z] to [z,y,x]
+    iso_img_sz = list(map(int, multiply_tuple(img_sz, img_thickness)))
     centroid_index = list(map(int, centroid_index))
-    flipped_coords = np.flip(centroid_index, 0)
-    flipped_image_thickness = np.flip(img_thickness, 0)
-    dy, dx, dz = np.meshgrid(
-        range(iso_img_sz[1]), range(iso_img_sz[0]), range(iso_img_sz[2])
-    )
 
-    x_diff = dx - flipped_coords[0] * flipped_image_thickness[0]
-    y_diff = dy - flipped_coords[1] * flipped_image_thickness[1]
-    z_diff = dz - flipped_coords[2] * flipped_image_thickness[2]
+    if pixeltype == sitk.sitkFloat32:
+        amplitude, dtype = min(iso_img_sz), np.float32
+    elif pixeltype in (sitk.sitkUInt8, sitk.sitkUInt16):
+        dtype = np.uint8 if pixeltype == sitk.sitkUInt8 else np.uint16
+        amplitude = np.iinfo(dtype).max
+    else:
+        raise ValueError(
+            f"pixeltype should be one of sitkFloat32, sitkUInt8 or sitkUInt16, got {pixeltype}"
+        )
+
+    heatmap = np.zeros(img_sz[::-1], dtype=dtype)
+    # crop the 1D kernel of every dimension to the image, flip from [x,y,z] to [z,y,x]
+    window, profiles = [], []
+    for dim in reversed(range(len(img_sz))):
+        kernel = get_gaussian_kernel_1d(float(img_thickness[dim]), float(sigma), truncate)
+        radius = len(kernel) // 2
+        lower = max(centroid_index[dim] - radius, 0)
+        upper = min(centroid_index[dim] + radius + 1, img_sz[dim])
+        if lower >= upper:
+            # gaussian support lies outside of the image
+            window = None
+            break
+        window.append(slice(lower, upper))
+        profiles.append(
+            kernel[lower - centroid_index[dim] + radius : upper - centroid_index[dim] + radius]
+        )
 
-    squared_distances = x_diff * x_diff + y_diff * y_diff + z_diff * z_diff
-    heatmap = min(iso_img_sz) * np.exp(-squared_distances / (2 * math.pow(sigma, 2)))
+    if window is not None:
+        block = amplitude * profiles[0]
+        for profile in profiles[1:]:
+            block = np.multiply.outer(block, profile)
+        if dtype != np.float32:
+            block = np.rint(block)
+        heatmap[tuple(window)] = block
 
     heatmap_sitk = sitk.GetImageFromArray(heatmap)
-    set_image_metadata(
-        heatmap_sitk,
-        origin=reference_image.GetOrigin(),
-        direction=reference_image.GetDirection(),
-        spacing=(1, 1, 1),
-    )
-    heatmap_sitk = sitk.Resample(heatmap_sitk, reference_image)
-
+    heatmap_sitk.CopyInformation(reference_image)
     return heatmap_sitk
 
 
@@ -0,0 +1,284 @@
+"""node-local shared memory volume cache service
+
+Scripts running at the same time on one node (and every worker of their multiprocessing pools)
+would each decompress the same scans. The cache daemon reads a volume once into a segment of
+/dev/shm and serves it to every process: clients ask for a path over a Unix socket and map the
+segment read-only, a volume is decompressed once per node. Least recently used segments are
+removed once the cached volumes take more than the byte budget. A client that still maps a
+removed segment keeps its memory until it unmaps it.
+
+Only `map_shm_cached_volume` is zero-copy. `read_image` copies the whole volume out of the
+segment into a sitk.Image (a memory copy instead of a decompression), `read_image_region` copies
+only the region it reads.
+
+start the daemon:
+    python -m xrayto3d_preprocess.shm_cache --socket /tmp/xrayto3d_shm_cache.sock --max_gb 32
+and point `read_image` of the scripts to it:
+    XRAYTO3D_SHM_CACHE=/tmp/xrayto3d_shm_cache.sock python preprocess_totalsegmentor_hip.py configs/...
+"""
+import json
+import mmap
+import os
+import socket
+import socketserver
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+from .raw_cache import get_raw_cache_dir, read_raw_cached_image
+
+SHM_CACHE_ENV = "XRAYTO3D_SHM_CACHE"
+DEFAULT_SHM_DIR = "/dev/shm"
+DEFAULT_SHM_CACHE_BYTES = 16 * 2**30
+# seconds to wait for the daemon, a miss decompresses the whole scan before the reply
+SHM_CACHE_TIMEOUT = 120.0
+
+
+def get_shm_cache_socket() -> Optional[str]:
+    """socket of the cache daemon set in the XRAYTO3D_SHM_CACHE environment variable, None if unset"""
+    return os.environ.get(SHM_CACHE_ENV) or None
+
+
+class ShmVolumeCache:
+    """volumes held in files of `shm_dir` (tmpfs), keyed by (resolved path, mtime, file size),
+    with least recently used eviction beyond `max_bytes`
+    """
+
+    def __init__(self, max_bytes=DEFAULT_SHM_CACHE_BYTES, shm_dir=DEFAULT_SHM_DIR):
+        self.max_bytes = max_bytes
+        self.shm_dir = shm_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._segments: "OrderedDict[tuple, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        # one lock per volume being read, concurrent requests of the same file read it once
+        self._read_locks: Dict[tuple, threading.Lock] = {}
+        self._counter = 0
+
+    def _read_volume(self, img_path: str) -> sitk.Image:
+        raw_cache_dir = get_raw_cache_dir()
+        if raw_cache_dir is not None:
+            img = read_raw_cached_image(img_path, raw_cache_dir)
+            if img is not None:
+                return img
+        return sitk.ReadImage(img_path)
+
+    def _write_segment(self, img: sitk.Image) -> Dict:
+        img_arr = sitk.GetArrayViewFromImage(img)
+        with self._lock:
+            self._counter += 1
+            shm_path = os.path.join(
+                self.shm_dir, f"xrayto3d_{os.getpid()}_{self._counter}"
+            )
+        tmp_path = f"{shm_path}.tmp"
+        # /dev/shm is shared by every user of the node, only the owner may read the scans
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as shm_file:
+            np.ascontiguousarray(img_arr).tofile(shm_file)
+        os.replace(tmp_path, shm_path)
+        return {
+            "shm_path": shm_path,
+            "shape": list(img_arr.shape),
+            "dtype": img_arr.dtype.str,
+            "nbytes": int(img_arr.nbytes),
+            "spacing": list(img.GetSpacing()),
+            "origin": list(img.GetOrigin()),
+            "direction": list(img.GetDirection()),
+            "num_components": img.GetNumberOfComponentsPerPixel(),
+        }
+
+    def _remove_segment(self, segment: Dict):
+        self.nbytes -= segment["nbytes"]
+        if os.path.exists(segment["shm_path"]):
+            os.remove(segment["shm_path"])
+
+    def get(self, img_path) -> Dict:
+        """segment holding the volume at img_path, read into shared memory on first request"""
+        img_path = str(Path(img_path).resolve())
+        stat = os.stat(img_path)
+        key = (img_path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            read_lock = self._read_locks.setdefault(key, threading.Lock())
+        with read_lock:
+            try:
+                with self._lock:
+                    segment = self._segments.get(key)
+                    if segment is not None:
+                        self.hits += 1
+                        self._segments.move_to_end(key)
+                        return segment
+                    self.misses += 1
+                segment = self._write_segment(self._read_volume(img_path))
+                with self._lock:
+                    # drop older versions of the file
+                    for stale_key in [k for k in self._segments if k[0] == img_path]:
+                        self._remove_segment(self._segments.pop(stale_key))
+                    self._segments[key] = segment
+                    self.nbytes += segment["nbytes"]
+                    # evict least recently used volumes, the requested one is always served
+                    while self.nbytes > self.max_bytes and len(self._segments) > 1:
+                        _, evicted = self._segments.popitem(last=False)
+                        self._remove_segment(evicted)
+                return segment
+            finally:
+                # the segment is inserted by now, later requests find it without the read lock
+                with self._lock:
+                    if self._read_locks.get(key) is read_lock:
+                        del self._read_locks[key]
+
+    def clear(self):
+        with self._lock:
+            while self._segments:
+                _, segment = self._segments.popitem()
+                self._remove_segment(segment)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "volumes": len(self._segments),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class _ShmCacheRequestHandler(socketserver.StreamRequestHandler):
+    """one json request per line: {"path": ...} or {"stats": true}, one json reply per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            try:
+                if request.get("stats"):
+                    reply = self.server.volume_cache.stats()
+                else:
+                    reply = self.server.volume_cache.get(request["path"])
+            except Exception as e:  # reported to the client, which reads the file itself
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ShmCacheServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, volume_cache: ShmVolumeCache):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.volume_cache = volume_cache
+        super().__init__(str(socket_path), _ShmCacheRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.volume_cache.clear()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _request(socket_path, request: Dict) -> Dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(SHM_CACHE_TIMEOUT)
+        client.connect(str(socket_path))
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile("rb") as reply_file:
+            return json.loads(reply_file.readline())
+
+
+def map_shm_cached_volume(
+    img_path, socket_path=None
+) -> Optional[Tuple[np.ndarray, Dict]]:
+    """read-only [z,y,x(,c)] array of the volume at img_path, mapped zero-copy from the segment
+    of the cache daemon, and its geometry (spacing, origin, direction).
+    None if no daemon is running, it could not read the file, did not reply in time or
+    the segment could not be mapped, the caller then reads the file itself
+    """
+    socket_path = socket_path or get_shm_cache_socket()
+    if socket_path is None:
+        return None
+    try:
+        segment = _request(socket_path, {"path": str(Path(img_path).resolve())})
+        if "error" in segment:
+            return None
+        with open(segment["shm_path"], "rb") as shm_file:
+            # the mapping outlives the file, even if the daemon evicts the segment
+            shm_map = mmap.mmap(shm_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # socket errors and timeouts, a dropped connection (no json reply), a segment of
+        # another user or an empty segment
+        return None
+    img_arr = np.frombuffer(shm_map, dtype=np.dtype(segment["dtype"])).reshape(
+        segment["shape"]
+    )
+    return img_arr, segment
+
+
+def _shm_array_to_image(img_arr: np.ndarray, segment: Dict, index=None) -> sitk.Image:
+    """copy img_arr (the whole mapped array or a region of it starting at index) into a sitk.Image"""
+    img = sitk.GetImageFromArray(img_arr, isVector=segment["num_components"] > 1)
+    img.SetSpacing(segment["spacing"])
+    img.SetDirection(segment["direction"])
+    img.SetOrigin(segment["origin"])
+    if index is not None:
+        img.SetOrigin(img.TransformIndexToPhysicalPoint([int(i) for i in index]))
+    return img
+
+
+def read_shm_cached_image(img_path, socket_path=None) -> Optional[sitk.Image]:
+    """image at img_path copied from the cache daemon, None if it is not available
+    a sitk.Image owns its buffer, the whole volume is copied out of the mapped segment
+    """
+    mapped = map_shm_cached_volume(img_path, socket_path)
+    if mapped is None:
+        return None
+    return _shm_array_to_image(*mapped)
+
+
+def read_shm_cached_region(img_path, index, size, socket_path=None) -> Optional[sitk.Image]:
+    """region of `size` voxels starting at `index` of the volume at img_path,
+    only the region is copied out of the mapped segment. None if the daemon is not available
+    """
+    mapped = map_shm_cached_volume(img_path, socket_path)
+    if mapped is None:
+        return None
+    img_arr, segment = mapped
+    # flip from [x,y,z] to [z,y,x]
+    region = tuple(slice(i, i + sz) for i, sz in zip(index[::-1], size[::-1]))
+    return _shm_array_to_image(img_arr[region], segment, index)
+
+
+def get_shm_cache_stats(socket_path=None) -> Dict:
+    return _request(socket_path or get_shm_cache_socket(), {"stats": True})
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="serve volumes from shared memory to the scripts running on this node"
+    )
+    parser.add_argument("--socket", default="/tmp/xrayto3d_shm_cache.sock")
+    parser.add_argument("--max_gb", default=DEFAULT_SHM_CACHE_BYTES / 2**30, type=float)
+    parser.add_argument("--shm_dir", default=DEFAULT_SHM_DIR)
+
+    args = parser.parse_args()
+
+    server = ShmCacheServer(
+        args.socket, ShmVolumeCache(int(args.max_gb * 2**30), args.shm_dir)
+    )
+    # remove the segments on `kill` as well as on ctrl-c
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"serving volumes on {args.socket}, export {SHM_CACHE_ENV}={args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
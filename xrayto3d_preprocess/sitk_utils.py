@@ -1,6 +1,10 @@
 """simpleitk utils"""
 import math
-from typing import Union, List
+import os
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 import nibabel.orientations as nio
 import numpy as np
@@ -8,6 +12,7 @@ import SimpleITK as sitk
 
 from .enumutils import ProjectionType
 from .ioutils import read_image, write_image
+from .label_utils import relabel
 from .metadata_utils import get_orientation_code_itk
 from .tuple_ops import all_elements_equal
 
@@ -38,25 +43,84 @@ def get_largest_connected_component(binary_image: sitk.Image):
     return largest_component_binary_image
 
 
-def combine_segmentations(imgs: List[sitk.Image], ref_img: sitk.Image, fill_label=1):
+def _iter_segmentations(imgs: Iterable, num_workers: int) -> Iterator[sitk.Image]:
+    """yield the images in order, paths are read in a thread pool
+    at most `num_workers` reads are in flight ahead of the image being consumed
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for img in imgs:
+            pending.append(
+                img if isinstance(img, sitk.Image) else executor.submit(read_image, img)
+            )
+            if len(pending) > num_workers:
+                img = pending.popleft()
+                yield img if isinstance(img, sitk.Image) else img.result()
+        while pending:
+            img = pending.popleft()
+            yield img if isinstance(img, sitk.Image) else img.result()
+
+
+def combine_segmentations(
+    imgs: Iterable[Union[sitk.Image, str, os.PathLike]],
+    ref_img: Optional[sitk.Image] = None,
+    fill_label=1,
+    return_multilabel=False,
+    labels: Optional[Sequence[int]] = None,
+    num_workers=2,
+):
     """Combine multiple segmentation images into a single segmentation image.
 
+    imgs may be images, paths or a generator of either. Paths are read in a small thread pool and
+    each segmentation is merged into a single uint8 buffer and released right away, so only the
+    combined buffer(s) and the few segmentations being read are in memory at any time.
+
     Precondition:
         segmentation masks do not overlap
 
     Postcondition:
-        a new segmentation images is returned where voxels are filled with fill_label
-        if the voxel position is labelled in one of the segmentation image
+        a new uint8 segmentation image (with the geometry of ref_img, default: the first segmentation)
+        is returned where voxels are filled with fill_label if the voxel position is labelled
+        in one of the segmentation image.
+        if return_multilabel, a multi-label map where the voxels of the i-th segmentation are filled
+        with labels[i] (default: i + 1) is returned as well
     """
-    new_seg = np.zeros_like(sitk.GetArrayFromImage(ref_img))
-
-    for seg in imgs:
-        single_seg = sitk.GetArrayViewFromImage(seg)
-        new_seg[single_seg > 0.5] = fill_label
-
-    img_out = sitk.GetImageFromArray(new_seg)
-    img_out.CopyInformation(ref_img)
-    return img_out
+    combined_arr, multilabel_arr, foreground_arr = None, None, None
+    for i, seg in enumerate(_iter_segmentations(imgs, num_workers)):
+        seg_arr = sitk.GetArrayViewFromImage(seg)
+        if combined_arr is None:
+            if ref_img is None:
+                ref_img = seg
+            combined_arr = np.zeros(seg_arr.shape, dtype=np.uint8)
+            foreground_arr = np.empty(seg_arr.shape, dtype=bool)
+            if return_multilabel:
+                multilabel_arr = np.zeros(seg_arr.shape, dtype=np.uint8)
+            geometry = ref_img.GetOrigin(), ref_img.GetSpacing(), ref_img.GetDirection()
+            ref_img = None  # do not hold on to the first segmentation
+
+        np.greater(seg_arr, 0.5, out=foreground_arr)
+        np.copyto(combined_arr, fill_label, where=foreground_arr)
+        if return_multilabel:
+            np.copyto(
+                multilabel_arr,
+                i + 1 if labels is None else labels[i],
+                where=foreground_arr,
+            )
+        del seg_arr, seg
+
+    if combined_arr is None:
+        raise ValueError("no segmentation to combine")
+
+    def to_image(arr):
+        img_out = sitk.GetImageFromArray(arr)
+        img_out.SetOrigin(geometry[0])
+        img_out.SetSpacing(geometry[1])
+        img_out.SetDirection(geometry[2])
+        return img_out
+
+    if return_multilabel:
+        return to_image(combined_arr), to_image(multilabel_arr)
+    return to_image(combined_arr)
 
 
 def mask_ct_with_seg(img: sitk.Image, seg: sitk.Image):
@@ -64,14 +128,27 @@ def mask_ct_with_seg(img: sitk.Image, seg: sitk.Image):
     return sitk.LabelMapMask(sitk.Cast(seg, sitk.sitkLabelUInt8), img)
 
 
+INTEGER_PIXEL_IDS = (
+    sitk.sitkUInt8,
+    sitk.sitkInt8,
+    sitk.sitkUInt16,
+    sitk.sitkInt16,
+    sitk.sitkUInt32,
+    sitk.sitkInt32,
+    sitk.sitkUInt64,
+    sitk.sitkInt64,
+)
+
+
 def change_label(img: sitk.Image, mapping_dict) -> sitk.Image:
     """
     use SimplITK AggregateLabelMapFilter to merge all segmentation labels to first label.
     This is used to obtain the bounding box of all the labels
+    floating point labels are truncated (1.6 -> 1) by the uint8 cast, unlike `relabel` which rounds them
     """
-    fltr = sitk.ChangeLabelImageFilter()
-    fltr.SetChangeMap(mapping_dict)
-    return fltr.Execute(sitk.Cast(img, sitk.sitkUInt8))
+    if img.GetPixelID() not in INTEGER_PIXEL_IDS:
+        img = sitk.Cast(img, sitk.sitkUInt8)
+    return relabel(img, mapping=mapping_dict)
 
 
 def keep_only_label(segmentation: sitk.Image, label_id) -> sitk.Image:
@@ -79,20 +156,239 @@ def keep_only_label(segmentation: sitk.Image, label_id) -> sitk.Image:
     return sitk.Threshold(segmentation, label_id, label_id, 0)
 
 
-def get_segmentation_labels(segmentation: sitk.Image):
+class SegmentationIndex:
+    """per-label bounding box, centroid, voxel count and number of voxels on the image border
+    of a segmentation, computed with a single label scan.
+    Provides the `sitk.LabelShapeStatisticsImageFilter` getters used in this package and the
+    geometry of the segmentation, so that it can be passed to the ROI helpers in place of the segmentation.
+    Use `get_segmentation_index` to obtain the memoized index of an image.
+    """
+
+    def __init__(self, segmentation: sitk.Image):
+        # integer labels are indexed as is (e.g. label ids above 255), other pixel types
+        # are cast to uint8 as `get_segmentation_stats` did before
+        if segmentation.GetPixelID() not in INTEGER_PIXEL_IDS:
+            segmentation = sitk.Cast(segmentation, sitk.sitkUInt8)
+        fltr = sitk.LabelShapeStatisticsImageFilter()
+        fltr.Execute(segmentation)
+
+        self.labels = tuple(fltr.GetLabels())
+        self.bounding_boxes = {l: fltr.GetBoundingBox(l) for l in self.labels}
+        self.centroids = {l: fltr.GetCentroid(l) for l in self.labels}
+        self.voxel_counts = {l: fltr.GetNumberOfPixels(l) for l in self.labels}
+        self.border_voxel_counts = {
+            l: fltr.GetNumberOfPixelsOnBorder(l) for l in self.labels
+        }
+
+        self.size = segmentation.GetSize()
+        self.origin = segmentation.GetOrigin()
+        self.spacing = segmentation.GetSpacing()
+        self.direction = segmentation.GetDirection()
+
+    def has_same_geometry(self, img: sitk.Image) -> bool:
+        """does img occupy the same grid as the indexed segmentation"""
+        return (
+            img.GetSize() == self.size
+            and img.GetOrigin() == self.origin
+            and img.GetSpacing() == self.spacing
+            and img.GetDirection() == self.direction
+        )
+
+    # label statistics, same interface as sitk.LabelShapeStatisticsImageFilter
+    def GetLabels(self):
+        return self.labels
+
+    def HasLabel(self, label) -> bool:
+        return label in self.bounding_boxes
+
+    def GetBoundingBox(self, label):
+        return self.bounding_boxes[label]
+
+    def GetCentroid(self, label):
+        return self.centroids[label]
+
+    def GetNumberOfPixels(self, label):
+        return self.voxel_counts[label]
+
+    def GetNumberOfPixelsOnBorder(self, label):
+        return self.border_voxel_counts[label]
+
+    # geometry, same interface as sitk.Image
+    def GetSize(self):
+        return self.size
+
+    def GetDimension(self):
+        return len(self.size)
+
+    def GetOrigin(self):
+        return self.origin
+
+    def GetSpacing(self):
+        return self.spacing
+
+    def GetDirection(self):
+        return self.direction
+
+
+# id(image) -> (weak reference to image, index)
+_segmentation_index_cache: Dict[int, Tuple[weakref.ref, SegmentationIndex]] = {}
+
+
+def get_segmentation_index(
+    segmentation: Union[sitk.Image, SegmentationIndex]
+) -> SegmentationIndex:
+    """memoized `SegmentationIndex` of a segmentation: the labels are scanned once per image object.
+    The index is recomputed if the geometry of the image changes, but not if its voxels are modified in-place.
+    """
+    if isinstance(segmentation, SegmentationIndex):
+        return segmentation
+    key = id(segmentation)
+    cached = _segmentation_index_cache.get(key)
+    if (
+        cached is not None
+        and cached[0]() is segmentation
+        and cached[1].has_same_geometry(segmentation)
+    ):
+        return cached[1]
+
+    index = SegmentationIndex(segmentation)
+    ref = weakref.ref(
+        segmentation, lambda _, key=key: _segmentation_index_cache.pop(key, None)
+    )
+    _segmentation_index_cache[key] = (ref, index)
+    return index
+
+
+def get_segmentation_labels(segmentation: Union[sitk.Image, SegmentationIndex]):
     """return segmentation labels"""
-    fltr = sitk.LabelShapeStatisticsImageFilter()
-    fltr.Execute(sitk.Cast(segmentation, sitk.sitkUInt8))
-    return fltr.GetLabels()
+    return get_segmentation_index(segmentation).GetLabels()
 
 
 def get_segmentation_stats(
+    segmentation: Union[sitk.Image, SegmentationIndex],
+) -> SegmentationIndex:
+    """return memoized obj containing segmentation stats, see `SegmentationIndex`"""
+    return get_segmentation_index(segmentation)
+
+
+def get_labels_bounding_box(
+    stats: SegmentationIndex, label_ids: Optional[Sequence] = None
+) -> Optional[Tuple[List[int], List[int]]]:
+    """(start index, size) of the bounding box enclosing all `label_ids` (default: all labels)
+    None if none of the labels is present
+    """
+    label_ids = stats.GetLabels() if label_ids is None else label_ids
+    bboxes = [stats.GetBoundingBox(label) for label in label_ids if stats.HasLabel(label)]
+    if not bboxes:
+        return None
+    bboxes = np.asarray(bboxes)
+    dim = bboxes.shape[1] // 2
+    lower = bboxes[:, :dim].min(axis=0)
+    upper = (bboxes[:, :dim] + bboxes[:, dim:]).max(axis=0)
+    return lower.tolist(), (upper - lower).tolist()
+
+
+def get_largest_connected_components(
     segmentation: sitk.Image,
-) -> sitk.LabelShapeStatisticsImageFilter:
-    """return sitk filter obj containing segmentation stats"""
-    fltr = sitk.LabelShapeStatisticsImageFilter()
-    fltr.Execute(sitk.Cast(segmentation, sitk.sitkUInt8))
-    return fltr
+    stats: Optional[SegmentationIndex] = None,
+    label_ids: Optional[Sequence] = None,
+    margin=1,
+    crop_to_bbox=True,
+    regions: Optional[Dict[int, Tuple[Sequence[int], Sequence[int]]]] = None,
+) -> Tuple[Dict[int, sitk.Image], Dict[int, int]]:
+    """`get_largest_connected_component` of each label of a multi-label segmentation
+
+    All labels are labelled in one ScalarConnectedComponent pass over the bounding box enclosing `label_ids`
+    (default: all labels) and each label is then cleaned within its own bounding box plus `margin` voxels.
+    A component of a label never leaves the label's bounding box, so the masks are the same as those of
+    `get_largest_connected_component(segmentation == label)`.
+
+    Args:
+        stats: label statistics of segmentation, defaults to the memoized `SegmentationIndex`
+        crop_to_bbox: if True, each mask covers only the bounding box (plus margin) of its label and keeps its
+            physical position, otherwise it is pasted into an image on the grid of segmentation
+        regions: optional (start index, size) of a region of segmentation per label, e.g. the ROI extracted
+            around it. Voxels outside of the region are ignored, the mask of the label is the same as
+            `get_largest_connected_component` of the label in `segmentation[region]`. The label is labelled
+            on its own within the intersection of its bounding box and region, labels without voxels
+            inside their region are left out
+
+    Returns:
+        per-label uint8 binary masks of the largest component and per-label number of voxels removed
+    """
+    if stats is None:
+        stats = get_segmentation_index(segmentation)
+    label_ids = [
+        l for l in (stats.GetLabels() if label_ids is None else label_ids) if stats.HasLabel(l)
+    ]
+    regions = {} if regions is None else regions
+    shared_label_ids = [label for label in label_ids if label not in regions]
+
+    if shared_label_ids:
+        # single labelling pass over the region holding all labels without a region of their own
+        bbox_start, bbox_size = get_labels_bounding_box(stats, shared_label_ids)
+        crop_start = [max(st - margin, 0) for st in bbox_start]
+        crop_end = [
+            min(st + sz + margin, seg_sz)
+            for st, sz, seg_sz in zip(bbox_start, bbox_size, segmentation.GetSize())
+        ]
+        crop_size = [end - st for st, end in zip(crop_start, crop_end)]
+        seg_crop = sitk.RegionOfInterest(segmentation, crop_size, crop_start)
+        seg_arr = sitk.GetArrayViewFromImage(seg_crop)
+        # neighbouring voxels are connected only if they have the same label
+        components_crop = sitk.ScalarConnectedComponent(seg_crop, 0.0, False)
+        component_arr = sitk.GetArrayViewFromImage(components_crop)
+
+    masks, removed_voxels = {}, {}
+    for label in label_ids:
+        label_start, label_size = get_labels_bounding_box(stats, [label])
+        start = [max(st - margin, 0) for st in label_start]
+        end = [
+            min(st + sz + margin, seg_sz)
+            for st, sz, seg_sz in zip(label_start, label_size, segmentation.GetSize())
+        ]
+        if label in regions:
+            region_start, region_size = regions[label]
+            start = [max(st, int(r_st)) for st, r_st in zip(start, region_start)]
+            end = [
+                min(e, int(r_st) + int(r_sz))
+                for e, r_st, r_sz in zip(end, region_start, region_size)
+            ]
+            if any(e <= st for st, e in zip(start, end)):
+                continue
+            window = sitk.RegionOfInterest(
+                segmentation, [e - st for st, e in zip(start, end)], start
+            )
+            label_components = sitk.GetArrayFromImage(
+                sitk.ConnectedComponent(window == label)
+            )
+            label_voxels = label_components > 0
+            if not label_voxels.any():
+                continue
+        else:
+            # numpy (z,y,x) slices of the label bounding box within the crop
+            region = tuple(
+                slice(st - crop_st, e - crop_st)
+                for st, e, crop_st in reversed(list(zip(start, end, crop_start)))
+            )
+            label_components = component_arr[region]
+            label_voxels = seg_arr[region] == label
+        components, counts = np.unique(label_components[label_voxels], return_counts=True)
+        # ties are resolved in favour of the first component in raster order, like RelabelComponent
+        largest = np.argmax(counts)
+        mask = sitk.GetImageFromArray(
+            (label_components == components[largest]).astype(np.uint8)
+        )
+        mask.SetSpacing(segmentation.GetSpacing())
+        mask.SetDirection(segmentation.GetDirection())
+        mask.SetOrigin(segmentation.TransformIndexToPhysicalPoint(start))
+        if not crop_to_bbox:
+            full_mask = sitk.Image(segmentation.GetSize(), sitk.sitkUInt8)
+            full_mask.CopyInformation(segmentation)
+            mask = sitk.Paste(full_mask, mask, mask.GetSize(), [0] * len(start), start)
+        masks[label] = mask
+        removed_voxels[label] = int(counts.sum() - counts[largest])
+    return masks, removed_voxels
 
 
 def flip_image(img: sitk.Image, flip_axes) -> sitk.Image:
@@ -162,28 +458,31 @@ def make_isotropic(img: sitk.Image, spacing=None, interpolator="linear"):
     return resampler.Execute(img)
 
 
-def simulate_parallel_projection(
-    segmentation: sitk.Image, projectiontype: ProjectionType
-):
-    """return a mean projection"""
-    segmentation = make_isotropic(segmentation, 1.0, "nearest")
-    orientation = get_orientation_code_itk(segmentation)
+def get_projection_dimension(orientation, projectiontype: ProjectionType) -> int:
+    """which image dimension does the AP/LAT x-ray project along? e.g. PIR, AP -> 0"""
     orientation = list(orientation)
-
     if projectiontype == ProjectionType.AP:
         if "P" in orientation:
-            dim = orientation.index("P")
+            return orientation.index("P")
         elif "A" in orientation:
-            dim = orientation.index("A")
+            return orientation.index("A")
     elif projectiontype == ProjectionType.LAT:
         if "L" in orientation:
-            dim = orientation.index("L")
+            return orientation.index("L")
         elif "R" in orientation:
-            dim = orientation.index("R")
-    else:
-        raise ValueError(
-            f"Projection type should be one of {ProjectionType.AP} or {ProjectionType.LAT}"
-        )
+            return orientation.index("R")
+    raise ValueError(
+        f"Projection type should be one of {ProjectionType.AP} or {ProjectionType.LAT}"
+    )
+
+
+def simulate_parallel_projection(
+    segmentation: sitk.Image, projectiontype: ProjectionType
+):
+    """return a mean projection"""
+    segmentation = make_isotropic(segmentation, 1.0, "nearest")
+    orientation = get_orientation_code_itk(segmentation)
+    dim = get_projection_dimension(orientation, projectiontype)
 
     projection = sitk.MeanProjection(segmentation, projectionDimension=dim)
     projection = sitk.Cast(sitk.RescaleIntensity(projection), sitk.sitkUInt8)
@@ -195,6 +494,137 @@ def simulate_parallel_projection(
         return projection[:, :, 0]
 
 
+def get_nearest_neighbour_indices(size, old_spacing, new_spacing) -> np.ndarray:
+    """voxel indices sampled along one axis by the nearest neighbour resampling of `make_isotropic`
+    -1 marks samples outside of the image (filled with the default value 0)
+    the size is rounded like `make_isotropic`, samples exactly halfway between two voxels
+    are rounded up here while ITK may round them down, so they can be one voxel apart
+    """
+    new_size = round(size * old_spacing / new_spacing)
+    continuous_index = np.arange(new_size) * new_spacing / old_spacing
+    indices = np.floor(continuous_index + 0.5).astype(np.int64)
+    indices[indices > size - 1] = -1
+    return indices
+
+
+def parallel_projection_array(arr: np.ndarray, size, spacing, dim, new_spacing=1.0):
+    """mean projection along image dimension `dim` of `arr` (...,z,y,x) as if it were
+    resampled with `make_isotropic(img, new_spacing, "nearest")` first
+    - the projection axis is weighted by how often each voxel is sampled by the resampling
+    - only the 2D projection is resampled in-plane
+    """
+    axis = arr.ndim - 1 - dim
+    indices = get_nearest_neighbour_indices(size[dim], spacing[dim], new_spacing)
+    weights = np.bincount(indices[indices >= 0], minlength=size[dim]).astype(np.float64)
+    projection = np.tensordot(arr, weights, axes=([axis], [0])) / len(indices)
+
+    for other_dim in range(len(size)):
+        if other_dim == dim:
+            continue
+        other_axis = arr.ndim - 1 - other_dim
+        other_axis = other_axis - 1 if other_axis > axis else other_axis
+        indices = get_nearest_neighbour_indices(
+            size[other_dim], spacing[other_dim], new_spacing
+        )
+        projection = np.take(projection, np.maximum(indices, 0), axis=other_axis)
+        outside = [1] * projection.ndim
+        outside[other_axis] = len(indices)
+        projection = projection * (indices >= 0).reshape(outside)
+    return projection
+
+
+def projection_array_to_image(
+    projection: np.ndarray, reference: sitk.Image, dim, new_spacing=1.0
+) -> sitk.Image:
+    """2D uint8 x-ray with the same metadata as `simulate_parallel_projection` would produce"""
+    projection_img = sitk.GetImageFromArray(
+        np.expand_dims(projection, axis=reference.GetDimension() - 1 - dim)
+    )
+    projection_img.SetOrigin(reference.GetOrigin())
+    projection_img.SetDirection(reference.GetDirection())
+    projection_img.SetSpacing((new_spacing,) * reference.GetDimension())
+    projection_img = sitk.Cast(sitk.RescaleIntensity(projection_img), sitk.sitkUInt8)
+    if dim == 0:
+        return projection_img[0, :, :]
+    elif dim == 1:
+        return projection_img[:, 0, :]
+    return projection_img[:, :, 0]
+
+
+def simulate_biplanar_parallel_projection(
+    segmentations: Union[sitk.Image, Sequence[sitk.Image]], spacing=1.0
+):
+    """return (AP, LAT) mean projections computed together from one numpy view of each mask
+    same as `simulate_parallel_projection` without resampling the whole volume, except for samples
+    exactly halfway between two voxels (e.g. 0.8 or 2.0 mm spacing), see `get_nearest_neighbour_indices`
+    A list of masks is projected in batches of masks sharing size, spacing and orientation.
+    """
+    if isinstance(segmentations, sitk.Image):
+        return simulate_biplanar_parallel_projection([segmentations], spacing)[0]
+
+    # group masks of identical geometry so that they can be projected as a single stacked array
+    groups: Dict[tuple, List[int]] = {}
+    for i, seg in enumerate(segmentations):
+        key = (seg.GetSize(), seg.GetSpacing(), seg.GetDirection(), seg.GetPixelID())
+        groups.setdefault(key, []).append(i)
+
+    projections: List[Optional[Tuple[sitk.Image, sitk.Image]]] = [None] * len(
+        segmentations
+    )
+    for key, members in groups.items():
+        size, img_spacing, direction, _ = key
+        orientation = get_orientation_code_itk(direction)
+        if len(members) == 1:
+            arr = sitk.GetArrayViewFromImage(segmentations[members[0]])[None]
+        else:
+            arr = np.stack(
+                [sitk.GetArrayViewFromImage(segmentations[i]) for i in members]
+            )
+        views = []
+        for projectiontype in (ProjectionType.AP, ProjectionType.LAT):
+            dim = get_projection_dimension(orientation, projectiontype)
+            views.append(
+                (dim, parallel_projection_array(arr, size, img_spacing, dim, spacing))
+            )
+        for batch_index, i in enumerate(members):
+            projections[i] = tuple(
+                projection_array_to_image(
+                    projection[batch_index], segmentations[i], dim, spacing
+                )
+                for dim, projection in views
+            )
+    return projections
+
+
+def simulate_biplanar_landmark_projection(
+    centroid_index, sigma, reference: sitk.Image, spacing=1.0
+) -> Tuple[sitk.Image, sitk.Image]:
+    """return (AP, LAT) mean projections of the gaussian heatmap centred at `centroid_index`
+    of `reference`, computed in closed form instead of projecting the heatmap volume.
+    The mean projection of an isotropic gaussian is the gaussian of the in-plane coordinates.
+    """
+    size, img_spacing = reference.GetSize(), reference.GetSpacing()
+    orientation = get_orientation_code_itk(reference)
+    views = []
+    for projectiontype in (ProjectionType.AP, ProjectionType.LAT):
+        dim = get_projection_dimension(orientation, projectiontype)
+        projection = np.ones((1,) * (reference.GetDimension() - 1))
+        in_plane_dims = [d for d in range(reference.GetDimension()) if d != dim]
+        # array axes are in reverse order of the image dimensions
+        for axis, other_dim in enumerate(reversed(in_plane_dims)):
+            indices = get_nearest_neighbour_indices(
+                size[other_dim], img_spacing[other_dim], spacing
+            )
+            # evaluated at the voxels picked by the nearest neighbour resampling
+            distance = (indices - centroid_index[other_dim]) * img_spacing[other_dim]
+            profile = np.exp(-distance * distance / (2 * sigma**2)) * (indices >= 0)
+            shape = [1] * projection.ndim
+            shape[axis] = len(indices)
+            projection = projection * profile.reshape(shape)
+        views.append(projection_array_to_image(projection, reference, dim, spacing))
+    return tuple(views)
+
+
 def rotate_about_image_center(img: sitk.Image, rx, ry, rz) -> sitk.Image:
     """rotation angles are assumed to be given in degrees"""
 